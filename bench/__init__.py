@@ -0,0 +1 @@
+# Here to make this a package
@@ -0,0 +1,155 @@
+# Benchmarks for the checksum database
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import hashlib
+import os
+
+from fusesha1util import sqliteConn
+from sha1db import Sha1DB
+from sha1diff import Differ
+from bench.benchutil import result, rate, scratchDir, Timer
+from bench.synthtree import makeTree
+
+# how many calls each of the single row operations is timed over
+OPS_PER_MEASUREMENT = 200
+
+def fillRows(sha1db, rows, prefix="/synthetic", copies=1):
+  """Bulk inserts rows synthetic entries (for paths that do not exist) in one transaction, each
+  run of copies of them having the same checksum."""
+  def entries():
+    for i in xrange(rows):
+      path = "%s/d%d/f%d" % (prefix, i % 1000, i)
+      key = path if copies == 1 else "%s/%d" % (prefix, i // copies)
+      yield (path, hashlib.sha1(key).hexdigest(), 0)
+  with sqliteConn(sha1db.database) as cursor:
+    cursor.executemany("insert or replace into files(path, chksum, symlink) values(?, ?, ?);",
+                       entries())
+
+def benchRowOps(workdir, paths, rows):
+  """Times updateChecksum, updatePath and removeChecksum against a database already holding
+  rows entries."""
+  results = []
+  sample = paths[:OPS_PER_MEASUREMENT]
+  sha1db = Sha1DB(os.path.join(workdir, "rows%d.db" % rows))
+  fillRows(sha1db, rows)
+
+  with Timer() as t:
+    for path in sample:
+      sha1db.updateChecksum(path)
+  results.append(result("db.updateChecksum", rate(len(sample), t.elapsed), "ops/s", rows=rows))
+
+  with Timer() as t:
+    for path in sample:
+      sha1db.updatePath(path, path + ".moved")
+  results.append(result("db.updatePath", rate(len(sample), t.elapsed), "ops/s", rows=rows))
+
+  with Timer() as t:
+    for path in sample:
+      sha1db.removeChecksum(path + ".moved")
+  results.append(result("db.removeChecksum", rate(len(sample), t.elapsed), "ops/s", rows=rows))
+  return results
+
+def benchManifests(workdir, rows):
+  """Times exporting a database of rows entries as a sha1sum manifest and importing it into an
+  empty database (trusted, as the synthetic paths don't exist), and importing one in which every
+  checksum appears twice, which keeps the duplicate counts busy."""
+  results = []
+  for copies in (1, 2):
+    sha1db = Sha1DB(os.path.join(workdir, "export%d-%d.db" % (rows, copies)))
+    fillRows(sha1db, rows, copies=copies)
+    manifest = os.path.join(workdir, "manifest%d-%d.txt" % (rows, copies))
+    with Timer() as t:
+      with open(manifest, "wb") as out:
+        sha1db.exportManifest(out)
+    if copies == 1:
+      results.append(result("db.exportManifest", rate(rows, t.elapsed), "rows/s", rows=rows))
+
+    target = Sha1DB(os.path.join(workdir, "import%d-%d.db" % (rows, copies)))
+    with Timer() as t:
+      with open(manifest) as lines:
+        target.importManifest(lines, trust=True)
+    params = {"rows": rows} if copies == 1 else {"rows": rows, "copies": copies}
+    results.append(result("db.importManifest", rate(rows, t.elapsed), "rows/s", **params))
+  return results
+
+def benchDiff(workdir, rows):
+  """Times comparing two databases of rows entries, one of which has a percent of its files
+  changed and another percent moved, with and without matching by digest."""
+  results = []
+  sha1db = Sha1DB(os.path.join(workdir, "diff%d.db" % rows))
+  fillRows(sha1db, rows)
+  other = Sha1DB(os.path.join(workdir, "other%d.db" % rows))
+  fillRows(other, rows)
+  with sqliteConn(other.database) as cursor:
+    cursor.execute("update files set chksum = 'x' || chksum where rowid % 100 = 0;")
+    cursor.execute("update files set path = path || '.moved' where rowid % 100 = 1;")
+  for matchDigests in (False, True):
+    with Timer() as t:
+      Differ(sha1db, other.database, matchDigests=matchDigests).run()
+    results.append(result("db.diff", rate(rows, t.elapsed), "rows/s", rows=rows,
+                          matchDigests=matchDigests))
+  return results
+
+def benchMaintenance(workdir, options):
+  """Times updateAllChecksums, vacuum and dedup end to end over a fresh synthetic tree."""
+  root = os.path.join(workdir, "maint")
+  (paths, totalBytes) = makeTree(root, options.files, options.sizes, options.dupRatio,
+                                 options.fanout, options.seed)
+  sha1db = Sha1DB(os.path.join(workdir, "maint.db"))
+  results = []
+
+  with Timer() as t:
+    sha1db.updateAllChecksums(root)
+  results.append(result("db.updateAllChecksums", rate(len(paths), t.elapsed), "files/s",
+                        files=len(paths), bytes=totalBytes))
+  results.append(result("db.updateAllChecksums.throughput", rate(totalBytes, t.elapsed) / 1048576,
+                        "MB/s", files=len(paths), bytes=totalBytes))
+
+  # give vacuum something to remove: as many dangling rows as real ones
+  fillRows(sha1db, len(paths))
+  with Timer() as t:
+    sha1db.vacuum()
+  results.append(result("db.vacuum", rate(2 * len(paths), t.elapsed), "rows/s",
+                        rows=2 * len(paths)))
+
+  with Timer() as t:
+    sha1db.dedup(os.path.join(workdir, "dups"), False)
+  results.append(result("db.dedup", t.elapsed, "s", files=len(paths), dupRatio=options.dupRatio))
+  return results
+
+def benchFindDuplicates(workdir, options):
+  """Times findDuplicates over a fresh synthetic tree with an empty database, and again with the
+  samples and checksums from the first scan, reporting the share of the tree's bytes each read."""
+  root = os.path.join(workdir, "dups")
+  makeTree(root, options.files, options.sizes, options.dupRatio, options.fanout, options.seed)
+  sha1db = Sha1DB(os.path.join(workdir, "dups.db"))
+  results = []
+  for label in ("fresh", "cached"):
+    with Timer() as t:
+      (groups, totalBytes, readBytes) = sha1db.findDuplicates(root)
+    results.append(result("db.findDuplicates.%s" % label, t.elapsed, "s", bytes=totalBytes,
+                          groups=len(groups)))
+    results.append(result("db.findDuplicates.%s.read" % label, 100.0 * readBytes / max(totalBytes, 1),
+                          "%", bytes=totalBytes))
+  return results
+
+def run(options, tree, workdir):
+  (paths, totalBytes) = tree
+  results = []
+  for rows in [int(r) for r in options.rows.split(",")]:
+    with scratchDir(workdir) as scratch:
+      results.extend(benchRowOps(scratch, paths, rows))
+    with scratchDir(workdir) as scratch:
+      results.extend(benchManifests(scratch, rows))
+    with scratchDir(workdir) as scratch:
+      results.extend(benchDiff(scratch, rows))
+  with scratchDir(workdir) as scratch:
+    results.extend(benchMaintenance(scratch, options))
+  with scratchDir(workdir) as scratch:
+    results.extend(benchFindDuplicates(scratch, options))
+  return results
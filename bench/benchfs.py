@@ -0,0 +1,164 @@
+# Benchmarks for the Sha1FS file operations, driven in process without a kernel mount
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import os
+import random
+import time
+
+from bench.benchutil import result, rate, latencyResults, scratchDir
+from bench.synthtree import writeRandom
+
+# the request size the kernel typically uses for reads (and for writes with big_writes)
+CHUNK_SIZE = 131072
+
+# the read paths compared by benchReadModes: (name, readahead, mmapReads, verifyReads)
+READ_MODES = (("plain", 0, False, False), ("readahead", 4194304, False, False),
+              ("mmap", 0, True, False), ("verify", 0, False, True))
+
+# the write paths compared by benchWriteModes: (name, writeBuffer)
+WRITE_MODES = (("direct", 0), ("buffered", 4194304))
+
+def makeServer(root, database):
+  """Returns a Sha1FS for root and database, in the state it would be in after mounting.  Note
+  that this changes the current directory to root, as mounting does."""
+  # imported here so that the other benchmarks run without fuse-python installed
+  from sha1fs import Sha1FS
+  server = Sha1FS()
+  server.parse(args=[], values=server, errex=1)
+  server.root = root
+  server.database = database
+  server.initDB()
+  os.chdir(root)
+  server.fsinit()
+  return server
+
+def benchWriteRead(server, paths, root):
+  """Copies every file into the mount with write calls, then reads it back with read calls,
+  timing each write, read and release."""
+  latencies = {"write": [], "read": [], "release": []}
+  written = 0
+  begin = time.time()
+  for src in paths:
+    path = "/" + os.path.basename(src)
+    server.mknod(path, 0100644, 0)
+    fh = server.open(path, os.O_WRONLY)
+    offset = 0
+    with open(src, "rb") as f:
+      while True:
+        buf = f.read(CHUNK_SIZE)
+        if not buf:
+          break
+        start = time.time()
+        server.write(path, buf, offset, fh)
+        latencies["write"].append(time.time() - start)
+        offset += len(buf)
+    written += offset
+    start = time.time()
+    server.release(path, os.O_WRONLY, fh)
+    latencies["release"].append(time.time() - start)
+  writeElapsed = time.time() - begin
+
+  read = 0
+  begin = time.time()
+  for src in paths:
+    path = "/" + os.path.basename(src)
+    fh = server.open(path, os.O_RDONLY)
+    offset = 0
+    while True:
+      start = time.time()
+      buf = server.read(path, CHUNK_SIZE, offset, fh)
+      latencies["read"].append(time.time() - start)
+      if not buf:
+        break
+      offset += len(buf)
+    read += offset
+    server.release(path, os.O_RDONLY, fh)
+  readElapsed = time.time() - begin
+
+  results = [result("fs.write.throughput", rate(written, writeElapsed) / 1048576, "MB/s",
+                    files=len(paths), bytes=written),
+             result("fs.read.throughput", rate(read, readElapsed) / 1048576, "MB/s",
+                    files=len(paths), bytes=read)]
+  for op, values in sorted(latencies.iteritems()):
+    results.extend(latencyResults("fs.%s" % op, values, chunk=CHUNK_SIZE))
+  return results
+
+def benchReadModes(server, path, filesize, requestSizes):
+  """Reads path sequentially and at random offsets through Sha1FS.read, once for every read path
+  in READ_MODES and every request size.  The release isn't timed: it rehashes the file unless
+  --verify-reads has already checked it, which would hide the cost of hashing during the reads.
+  Every read is copied out, as fuse-python copies it into the kernel's reply, so that the modes
+  returning buffers of a map or a read-ahead window pay for the bytes they hand over."""
+  results = []
+  rng = random.Random(0)
+  for size in requestSizes:
+    reply = bytearray(size)
+    offsets = range(0, filesize, size)
+    shuffled = list(offsets)
+    rng.shuffle(shuffled)
+    for (mode, readahead, mmapReads, verifyReads) in READ_MODES:
+      server.readahead = readahead
+      server.mmapReads = mmapReads
+      server.verifyReads = verifyReads
+      for (pattern, order) in (("sequential", offsets), ("random", shuffled)):
+        fh = server.open(path, os.O_RDONLY)
+        start = time.time()
+        for offset in order:
+          data = server.read(path, size, offset, fh)
+          reply[:len(data)] = data
+        elapsed = time.time() - start
+        server.release(path, os.O_RDONLY, fh)
+        results.append(result("fs.read.%s.%s" % (pattern, mode), rate(filesize, elapsed) / 1048576,
+                              "MB/s", request=size, bytes=filesize))
+  server.readahead = 0
+  server.mmapReads = False
+  server.verifyReads = False
+  return results
+
+def benchWriteModes(server, filesize, requestSizes):
+  """Writes a file of filesize bytes sequentially through Sha1FS.write for every write path in
+  WRITE_MODES and every request size, including the release (which hashes the file)."""
+  results = []
+  for size in requestSizes:
+    buf = os.urandom(size)
+    for (mode, writeBuffer) in WRITE_MODES:
+      server.writeBuffer = writeBuffer
+      path = "/write-%s-%d.bin" % (mode, size)
+      server.mknod(path, 0100644, 0)
+      fh = server.open(path, os.O_WRONLY)
+      start = time.time()
+      for offset in xrange(0, filesize, size):
+        server.write(path, buf, offset, fh)
+      server.flush(path, fh)
+      writeElapsed = time.time() - start
+      server.release(path, os.O_WRONLY, fh)
+      elapsed = time.time() - start
+      results.append(result("fs.write.sequential.%s" % mode, rate(filesize, writeElapsed) / 1048576,
+                            "MB/s", request=size, bytes=filesize))
+      results.append(result("fs.write.sequential.%s.withrelease" % mode,
+                            rate(filesize, elapsed) / 1048576, "MB/s", request=size, bytes=filesize))
+      server.unlink(path)
+  server.writeBuffer = 0
+  return results
+
+def run(options, tree, workdir):
+  (paths, totalBytes) = tree
+  cwd = os.getcwd()
+  with scratchDir(workdir) as scratch:
+    root = os.path.join(scratch, "root")
+    os.mkdir(root)
+    try:
+      server = makeServer(root, os.path.join(scratch, "fs.db"))
+      results = benchWriteRead(server, paths, root)
+
+      writeRandom(os.path.join(root, "large.bin"), options.readSize)
+      results.extend(benchReadModes(server, "/large.bin", options.readSize, (4096, CHUNK_SIZE)))
+      results.extend(benchWriteModes(server, options.readSize, (4096, CHUNK_SIZE, 1048576)))
+      return results
+    finally:
+      os.chdir(cwd)
@@ -0,0 +1,86 @@
+# Benchmarks for file hashing
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import hashlib
+
+from fusesha1util import fileChecksum, fileChecksums, hashConstructor
+from sha1chunk import chunkFile
+from bench.benchutil import result, rate, Timer
+
+# the algorithms measured by default: all of these that this hashlib provides
+DEFAULT_ALGORITHMS = ("md5", "sha1", "sha256", "sha512", "blake2b", "blake2s")
+
+def availableAlgorithms():
+  """Returns a comma separated list of the DEFAULT_ALGORITHMS that hashlib provides."""
+  available = []
+  for name in DEFAULT_ALGORITHMS:
+    try:
+      hashConstructor(name)
+      available.append(name)
+    except ValueError:
+      pass
+  return ",".join(available)
+
+def benchChecksum(paths, totalBytes, algorithms):
+  """Hashes every path once per algorithm with fileChecksum.  The files are read once beforehand
+  so that every algorithm is measured against the page cache rather than the disk."""
+  for path in paths:
+    fileChecksum(path, hashlib.md5)
+
+  results = []
+  for name in algorithms:
+    func = hashConstructor(name)
+    with Timer() as t:
+      for path in paths:
+        fileChecksum(path, func)
+    results.append(result("checksum.%s" % name, rate(totalBytes, t.elapsed) / 1048576, "MB/s",
+                          files=len(paths), bytes=totalBytes))
+  return results
+
+def benchMultiChecksum(paths, totalBytes, algorithms):
+  """Hashes every path with all of the algorithms at once with fileChecksums, which reads each
+  file once, for comparison with the sum of the single algorithm results."""
+  funcs = [hashConstructor(name) for name in algorithms]
+  with Timer() as t:
+    for path in paths:
+      fileChecksums(path, funcs)
+  return [result("checksum.all", rate(totalBytes, t.elapsed) / 1048576, "MB/s",
+                 files=len(paths), bytes=totalBytes, algorithms=",".join(algorithms))]
+
+def benchChunking(paths, totalBytes, algorithms):
+  """Chunks every path once per algorithm with chunkFile, which also calculates the whole file
+  checksum, for comparison with the plain checksum results.  Also reports how many of the bytes
+  are in chunks seen before."""
+  results = []
+  for name in algorithms:
+    func = hashConstructor(name)
+    seen = set()
+    sharedBytes = 0
+    chunkCount = 0
+    with Timer() as t:
+      for path in paths:
+        (chksum, chunks) = chunkFile(path, func)
+        for (offset, size, digest) in chunks:
+          if digest in seen:
+            sharedBytes += size
+          seen.add(digest)
+        chunkCount += len(chunks)
+    results.append(result("chunk.%s" % name, rate(totalBytes, t.elapsed) / 1048576, "MB/s",
+                          files=len(paths), bytes=totalBytes, chunks=chunkCount))
+  results.append(result("chunk.shared", 100.0 * sharedBytes / max(totalBytes, 1), "%",
+                        files=len(paths), bytes=totalBytes))
+  return results
+
+def run(options, tree, workdir):
+  (paths, totalBytes) = tree
+  algorithms = options.algorithms.split(",")
+  results = benchChecksum(paths, totalBytes, algorithms)
+  if len(algorithms) > 1:
+    results.extend(benchMultiChecksum(paths, totalBytes, algorithms))
+  results.extend(benchChunking(paths, totalBytes, algorithms))
+  return results
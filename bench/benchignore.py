@@ -0,0 +1,65 @@
+# Benchmarks for the ignore rules
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import os
+import random
+
+from sha1ignore import IgnoreRules
+from bench.benchutil import result, Timer
+
+# A rule set of the size and kind a home directory or source tree needs
+RULES = ["*.swp", "*.swo", "*~", ".#*", "*.part", "*.crdownload", "*.tmp", "build/", "dist/",
+         "node_modules/", ".git/", "__pycache__/", "/cache/**", "*.o", "*.pyc",
+         r"re:/core\.\d+$", "ext:.iso .img .vmdk", "!keep.tmp"]
+
+# Paths to match on top of the synthetic tree, so that the timing isn't dominated by loop overhead
+PATHS = 100000
+
+# Names the generated paths are built from, some of which are ignored
+NAMES = ["photo.jpg", "notes.txt", ".notes.txt.swp", "main.c", "main.o", "disk.iso", "song.mp3",
+         "report.pdf", "setup.tmp", "keep.tmp", "core.1234", "index.html"]
+DIRS = ["home", "user", "src", "build", "docs", "music", "node_modules", "cache", "2011", "a"]
+
+def makePaths(root, count, seed=0):
+  """Returns count random paths under root, two to six directories deep."""
+  rng = random.Random(seed)
+  paths = []
+  for i in xrange(count):
+    parts = [rng.choice(DIRS) for d in xrange(rng.randint(2, 6))]
+    paths.append(os.path.join(root, *(parts + [rng.choice(NAMES)])))
+  return paths
+
+def benchMatch(name, matcher, paths, **params):
+  """Times matcher over every path, returning the cost per path and the share of paths matched."""
+  ignored = 0
+  with Timer() as t:
+    for path in paths:
+      if matcher(path):
+        ignored += 1
+  return [result("ignore.%s" % name, t.elapsed * 1e9 / max(len(paths), 1), "ns/path",
+                 paths=len(paths), **params),
+          result("ignore.%s.matched" % name, 100.0 * ignored / max(len(paths), 1), "%",
+                 paths=len(paths), **params)]
+
+def run(options, tree, workdir):
+  (treePaths, totalBytes) = tree
+  root = os.path.commonprefix(treePaths).rsplit("/", 1)[0]
+  paths = treePaths + makePaths(root, PATHS, options.seed)
+  sizes = dict((path, 1 << (i % 32)) for (i, path) in enumerate(paths))
+
+  results = []
+  # the single substring test the mount used before there were rules
+  results.extend(benchMatch("substring", lambda path: path.find(".Trash") >= 0, paths))
+  defaults = IgnoreRules(root=root)
+  results.extend(benchMatch("defaults", defaults.ignored, paths, rules=0))
+  rules = IgnoreRules(RULES, root)
+  results.extend(benchMatch("rules", rules.ignored, paths, rules=len(RULES)))
+  sized = IgnoreRules(RULES + ["minsize:1", "maxsize:1G"], root)
+  results.extend(benchMatch("sized", lambda path: sized.ignored(path, sizes[path]), paths,
+                            rules=len(RULES) + 2))
+  return results
@@ -0,0 +1,126 @@
+# Benchmarks for the checksum query daemon
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import hashlib
+import os
+import random
+import threading
+
+from pysqlite2 import dbapi2 as sqlite
+
+from sha1db import Sha1DB
+from sha1query import QueryClient, QueryServer, QueryService
+from bench.benchdb import fillRows
+from bench.benchutil import result, rate, scratchDir, Timer
+
+# Paths looked up per measurement (a tenth of them for a connection per lookup, which is slow),
+# and the batch sizes sent to the server
+LOOKUPS = 20000
+BATCHES = [1, 100]
+
+def samplePaths(rows, count, seed=0):
+  """Returns count (or, if there are fewer, rows) different random paths of the rows filled in by
+  benchdb.fillRows, so that the first pass through them never hits the cache."""
+  rng = random.Random(seed)
+  return ["/synthetic/d%d/f%d" % (row % 1000, row)
+          for row in rng.sample(xrange(rows), min(count, rows))]
+
+def benchDirect(sha1db, paths, rows):
+  """Times lookups straight from SQLite: with a connection per lookup (Sha1DB.lookupChecksum, as a
+  script would call it) and with one connection kept open."""
+  results = []
+  sample = paths[:len(paths) / 10]
+  with Timer() as t:
+    for path in sample:
+      sha1db.lookupChecksum(path)
+  results.append(result("query.direct.connect", rate(len(sample), t.elapsed), "lookups/s",
+                        rows=rows))
+
+  connection = sqlite.connect(sha1db.database)
+  try:
+    cursor = connection.cursor()
+    with Timer() as t:
+      for path in paths:
+        cursor.execute("select chksum from files where path = ?;", (path, ))
+        cursor.fetchall()
+    results.append(result("query.direct.open", rate(len(paths), t.elapsed), "lookups/s",
+                          rows=rows))
+  finally:
+    connection.close()
+  return results
+
+def benchServer(sha1db, paths, rows, workdir):
+  """Times lookups through a QueryServer in batches of each of BATCHES, with the cache empty and
+  then again once it holds every path."""
+  results = []
+  for batch in BATCHES:
+    server = QueryServer(os.path.join(workdir, "query%d.sock" % batch), QueryService(sha1db))
+    server.start()
+    try:
+      with QueryClient(server.socketPath) as client:
+        for label in ("cold", "hot"):
+          with Timer() as t:
+            for start in xrange(0, len(paths), batch):
+              client.digests(paths[start:start + batch])
+          results.append(result("query.socket.%s" % label, rate(len(paths), t.elapsed),
+                                 "lookups/s", rows=rows, batch=batch))
+    finally:
+      server.stop()
+      server.join()
+  return results
+
+def benchConcurrentWrites(sha1db, paths, rows, workdir, batch=BATCHES[-1]):
+  """Times lookups of paths the cache already holds through a QueryServer while another connection
+  keeps committing entries for other paths, as the mount does while files are written.  Each
+  commit makes the server read the changes it logged, without dropping the entries looked up."""
+  server = QueryServer(os.path.join(workdir, "writes.sock"), QueryService(sha1db))
+  server.start()
+  stop = threading.Event()
+  written = []
+
+  def write():
+    connection = sqlite.connect(sha1db.database, isolation_level=None)
+    try:
+      while not stop.is_set():
+        path = "/written/f%d" % len(written)
+        connection.execute("insert or replace into files(path, chksum, symlink) values(?, ?, 0);",
+                           (path, hashlib.sha1(path).hexdigest()))
+        written.append(path)
+    finally:
+      connection.close()
+
+  writer = threading.Thread(target=write, name="writer")
+  try:
+    with QueryClient(server.socketPath) as client:
+      for start in xrange(0, len(paths), batch):
+        client.digests(paths[start:start + batch])
+      writer.start()
+      with Timer() as t:
+        for start in xrange(0, len(paths), batch):
+          client.digests(paths[start:start + batch])
+    stop.set()
+    writer.join()
+    results = [result("query.socket.writes", rate(len(paths), t.elapsed), "lookups/s", rows=rows,
+                      batch=batch, commits=len(written))]
+  finally:
+    stop.set()
+    server.stop()
+    server.join()
+  return results
+
+def run(options, tree, workdir):
+  results = []
+  for rows in [int(r) for r in options.rows.split(",")]:
+    with scratchDir(workdir) as scratch:
+      sha1db = Sha1DB(os.path.join(scratch, "query%d.db" % rows))
+      fillRows(sha1db, rows)
+      paths = samplePaths(rows, LOOKUPS, options.seed)
+      results.extend(benchDirect(sha1db, paths, rows))
+      results.extend(benchServer(sha1db, paths, rows, scratch))
+      results.extend(benchConcurrentWrites(sha1db, paths, rows, scratch))
+  return results
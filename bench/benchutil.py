@@ -0,0 +1,50 @@
+# Helpers shared by the benchmarks
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import shutil
+import tempfile
+import time
+
+from contextlib import contextmanager
+from sha1trace import percentile
+
+def result(name, value, unit, **params):
+  """Returns one benchmark result in the form written to the JSON output."""
+  return {"name": name, "value": value, "unit": unit, "params": params}
+
+def rate(count, elapsed):
+  """Returns count per second, or 0 if nothing measurable elapsed."""
+  if elapsed <= 0:
+    return 0
+  return count / elapsed
+
+def latencyResults(name, latencies, **params):
+  """Returns p50/p99/max results, in microseconds, for a list of latencies in seconds."""
+  ordered = sorted(latencies)
+  results = []
+  for label, fraction in (("p50", 0.50), ("p99", 0.99), ("max", 1.0)):
+    results.append(result("%s.%s" % (name, label), percentile(ordered, fraction) * 1000000,
+                          "us", **params))
+  return results
+
+class Timer:
+  """Measures the wall clock time of a with block in its elapsed attribute."""
+  def __enter__(self):
+    self.start = time.time()
+    return self
+  def __exit__(self, type, value, trace):
+    self.elapsed = time.time() - self.start
+
+@contextmanager
+def scratchDir(parent=None):
+  """Provides a temporary directory that is removed along with its contents afterwards."""
+  path = tempfile.mkdtemp(prefix="sha1bench", dir=parent)
+  try:
+    yield path
+  finally:
+    shutil.rmtree(path, True)
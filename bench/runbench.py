@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# Runs the fuse-sha1 benchmarks and writes the results as JSON
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import json
+import os
+import platform
+import sys
+import time
+
+from optparse import OptionParser
+
+from bench import benchdb, benchfs, benchhash, benchignore, benchquery
+from bench.benchutil import scratchDir
+from bench.synthtree import makeTree
+
+# Benchmark suites by name.  Each is called with the options, the shared synthetic tree (a list of
+# paths and the total bytes in them) and a scratch directory, and returns a list of results.
+SUITES = {"checksum": benchhash.run,
+          "db": benchdb.run,
+          "fs": benchfs.run,
+          "ignore": benchignore.run,
+          "query": benchquery.run}
+
+def compare(results, baselineFile):
+  """Prints the ratio of every result to the result of the same name and params in baselineFile."""
+  with open(baselineFile) as f:
+    baseline = json.load(f)
+  def key(r):
+    return (r["name"], json.dumps(r["params"], sort_keys=True))
+  old = dict((key(r), r) for r in baseline["results"])
+  for r in results:
+    match = old.get(key(r))
+    if match is not None and match["value"]:
+      print >> sys.stderr, "%-40s %12.2f %-6s (%.2fx baseline)" % (r["name"], r["value"],
+          r["unit"], r["value"] / match["value"])
+
+def main():
+  usage = """%prog runs the fuse-sha1 benchmarks against a synthetic tree.  Run from the top of
+the source tree as python -m bench.runbench [options]."""
+  parser = OptionParser(usage = usage)
+  parser.add_option("--suites", dest = "suites", default = ",".join(sorted(SUITES.keys())),
+                    help = "comma separated suites to run [default: %default]")
+  parser.add_option("--files", dest = "files", type = "int", default = 200,
+                    help = "number of files in the synthetic tree [default: %default]")
+  parser.add_option("--sizes", dest = "sizes", default = "lognormal:65536:1.5",
+                    help = "file size distribution: N, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA " +
+                           "[default: %default]")
+  parser.add_option("--dup-ratio", dest = "dupRatio", type = "float", default = 0.2,
+                    help = "fraction of files that duplicate another file [default: %default]")
+  parser.add_option("--fanout", dest = "fanout", type = "int", default = 16,
+                    help = "maximum entries per directory [default: %default]")
+  parser.add_option("--seed", dest = "seed", type = "int", default = 0,
+                    help = "random seed for the tree layout [default: %default]")
+  parser.add_option("--rows", dest = "rows", default = "10000,100000",
+                    help = "comma separated database sizes for the row benchmarks [default: %default]")
+  parser.add_option("--read-size", dest = "readSize", type = "int", default = 67108864,
+                    help = "size of the file used to compare read and write paths [default: %default]")
+  parser.add_option("--algorithms", dest = "algorithms", default = benchhash.availableAlgorithms(),
+                    help = "comma separated hashlib algorithms to measure [default: %default]")
+  parser.add_option("--workdir", dest = "workdir", default = None,
+                    help = "directory for the scratch trees and databases [default: system temp]")
+  parser.add_option("--output", dest = "output", default = None,
+                    help = "write the JSON results to OUTPUT instead of stdout", metavar = "OUTPUT")
+  parser.add_option("--baseline", dest = "baseline", default = None,
+                    help = "compare the results with an earlier OUTPUT", metavar = "BASELINE")
+
+  (options, args) = parser.parse_args()
+  suites = options.suites.split(",")
+  for name in suites:
+    if not name in SUITES:
+      parser.error("Unknown suite %s" % name)
+  workdir = os.path.abspath(options.workdir) if options.workdir else None
+
+  results = []
+  started = time.time()
+  with scratchDir(workdir) as scratch:
+    tree = makeTree(os.path.join(scratch, "tree"), options.files, options.sizes, options.dupRatio,
+                    options.fanout, options.seed)
+    for name in suites:
+      print >> sys.stderr, "Running %s" % name
+      try:
+        results.extend(SUITES[name](options, tree, scratch))
+      except ImportError as einst:
+        print >> sys.stderr, "Skipping %s: %s" % (name, einst)
+
+  report = {"started": started,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "options": options.__dict__,
+            "results": results}
+  if options.output:
+    with open(options.output, "w") as f:
+      json.dump(report, f, indent=1, sort_keys=True)
+  else:
+    print json.dumps(report, indent=1, sort_keys=True)
+
+  if options.baseline:
+    compare(results, options.baseline)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,84 @@
+# Generates synthetic directory trees for the benchmarks
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import math
+import os
+import random
+
+def parseSizes(spec, rng):
+  """Returns a function producing file sizes in bytes from a size distribution spec:
+    N                     every file is N bytes
+    uniform:MIN:MAX       sizes drawn uniformly from [MIN, MAX]
+    lognormal:MEDIAN:SIG  sizes drawn from a lognormal distribution around MEDIAN bytes
+  """
+  parts = spec.split(":")
+  if len(parts) == 1:
+    size = int(parts[0])
+    return lambda: size
+  elif parts[0] == "uniform" and len(parts) == 3:
+    low, high = int(parts[1]), int(parts[2])
+    return lambda: rng.randint(low, high)
+  elif parts[0] == "lognormal" and len(parts) == 3:
+    median, sigma = float(parts[1]), float(parts[2])
+    mu = math.log(median)
+    return lambda: int(rng.lognormvariate(mu, sigma))
+  raise ValueError("Unknown size distribution %s" % spec)
+
+def treePath(root, index, count, fanout):
+  """Returns the path of file number index in a tree of count files where every directory holds
+  at most fanout files or subdirectories."""
+  dirIndex = index // fanout
+  ndirs = max(1, (count + fanout - 1) // fanout)
+  depth = 0
+  while fanout ** depth < ndirs:
+    depth += 1
+  parts = []
+  for level in range(depth):
+    parts.append("d%d" % (dirIndex % fanout))
+    dirIndex //= fanout
+  parts.reverse()
+  return os.path.join(root, *(parts + ["f%d.bin" % index]))
+
+def writeRandom(path, size):
+  with open(path, "wb") as f:
+    while size > 0:
+      n = min(size, 1048576)
+      f.write(os.urandom(n))
+      size -= n
+
+def copyContents(src, dst):
+  with open(src, "rb") as fin:
+    with open(dst, "wb") as fout:
+      while True:
+        d = fin.read(1048576)
+        if not d:
+          break
+        fout.write(d)
+
+def makeTree(root, count, sizes="4096", dupRatio=0.0, fanout=16, seed=0):
+  """Creates count files under root, spread over directories holding at most fanout entries each.
+  File sizes follow the sizes spec (see parseSizes).  dupRatio is the fraction of files that are
+  byte for byte copies of an earlier file.  Returns the list of paths and the total bytes written."""
+  rng = random.Random(seed)
+  nextSize = parseSizes(sizes, rng)
+  paths = []
+  uniques = []
+  total = 0
+  for i in range(count):
+    path = treePath(root, i, count, fanout)
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+      os.makedirs(parent)
+    if len(uniques) > 0 and rng.random() < dupRatio:
+      copyContents(rng.choice(uniques), path)
+    else:
+      writeRandom(path, nextSize())
+      uniques.append(path)
+    total += os.path.getsize(path)
+    paths.append(path)
+  return (paths, total)
@@ -6,16 +6,37 @@
 #    See the file COPYING.
 #
 
+import errno
 import hashlib
 import logging
 import os
+import random
+import re
+import socket
+import threading
+import time
 
+from collections import OrderedDict
+from stat import S_ISSOCK
 from contextlib import contextmanager
 from pysqlite2 import dbapi2 as sqlite
+from sha1stats import STATS
 
 LOG_FILENAME = "LOG"
 logging.basicConfig(filename=LOG_FILENAME,level=logging.WARN,)
 
+# Several processes (mounts and sha1db.py jobs) may share a database.  Rather than SQLite's own
+# busy handler, which polls on a fixed schedule, a statement that finds the database locked is
+# retried after a random pause that doubles from BUSY_START up to BUSY_MAX, so that waiting
+# processes don't all retry at once.  After BUSY_TIMEOUT seconds the error is raised.
+BUSY_START = 0.002
+BUSY_MAX = 0.25
+BUSY_TIMEOUT = 30.0
+
+# Statements that start a write transaction; once one has run, the connection holds the write lock
+# until it commits
+WRITE_STATEMENTS = ("insert", "update", "delete", "replace", "begin")
+
 def fileChecksum(path, checksum_func=hashlib.sha1):
   '''Returns a hash for the file located at the given path.
 
@@ -34,6 +55,62 @@ def fileChecksum(path, checksum_func=hashlib.sha1):
       m.update(d)
     return m.hexdigest()
 
+def fileChecksums(path, checksum_funcs):
+  '''Returns the hashes of the file located at the given path for several checksum functions,
+  reading the file only once.
+
+    path - The path to the file
+    checksum_funcs - list of checksum functions to call.  The hashes are returned in the same order.
+  '''
+  if None == path:
+    raise IOError("fileChecksums requires a path to be specified")
+  with open(path, 'rb') as fobj:
+    ms = [func() for func in checksum_funcs]
+    chunksize = 128 * max(m.block_size for m in ms)
+    while True:
+      d = fobj.read(chunksize)
+      if not d:
+        break
+      for m in ms:
+        m.update(d)
+    return [m.hexdigest() for m in ms]
+
+def sampleChecksum(path, size, sampleSize, checksum_func=hashlib.sha1):
+  '''Returns a hash of the first and last sampleSize bytes of the file located at the given path,
+  and whether that covered the whole file (in which case it is the same as fileChecksum).
+
+    path - The path to the file
+    size - The size of the file
+    sampleSize - The number of bytes to read from each end
+    checksum_func - the checksum function to call.  Defaults to hashlib.sha1.
+  '''
+  if None == path:
+    raise IOError("sampleChecksum requires a path to be specified")
+  m = checksum_func()
+  with open(path, 'rb') as fobj:
+    if size <= 2 * sampleSize:
+      m.update(fobj.read())
+      return (m.hexdigest(), True)
+    m.update(fobj.read(sampleSize))
+    fobj.seek(size - sampleSize)
+    m.update(fobj.read(sampleSize))
+  return (m.hexdigest(), False)
+
+def hashConstructor(name):
+  """Returns a no argument constructor for the named hashlib algorithm (e.g. md5, sha256 or, where
+  hashlib has them, blake2b and blake2s).  Raises ValueError if hashlib doesn't provide it."""
+  if not re.match("^[A-Za-z0-9_]+$", name):
+    raise ValueError("Invalid checksum algorithm name %s" % name)
+  try:
+    hashlib.new(name)
+  except ValueError:
+    raise ValueError("Unsupported checksum algorithm %s" % name)
+  # the named constructors are faster than hashlib.new
+  func = getattr(hashlib, name, None)
+  if func is None:
+    func = lambda: hashlib.new(name)
+  return func
+
 def safeMakedirs(path):
   """Checks the parent of the path (via dirname) and makes sure it exists by calling os.makedirs.
   Returns the parent directory name."""
@@ -51,6 +128,27 @@ def safeUnlink(path):
   if os.path.exists(path):
     os.unlink(path)
 
+def removeStaleSocket(path):
+  """Removes the Unix socket at path if nothing is listening on it, so that a server can bind the
+  path again after an unclean exit.  Raises socket.error (EADDRINUSE) if a server still answers on
+  it; anything at path that isn't a socket is left for bind to complain about."""
+  try:
+    if not S_ISSOCK(os.lstat(path).st_mode):
+      return
+  except OSError:
+    return
+  probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    probe.connect(path)
+  except socket.error as einst:
+    if einst.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+      raise
+    os.remove(path)
+  else:
+    raise socket.error(errno.EADDRINUSE, "%s is in use by another server" % path)
+  finally:
+    probe.close()
+
 def dstWithSubdirectory(src, dstdir):
   """Returns a destination filename that includes the subdirectory structure that is not common
   to both src and dstdir.  This can be used to determine where to move a file including
@@ -131,34 +229,156 @@ def isLinkAsNum(path):
     return 1
   return 0
 
+def isBusy(einst):
+  """Returns true if einst is the error SQLite gives when another connection holds a lock."""
+  return isinstance(einst, sqlite.OperationalError) and ("locked" in str(einst) or
+                                                         "busy" in str(einst))
+
+def retryBusy(func, *args):
+  """Calls func with args, retrying with jittered exponential backoff for up to BUSY_TIMEOUT
+  seconds while it fails because the database is locked.  The time spent waiting is recorded in
+  STATS as sqlite.lockWait, and each failed attempt counted as sqlite.busy."""
+  start = None
+  delay = BUSY_START
+  while True:
+    try:
+      result = func(*args)
+    except sqlite.OperationalError as einst:
+      now = time.time()
+      if start is None:
+        start = now
+      if not isBusy(einst) or now - start >= BUSY_TIMEOUT:
+        STATS.record("sqlite.lockWait", now - start, True)
+        raise
+      STATS.count("sqlite.busy")
+      time.sleep(random.uniform(delay / 2, delay))
+      delay = min(delay * 2, BUSY_MAX)
+      continue
+    if start is not None:
+      STATS.record("sqlite.lockWait", time.time() - start)
+    return result
+
+class RetryingCursor(object):
+  """Wraps a cursor so that statements are retried with retryBusy while the database is locked.
+  pysqlite only begins a transaction (with BEGIN IMMEDIATE) before the first statement that
+  writes, so selects before it run outside the transaction and may be out of date by the time it
+  starts.  Anything that reads what it is about to write must execute "begin immediate;" first,
+  which takes the write lock before anything is read.  Either way the lock is taken by the first
+  statement of the transaction, and retrying that statement is always safe.  Later statements of
+  the transaction are not retried: the lock is already held (and in WAL mode readers never wait),
+  so a busy error there is passed on."""
+  def __init__(self, cursor):
+    self.cursor = cursor
+    self.writing = False
+
+  def execute(self, sql, *args):
+    if self.writing:
+      return self.cursor.execute(sql, *args)
+    result = retryBusy(self.cursor.execute, sql, *args)
+    self.writing = sql.lstrip()[:7].lower().startswith(WRITE_STATEMENTS)
+    return result
+
+  def executemany(self, sql, *args):
+    if self.writing:
+      return self.cursor.executemany(sql, *args)
+    result = retryBusy(self.cursor.executemany, sql, *args)
+    self.writing = sql.lstrip()[:7].lower().startswith(WRITE_STATEMENTS)
+    return result
+
+  def commit(self):
+    """Commits the transaction so far, so that a long job can write in several transactions on one
+    connection (keeping its page cache); the next write statement takes the lock again."""
+    start = time.time()
+    retryBusy(self.cursor.connection.commit)
+    STATS.record("sqlite.commit", time.time() - start)
+    self.writing = False
+
+  def __iter__(self):
+    return iter(self.cursor)
+
+  def __getattr__(self, name):
+    return getattr(self.cursor, name)
+
 @contextmanager
 def sqliteConn(database):
   """Opens an SQLite connection to the given database file and provides a cursor that can be used
 for operations on that SQLite connection.  The connection and cursor will always be closed, any
 exceptions trapped at this level will be reraised, and the connection will be committed if the SQL
-op succeeds or rolled back if it does not.  Can be used with the Python 'with' keyword."""
-  with sqlite.connect(database, timeout=30.0) as connection:
+op succeeds or rolled back if it does not.  Can be used with the Python 'with' keyword.  Statements
+and the commit are retried while another connection holds the database locked (see retryBusy).
+Reads are only part of the write transaction if they follow "begin immediate;" (see
+RetryingCursor)."""
+  with sqlite.connect(database, timeout=0, isolation_level="IMMEDIATE") as connection:
     cursor = None
     try:
       # return the cursor
-      cursor = connection.cursor()
+      cursor = RetryingCursor(connection.cursor())
       yield cursor
     except:
       if connection != None:
         connection.rollback()
       raise
     else:
-      connection.commit()
+      start = time.time()
+      retryBusy(connection.commit)
+      STATS.record("sqlite.commit", time.time() - start)
     finally:
       if cursor != None:
         cursor.close()
 
-# Wraps a code block so that if an exception occurs, it is logged
+class LRUCache:
+  """A thread safe mapping that holds at most maxsize entries, dropping the least recently used
+  entry to make room for a new one."""
+  def __init__(self, maxsize):
+    self.maxsize = maxsize
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, key, default=None):
+    with self.lock:
+      if not key in self.entries:
+        return default
+      # move the entry to the most recently used end
+      value = self.entries.pop(key)
+      self.entries[key] = value
+      return value
+
+  def put(self, key, value):
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = value
+      while len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+
+  def discard(self, key):
+    with self.lock:
+      self.entries.pop(key, None)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def items(self):
+    """Returns a list of the (key, value) pairs held, least recently used first."""
+    with self.lock:
+      return self.entries.items()
+
+  def __len__(self):
+    return len(self.entries)
+
+# Wraps a code block so that if an exception occurs, it is logged.  The block is also timed and
+# recorded in sha1stats.STATS under funcName; the block may call addBytes on the object bound by
+# 'as' to account for the bytes it moved.
 class ewrap:
   def __init__(self, funcName):
     self.funcName = funcName
+    self.nbytes = 0
   def __enter__(self):
-    return self.funcName
+    self.start = time.time()
+    return self
+  def addBytes(self, nbytes):
+    self.nbytes += nbytes
   def __exit__(self, type, value, trace):
+    STATS.record(self.funcName, time.time() - self.start, None != value, self.nbytes)
     if None != value:
       logging.error("!! Exception in %s: %s" % (self.funcName, value))
@@ -0,0 +1,115 @@
+# Content defined chunking, for finding data shared between files that aren't identical
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import binascii
+import hashlib
+import zlib
+
+# Chunk size limits in bytes.  Boundaries fall on average about AVG_CHUNK bytes past MIN_CHUNK,
+# for text and binary data alike.
+MIN_CHUNK = 2048
+AVG_CHUNK = 8192
+MAX_CHUNK = 65536
+
+# Bytes read from the file at a time
+READ_SIZE = 1048576
+
+# A boundary can fall after any byte.  Every position where the XOR of TABLE values of the WINDOW
+# bytes ending there is zero (one in 256 on random data) is a candidate, and a candidate is a
+# boundary when the CRC32 of the same WINDOW bytes also has all the bits of the boundary mask
+# clear.  Both depend only on the data near the boundary, so boundaries move with the content
+# around them when data is inserted or removed before them.  WINDOW is odd, and no TABLE value is
+# zero, so runs of a single byte value never have candidates and are cut every MAX_CHUNK bytes.
+CANDIDATE_SPACING = 256  # on random data
+WINDOW = 33
+TABLE = "".join([c for c in hashlib.sha1(chr(i)).digest() if c != "\0"][0] for i in xrange(256))
+
+def boundaryMask(avgSize):
+  """Returns the mask of CRC bits that must all be clear at a boundary, giving one boundary about
+  every avgSize bytes of random data."""
+  bits = max((avgSize // CANDIDATE_SPACING).bit_length() - 1, 0)
+  return (1 << bits) - 1
+
+def windowMarks(data, context=""):
+  """Returns a string as long as data holding, for each of its bytes, the XOR of the TABLE values of
+  the WINDOW bytes ending with it, so that candidates are the zero bytes.  context holds the bytes
+  before data, of which the last WINDOW - 1 are used."""
+  if not data:
+    return ""
+  context = str(context[-(WINDOW - 1):])
+  # one byte of the integer per position.  Shifting it right by 8 * n bits moves every value n
+  # positions on, so the window sums for all the positions come from log2(WINDOW) shifts and XORs
+  # run in C rather than a Python loop over every byte.
+  part = int(binascii.hexlify((context + str(data)).translate(TABLE)), 16)
+  total = 0
+  shift = 0
+  span = 1
+  window = WINDOW
+  while window:
+    if window & 1:
+      total ^= part >> (8 * shift)
+      shift += span
+    window >>= 1
+    if window:
+      part ^= part >> (8 * span)
+      span *= 2
+  return binascii.unhexlify("%0*x" % (2 * (len(context) + len(data)), total))[len(context):]
+
+def cutPoint(buf, marks, pos, end, minSize, maxSize, mask):
+  """Returns the length of the chunk starting at buf[pos], where buf[pos:end] is all the data that
+  is left (or at least maxSize bytes of it) and marks is windowMarks for buf."""
+  available = end - pos
+  if available <= minSize:
+    return available
+  stop = pos + min(available, maxSize)
+  crc32 = zlib.crc32
+  i = marks.find("\0", pos + minSize - 1, stop)
+  while i >= 0:
+    if not (crc32(buffer(buf, i + 1 - WINDOW, WINDOW)) & mask):
+      return i + 1 - pos
+    i = marks.find("\0", i + 1, stop)
+  return stop - pos
+
+def chunkFile(path, checksum_func=hashlib.sha1, minSize=MIN_CHUNK, avgSize=AVG_CHUNK,
+              maxSize=MAX_CHUNK, extra=()):
+  """Splits the file at path into content defined chunks in a single read.  Returns the hex
+  checksum of the whole file (the same as fileChecksum) and a list of (offset, size, hex digest)
+  for the chunks.  Any hash objects in extra are updated with the whole file as well."""
+  mask = boundaryMask(avgSize)
+  whole = checksum_func()
+  chunks = []
+  buf = bytearray()
+  marks = bytearray()
+  pos = 0
+  offset = 0
+  eof = False
+  with open(path, 'rb') as fobj:
+    while True:
+      if not eof and len(buf) - pos < maxSize:
+        # drop what has been chunked already, then top the buffer up
+        del buf[:pos]
+        del marks[:pos]
+        pos = 0
+        d = fobj.read(READ_SIZE)
+        if d:
+          whole.update(d)
+          for m in extra:
+            m.update(d)
+          marks.extend(windowMarks(d, buf))
+          buf.extend(d)
+          continue
+        eof = True
+      if pos >= len(buf):
+        break
+      size = cutPoint(buf, marks, pos, len(buf), minSize, maxSize, mask)
+      m = checksum_func()
+      m.update(buffer(buf, pos, size))
+      chunks.append((offset, size, m.hexdigest()))
+      pos += size
+      offset += size
+  return (whole.hexdigest(), chunks)
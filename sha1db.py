@@ -8,30 +8,345 @@
 #
 
 import os
+import sys
 import logging
 import hashlib
-from fusesha1util import fileChecksum, moveFile, sqliteConn, symlinkFile
+import itertools
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from stat import S_ISLNK, S_ISREG
+from fusesha1util import fileChecksums, hashConstructor, moveFile, sampleChecksum, sqliteConn
+from fusesha1util import symlinkFile
 from fusesha1util import isLinkAsNum, linkFile, dstWithSubdirectory
+from sha1chunk import chunkFile
+from sha1diff import Differ
+from sha1ignore import IgnoreRules
+from sha1merkle import blockCount, rangeBlocks, hashBlocks, merkleRoot
+from sha1stats import STATS, timed
+from sha1verify import Verifier
 
 from optparse import OptionParser
 
 LOG_FILENAME = "LOG"
 logging.basicConfig(filename=LOG_FILENAME,level=logging.INFO,)
-CHECKSUM_UPDATE = "insert or replace into files(path, chksum, symlink) values(?, ?, ?);"
+# path, chksum, symlink, size, mtime.  Nothing is written if the row is already just that, so
+# rehashing an unchanged file (as every release of it does) logs no change and queues no tree delta
+CHECKSUM_UPDATE = """insert or replace into files(path, chksum, symlink, size, mtime)
+select ?1, ?2, ?3, ?4, ?5 where not exists (select 1 from files
+where path = ?1 and chksum = ?2 and symlink = ?3 and size is ?4 and mtime is ?5);"""
 LINK_UPDATE = "update files set link = ? where path = ?;"
+# size, mtime, path
+STAT_UPDATE = "update files set size = ?, mtime = ? where path = ?;"
 # old path, new path, old path with %
-PATH_UPDATE = "update files set path = replace(path, ?, ?) where path like ?;"
+PATH_UPDATE = "update %s set path = replace(path, ?, ?) where path like ?;"
 REMOVE_ROW = "delete from files where path = ?;"
+# path, size, mtime
+DIRTY_UPDATE = "insert or replace into dirty(path, size, mtime) values(?, ?, ?);"
+REMOVE_DIRTY = "delete from dirty where path = ?;"
+# path, blocksize, root, size, mtime
+MERKLE_UPDATE = """insert or replace into merkle(path, blocksize, root, size, mtime)
+values(?, ?, ?, ?, ?);"""
+# path, idx, digest
+BLOCK_UPDATE = "insert or replace into blocks(path, idx, digest) values(?, ?, ?);"
+# path, idx, digest, offset, size
+FILE_CHUNK_INSERT = """insert into file_chunks(path, idx, digest, offset, size)
+values(?, ?, ?, ?, ?);"""
+
+# Columns added to the files table after it was first released, with their definitions.  Any that
+# are missing are added whenever a database is opened, so older databases keep working.
+# size and mtime are the stat of the file when its checksum was calculated; a file whose current
+# stat differs may have changed since.
+FILES_COLUMNS = [("link", "boolean default 0"),
+                 ("size", "integer"),
+                 ("mtime", "real")]
+
+# Columns added to the dirty table after it was first released, added as FILES_COLUMNS are.
+# attempts counts the times hashing the file has failed since it was marked.
+DIRTY_COLUMNS = [("attempts", "integer not null default 0")]
+
+# Times hashDirty tries to hash a file that can't be read before it drops the dirty mark
+DIRTY_ATTEMPTS = 5
+
+# Trigger statements queueing a file (path, chksum and size being its columns, if guard holds)
+# leaving its directories, and the other file with its checksum no longer being a duplicate if it
+# was the last copy.  The other file is looked for (cross joined, so in that order) only when the
+# digests row says there is exactly one, as a checksum many files share would take a scan.
+TREE_REMOVE = """insert into tree_deltas(path, chksum, size, sign, dups)
+select %(path)s, %(chksum)s, %(size)s, -1, -(copies > 1) from digests
+where chksum = %(chksum)s and %(guard)s;
+update digests set copies = copies - 1 where chksum = %(chksum)s and %(guard)s;
+insert into tree_deltas(path, chksum, size, sign, dups)
+select path, files.chksum, size, 0, -1 from digests cross join files using (chksum)
+where chksum = %(chksum)s and copies = 1 and symlink = 0 and path != %(path)s and %(guard)s;
+delete from digests where chksum = %(chksum)s and copies <= 0 and %(guard)s;"""
+
+# and joining its directories, and the other file with its checksum becoming a duplicate if it
+# was the only copy.  (Not "insert or ignore": the insert or replace that fires the trigger would
+# override it.)
+TREE_ADD = """insert into digests(chksum, copies) select %(chksum)s, 0
+where %(guard)s and not exists (select 1 from digests where chksum = %(chksum)s);
+update digests set copies = copies + 1 where chksum = %(chksum)s and %(guard)s;
+insert into tree_deltas(path, chksum, size, sign, dups)
+select %(path)s, %(chksum)s, %(size)s, 1, copies > 1 from digests
+where chksum = %(chksum)s and %(guard)s;
+insert into tree_deltas(path, chksum, size, sign, dups)
+select path, files.chksum, size, 0, 1 from digests cross join files using (chksum)
+where chksum = %(chksum)s and copies = 2 and symlink = 0 and path != %(path)s and %(guard)s;"""
+
+# Tables (and indexes) added after the first release.  They are created whenever a database is
+# opened, so older databases keep working.
+# dirty holds files that have changed but haven't been hashed yet (see markDirty), with the stat
+# they had when they were marked.
+TABLES = ["""create table if not exists dirty(
+path varchar not null primary key,
+size integer,
+mtime real,
+attempts integer not null default 0);""",
+# merkle holds the root of the tree of block digests of a file (see updateBlocks), with the
+# block size and the stat of the file it was calculated for; blocks holds the block digests
+"""create table if not exists merkle(
+path varchar not null primary key,
+blocksize integer not null,
+root varchar not null,
+size integer,
+mtime real);""",
+"""create table if not exists blocks(
+path varchar not null,
+idx integer not null,
+digest varchar not null,
+primary key(path, idx));""",
+# chunks holds every distinct content defined chunk (see sha1chunk) with the number of times
+# file_chunks refers to it; file_chunks holds the chunks of each file in order
+"""create table if not exists chunks(
+digest varchar not null primary key,
+size integer not null,
+refs integer not null);""",
+"""create table if not exists file_chunks(
+path varchar not null,
+idx integer not null,
+digest varchar not null,
+offset integer not null,
+size integer not null,
+primary key(path, idx));""",
+"create index if not exists file_chunks_digest_idx on file_chunks(digest);",
+# algorithms holds the checksum algorithms calculated along with the one in versioning, each
+# stored in its own ALGORITHM_COLUMN of files.  complete is set once every file has a digest.
+"""create table if not exists algorithms(
+name varchar not null primary key,
+complete boolean default 0);""",
+# samples holds the checksum of the first and last SAMPLE_SIZE bytes of files, with the stat they
+# were taken for, for findDuplicates
+"""create table if not exists samples(
+path varchar not null primary key,
+size integer,
+mtime real,
+sample varchar not null);""",
+
+# checkpoints holds the progress of long running jobs (such as sha1verify) so they can resume
+"""create table if not exists checkpoints(
+name varchar not null primary key,
+value varchar);""",
+# changes logs every change to files, as triggers on it record them whatever makes them: update
+# (a new checksum), rename (path was oldPath), remove, link (hard linked to a duplicate by the
+# mount) and symlink (replaced by a symlink by --dedup).  seq is never reused, and time is in
+# seconds since the epoch.
+"""create table if not exists changes(
+seq integer primary key autoincrement,
+op varchar not null,
+path varchar not null,
+oldPath varchar,
+chksum varchar,
+time real not null default ((julianday('now') - 2440587.5) * 86400.0));""",
+"""create trigger if not exists changes_insert after insert on files begin
+insert into changes(op, path, chksum) values('update', new.path, new.chksum); end;""",
+"""create trigger if not exists changes_delete after delete on files begin
+insert into changes(op, path) values('remove', old.path); end;""",
+"""create trigger if not exists changes_path after update of path on files
+when new.path != old.path begin
+insert into changes(op, path, oldPath, chksum) values('rename', new.path, old.path, new.chksum); end;""",
+"""create trigger if not exists changes_chksum after update of chksum on files
+when new.chksum != old.chksum begin
+insert into changes(op, path, chksum) values('update', new.path, new.chksum); end;""",
+"""create trigger if not exists changes_link after update of link on files when new.link = 1 begin
+insert into changes(op, path, chksum) values('link', new.path, new.chksum); end;""",
+"""create trigger if not exists changes_symlink after update of symlink on files
+when new.symlink = 1 and old.symlink = 0 begin
+insert into changes(op, path, chksum) values('symlink', new.path, new.chksum); end;""",
+# dirs holds, for every directory with files below it, its digest (see treeDigest), its parent and
+# the number of files and directories directly in it, and the number of files, bytes, duplicated
+# files (whose checksum another file has) and bytes of those below it.  digests holds the number of
+# files with each checksum.  Triggers on files queue every file (but not symlink) a directory gains
+# (sign 1) or loses (sign -1), and every one that starts (dups 1) or stops (dups -1) being a
+# duplicate, in tree_deltas, which updateTrees folds into the directories above them.
+"""create table if not exists dirs(
+path varchar not null primary key,
+parent varchar,
+digest varchar not null,
+entries integer not null,
+files integer not null,
+bytes integer not null,
+dupFiles integer not null,
+dupBytes integer not null);""",
+"create index if not exists dirs_parent_idx on dirs(parent);",
+"create index if not exists dirs_dup_idx on dirs(dupBytes);",
+"""create table if not exists digests(
+chksum varchar not null primary key,
+copies integer not null) without rowid;""",
+"""create table if not exists tree_deltas(
+id integer primary key,
+path varchar not null,
+chksum varchar not null,
+size integer,
+sign integer not null,
+dups integer not null);""",
+# tree_replace removes what an insert or replace overwrites, as the replace doesn't fire
+# tree_delete
+"""create trigger if not exists tree_replace before insert on files
+when exists (select 1 from files where path = new.path and symlink = 0) begin %s end;""" % (TREE_REMOVE % {
+  "path": "new.path", "chksum": "(select chksum from files where path = new.path and symlink = 0)",
+  "size": "(select size from files where path = new.path)", "guard": "1"}),
+"create trigger if not exists tree_insert after insert on files begin %s end;" % (TREE_ADD % {
+  "path": "new.path", "chksum": "new.chksum", "size": "new.size", "guard": "new.symlink = 0"}),
+"create trigger if not exists tree_delete after delete on files begin %s end;" % (TREE_REMOVE % {
+  "path": "old.path", "chksum": "old.chksum", "size": "old.size", "guard": "old.symlink = 0"}),
+"""create trigger if not exists tree_update after update of chksum, symlink on files
+when new.chksum != old.chksum or new.symlink != old.symlink begin %s %s end;""" % (TREE_REMOVE % {
+  "path": "old.path", "chksum": "old.chksum", "size": "old.size", "guard": "old.symlink = 0"},
+  TREE_ADD % {"path": "new.path", "chksum": "new.chksum", "size": "new.size",
+              "guard": "new.symlink = 0"}),
+# a file moved or resized keeps its checksum, and so whether it is a duplicate
+"""create trigger if not exists tree_move after update of path, size on files
+when new.chksum = old.chksum and new.symlink = old.symlink and new.symlink = 0 and
+(new.path != old.path or new.size is not old.size) begin
+insert into tree_deltas(path, chksum, size, sign, dups)
+select old.path, old.chksum, old.size, -1, -(copies > 1) from digests where chksum = old.chksum;
+insert into tree_deltas(path, chksum, size, sign, dups)
+select new.path, new.chksum, new.size, 1, copies > 1 from digests where chksum = new.chksum;
+end;"""]
+
+# Checkpoint holding the highest change seq removed by pruneChanges; changesSince can't answer
+# for anything before it
+CHANGES_PRUNED = "changes.pruned"
+
+# Selects every path changed after a seq (both paths of a rename) with the seq of its last change,
+# the seq bound twice
+CHANGED_PATHS = """select touched.path, max(touched.seq) as last
+from (select seq, path from changes where seq > ?
+union all select seq, oldPath from changes where seq > ? and oldPath is not null) as touched
+group by touched.path"""
+
+# Queued file changes updateTrees folds into the directory digests per transaction
+TREE_BATCH = 10000
+
+# Directory digests are sums of entry digests modulo this
+TREE_MODULUS = 2 ** 256
+
+# Directories listed by dirReport by default
+REPORT_TOP = 20
+
+def treeEntryDigest(kind, name, digest):
+  """Returns what an entry adds to the digest of its directory, as a number: the SHA256 of its kind
+  ("f" for a file, "d" for a directory), name and digest."""
+  entry = "%s%s\0%s" % (kind, name, digest)
+  if isinstance(entry, unicode):
+    entry = entry.encode("utf-8")
+  return int(hashlib.sha256(entry).hexdigest(), 16)
+
+def treeDepth(path):
+  """Returns the number of directories path is below, 0 for /."""
+  return 0 if path == "/" else path.count("/")
+
+# Bytes read from each end of a file for its sample checksum
+SAMPLE_SIZE = 65536
+
+# Column of files holding the digests of an extra algorithm
+ALGORITHM_COLUMN = "dg_%s"
+
+# Tables keyed by path, kept in step by updatePath, removeChecksum and vacuum
+PATH_TABLES = ["files", "dirty", "merkle", "blocks", "file_chunks", "samples"]
+
+# Files or rows written per transaction by the operations that work through many of them.  Files
+# are read and hashed with no transaction open, so that other processes sharing the database (such
+# as a mount) only ever wait for the write lock for as long as it takes to write one batch.
+BATCH_SIZE = 100
+
+def batches(items, size=BATCH_SIZE):
+  """Yields the list items in consecutive slices of up to size items."""
+  for start in xrange(0, len(items), size):
+    yield items[start:start + size]
+
+# Keys bound to one statement by the batched lookups; SQLite allows at most 999 parameters
+LOOKUP_BATCH = 500
+
+# Rows written per transaction by importManifest (and read at a time by exportManifest), and the
+# page cache in KB the import keeps the path index in
+MANIFEST_BATCH = 100000
+IMPORT_CACHE_KB = 65536
+
+# Manifest formats: the text sha1sum (md5sum, ...) prints and checks, or a JSON object per line
+MANIFEST_FORMATS = ["sum", "json"]
+
+# A line of sha1sum output: a backslash if the name is escaped, the digest, then the name after a
+# space and either another space (text mode) or * (binary mode)
+SUM_LINE = re.compile(r"^(\\?)([0-9a-fA-F]+) [ *](.*)$")
+HEX_DIGEST = re.compile(r"^[0-9a-f]+$")
+
+def manifestLine(path, chksum, size, mtime, format="sum"):
+  """Returns the manifest line, newline included, for one file in the given format, encoded as
+  UTF-8.  Names with a backslash or newline are escaped as sha1sum escapes them."""
+  if format == "json":
+    return json.dumps({"path": path, "digest": chksum, "size": size, "mtime": mtime},
+                      sort_keys=True) + "\n"
+  if "\\" in path or "\n" in path:
+    path = path.replace("\\", "\\\\").replace("\n", "\\n")
+    return (u"\\%s  %s\n" % (chksum, path)).encode("utf-8")
+  return (u"%s  %s\n" % (chksum, path)).encode("utf-8")
+
+def parseManifestLine(line, format="sum"):
+  """Returns the (path, digest, size, mtime) in a manifest line, size and mtime being None if the
+  line doesn't give them, or None for a blank line.  Raises ValueError for anything else."""
+  line = line.rstrip("\r\n")
+  if len(line.strip()) <= 0:
+    return None
+  if format == "json":
+    entry = json.loads(line)
+    if not isinstance(entry, dict) or not isinstance(entry.get("path"), basestring) or \
+        not isinstance(entry.get("digest"), basestring):
+      raise ValueError("not an object with a path and digest")
+    digest = str(entry["digest"]).lower()
+    if HEX_DIGEST.match(digest) is None:
+      raise ValueError("%s is not a hex digest" % digest)
+    return (entry["path"].encode("utf-8"), digest, entry.get("size"), entry.get("mtime"))
+  match = SUM_LINE.match(line)
+  if match is None:
+    raise ValueError("not a checksum line")
+  path = match.group(3)
+  if match.group(1):
+    path = re.sub(r"\\(.)", lambda m: "\n" if m.group(1) == "n" else m.group(1), path)
+  return (path, match.group(2).lower(), None, None)
 
 class Sha1DB:
-  # Creates a new Sha1DB.  If the database given does not exist, it will be created.
-  def __init__(self, database, useMd5=False):
+  # Creates a new Sha1DB.  If the database given does not exist, it will be created, using the
+  # hashlib algorithm named by algorithm (or MD5 if useMd5 is true, and SHA1 otherwise).  If
+  # chunking is true, files are also split into content defined chunks whenever they are hashed.
+  # events may be set to an EventPublisher (see sha1events.py), which is then told of every
+  # checksum update, dirty mark, removal and rename once it is committed.  While it is set, writes
+  # that publish take turns from their transaction to their events, so that events are published
+  # in the order their changes were committed.
+  def __init__(self, database, useMd5=False, chunking=False, algorithm=None):
     self.database = database
+    self.chunking = chunking
+    self.events = None
+    self.publishLock = threading.RLock()
 
     dbExists = os.path.exists(database)
 
-    usingMd5 = useMd5
+    checksumName = algorithm or ("md5" if useMd5 else "sha1")
     if not dbExists:
+      hashConstructor(checksumName) # fail before creating anything
       logging.info("Sha1DB initialized with connection string %s" % database)
       self._execSql("""create table if not exists files(
 path varchar not null primary key,
@@ -39,25 +354,33 @@ chksum varchar not null,
 symlink boolean default 0);""")
       self._execSql("create index csum_idx on files(chksum);")
       self._execSql("create table if not exists versioning(chksum_type varchar not null)");
-      self._execSql("insert into versioning(chksum_type) values(?)", ("md5" if useMd5 else "sha1", ));
+      self._execSql("insert into versioning(chksum_type) values(?)", (checksumName, ));
     else:
       # pull the checksum type out of the database
       with sqliteConn(self.database) as cursor:
         cursor.execute("select chksum_type from versioning")
         for row in cursor:
           (chksum_type, ) = row
-          usingMd5 = "md5" == chksum_type
+          checksumName = chksum_type
 
-    self.checksum = hashlib.md5 if usingMd5 else hashlib.sha1
+    self._enableWal()
+    self._upgradeSchema()
+    self.checksum = hashConstructor(checksumName)
+    self.checksumName = checksumName
+    self._loadAlgorithms()
 
+  @timed("db.dedup")
   def dedup(self, dupdir, doSymlink):
     """ Moves duplicate entries (based on checksum) into the dupdir.  Uses the entry's path to
     reconstruct a subdirectory hierarchy in dupdir.  This will remove any common prefixes
     between dupdir and the file path itself so as to make a useful subdirectory structure.
+    The first file of each group (one that isn't a hard link made at hash time, if there is one,
+    else the first by path) is the canonical file, and stays where it is.
     If doSymlink is true, then the original paths of the files that were moved will be symlinked
     back to the canonical file; in addition, it will keep the file entry in the database rather than
     removing it."""
     logging.info("De-duping database")
+    self.hashDirty()
 
     if os.path.exists(dupdir) and not len(os.listdir(dupdir)) <= 0:
       raise Exception("%s is not empty; refusing to move files" % dupdir)
@@ -65,32 +388,43 @@ symlink boolean default 0);""")
     try:
       pathmap = {} # store duplicate paths keyed by file checksum
 
+      # candidates are matched on the indexed checksum, then confirmed with the digests of any
+      # extra algorithms that every file has (as the database says now)
+      self._loadAlgorithms()
+      confirm = self._algorithmColumns(True)
       with sqliteConn(self.database) as cursor:
-        cursor.execute("""select chksum, path, link from files
+        cursor.execute("""select chksum, path, link%s from files
 where chksum in(
 select chksum from files where symlink = 0 group by chksum having count(chksum) > 1)
 and symlink = 0
-and link = 1
-order by chksum, link;""")
-        for row in cursor:
-          (chksum, path, islink) = row
+order by chksum, link, path;""" % "".join(", " + column for column in confirm))
+        for row in cursor.fetchall():
+          (chksum, path, islink) = row[:3]
+          chksum = tuple([chksum] + list(row[3:]))
           if not chksum in pathmap:
             # ensure existence of list for checksum
             pathmap[chksum] = []
           paths = pathmap[chksum]
           paths.append(path)
 
-        for chksum, paths in pathmap.iteritems():
-          # the query above will result in single rows for symlinked files, so fix that here
-          # rather than mucking about with temp tables
-          paths = filter(lambda path: not os.path.islink(path), paths)
+      for chksum, paths in pathmap.iteritems():
+        # the query above will result in single rows for symlinked files, so fix that here
+        # rather than mucking about with temp tables
+        paths = filter(lambda path: not os.path.islink(path), paths)
 
-          # we'll have at least two elements due to the inner part of the query above
-          for path in paths:
-            dst = dstWithSubdirectory(path, dupdir)
-            moveFile(path, dst, (not doSymlink)) # don't rm empty dirs if we are symlinking
+        # the canonical file stays; a group may be down to one once the symlinks and the files whose
+        # extra digests differ are left out
+        if len(paths) < 2:
+          continue
+        canonicalPath = paths[0]
+        for path in paths[1:]:
+          dst = dstWithSubdirectory(path, dupdir)
+          moveFile(path, dst, (not doSymlink)) # don't rm empty dirs if we are symlinking
+          # a transaction per file, so that nothing waits on the database while files are moved
+          with sqliteConn(self.database) as cursor:
+            cursor.execute("begin immediate;")
             if not doSymlink:
-              cursor.execute(REMOVE_ROW, (path, ))
+              self._removePath(path, cursor)
             else:
               cursor.execute("update files set symlink = 1 where path = ?;", (path, ))
               symlinkFile(canonicalPath, path)
@@ -99,79 +433,960 @@ order by chksum, link;""")
       logging.error("Unable to de-dup database: %s" % einst)
       raise
 
-  def vacuum(self):
-    """ Check the paths in the database, removing entries for which no actual file exists """
+  @timed("db.vacuum")
+  def vacuum(self, ignore=None):
+    """ Check the paths in the database, removing entries for which no actual file exists, and for
+    files the IgnoreRules ignore says should not be hashed """
     logging.info("Vacuuming database")
 
     try:
-      paths = [] # store nonexistent paths
-      with sqliteConn(self.database) as cursor:
-        cursor.execute("select path from files;")
-        for row in cursor:
-          (path, ) = row
+      paths = set() # store nonexistent and ignored paths
+      for table in PATH_TABLES:
+        with sqliteConn(self.database) as cursor:
+          cursor.execute("select distinct path from %s;" % table)
+          rows = cursor.fetchall()
+        for (path, ) in rows:
+          if path in paths:
+            continue
           if not os.path.exists(path):
-            paths.append(path)
+            paths.add(path)
+          elif self._ignored(path, ignore):
+            STATS.count("ignore.vacuum")
+            paths.add(path)
 
-        for path in paths:
-          logging.info("Removing entry for %s; file does not exist" % path)
-          cursor.execute("delete from files where path = ?;", (path, ))
-        logging.info("Vacuum complete")
+      for batch in batches(sorted(paths)):
+        with sqliteConn(self.database) as cursor:
+          cursor.execute("begin immediate;")
+          for path in batch:
+            logging.info("Removing entry for %s; file does not exist or is ignored" % path)
+            self._removePath(path, cursor)
+      logging.info("Vacuum complete")
     except Exception as einst:
       logging.error("Unable to vacuum database: %s" % einst)
       raise
 
+  @timed("db.updateChecksum")
   def updateChecksum(self, path):
     """ Update/insert checksums for a given path.  If the path points at a symlink, the entry will
     be marked as being a symlink."""
     try:
-      with sqliteConn(self.database) as cursor:
-        self._updateChecksumAndLink(path, cursor)
+      hashed = self.hashPath(path)
+      if hashed is None:
+        # this happens for broken symlinks
+        logging.error("Path %s does not exist; skipping update" % path)
+        return
+      # the file is read before the transaction starts, and the write lock taken before the chunks
+      # and duplicates are read
+      with self._publishing():
+        with sqliteConn(self.database) as cursor:
+          cursor.execute("begin immediate;")
+          self._storeHashed(hashed, cursor)
+        self._publishHashed([hashed])
     except Exception as einst:
       logging.error("Unable to update checksum for %s: %s" % (path, einst))
       raise
 
+  @timed("db.updatePath")
   def updatePath(self, old, new):
     """Updates the path in the database for a given file.  This is meant to be used by functions
     like rename, which may use directories rather than individual files for renames, thus old and
     new may be directories."""
+    with self._publishing():
+      try:
+        with sqliteConn(self.database) as cursor:
+          for table in PATH_TABLES:
+            cursor.execute(PATH_UPDATE % table, (old, new, old + '%'))
+      except Exception as einst:
+        logging.error("Unable to update path for %s to %s: %s" % (old, new, einst))
+        raise
+      if self.events is not None:
+        self.events.publish("rename", new, oldPath=old)
+
+  @timed("db.updateAllChecksums")
+  def updateAllChecksums(self, fsroot, ignore=None):
+    logging.info("Updating all checksums under %s" % fsroot)
+    """ Update/insert checksums for all of the files located under fsroot, except those the
+    IgnoreRules ignore says should not be hashed.  This is meant as an optimization for rescanning
+    the database, as it stores the checksums in batches with storeHashed."""
+    hashed = []
     try:
-      with sqliteConn(self.database) as cursor:
-        cursor.execute(PATH_UPDATE, (old, new, old + '%'))
+      for result in self.walkHashed(fsroot, ignore):
+        hashed.append(result)
+        if len(hashed) >= BATCH_SIZE:
+          self.storeHashed(hashed)
+          hashed = []
+      self.storeHashed(hashed)
     except Exception as einst:
-      logging.error("Unable to update path for %s to %s: %s" % (old, new, einst))
+      logging.error("Unable to update checksums under %s: %s" % (fsroot, einst))
       raise
+    logging.info("Done updating all checksums")
 
-  def updateAllChecksums(self, fsroot):
-    logging.info("Updating all checksums under %s" % fsroot)
-    """ Update/insert checksums for all of the files located under fsroot.  This is meant as an
-    optimization for rescanning the database, as it uses a single connection and transaction."""
+  def walkHashed(self, fsroot, ignore=None):
+    """Yields the hashPath result for every file under fsroot, except those the IgnoreRules ignore
+    says should not be hashed, without touching the database."""
+    for root, dirs, files in os.walk(fsroot):
+      if ignore is not None:
+        dirs[:] = [name for name in dirs if not ignore.ignoredDir(os.path.join(root, name))]
+      for name in files:
+        path = os.path.join(root, name)
+        if self._ignored(path, ignore):
+          STATS.count("ignore.rescan")
+          continue
+        logging.info("Updating %s" % path)
+        result = self.hashPath(path)
+        if result is None:
+          # this happens for broken symlinks
+          logging.error("Path %s does not exist; skipping update" % path)
+          continue
+        yield result
+
+  def hashPath(self, path):
+    """Hashes the file at path with every algorithm (and chunks it, if chunking) without touching
+    the database.  Returns (path, stat, checksum, extra digests, chunks or None) for storeHashed,
+    or None if the file does not exist."""
+    if not os.path.exists(path):
+      return None
+    # stat before hashing, so that a change made while hashing leaves the entry looking stale
+    st = os.stat(path)
+    funcs = [func for (name, func) in self.algorithms]
+    if self.chunking and not os.path.islink(path):
+      extra = [func() for func in funcs]
+      (chksum, chunks) = chunkFile(path, self.checksum, extra=extra)
+      return (path, st, chksum, [m.hexdigest() for m in extra], chunks)
+    # a single read for the main checksum and all of the extra ones
+    digests = fileChecksums(path, [self.checksum] + funcs)
+    return (path, st, digests[0], digests[1:], None)
+
+  @timed("db.storeHashed")
+  def storeHashed(self, results):
+    """Stores a list of hashPath results in one transaction, as a background scan would while
+    files are changed through the mount.  The database is locked for writing before any file is
+    checked, and a file whose size or mtime is no longer the one it was hashed with (or which has
+    gone) is left alone.  Whatever changed it records the new checksum, either before the check,
+    or after this transaction.  Returns the number of files stored."""
+    stored = []
+    if len(results) <= 0:
+      return 0
+    with self._publishing():
+      with sqliteConn(self.database) as cursor:
+        cursor.execute("begin immediate;")
+        for hashed in results:
+          st = hashed[1]
+          try:
+            now = os.stat(hashed[0])
+          except OSError:
+            continue
+          if now.st_size == st.st_size and now.st_mtime == st.st_mtime and now.st_ino == st.st_ino:
+            self._storeHashed(hashed, cursor)
+            stored.append(hashed)
+      self._publishHashed(stored)
+    return len(stored)
+
+  @timed("db.exportManifest")
+  def exportManifest(self, out, format="sum"):
+    """Writes the checksum of every file (but not symlinks) to the file object out in path order,
+    as lines sha1sum -c (or md5sum -c, and so on) can check, or with format "json" as JSON lines of
+    {"path", "digest", "size", "mtime"}.  Rows are streamed from the database MANIFEST_BATCH at a
+    time rather than loaded.  Returns the number of files written."""
+    count = 0
+    with sqliteConn(self.database) as cursor:
+      cursor.execute("select path, chksum, size, mtime from files where symlink = 0 order by path;")
+      while True:
+        rows = cursor.fetchmany(MANIFEST_BATCH)
+        if len(rows) <= 0:
+          break
+        out.write("".join(manifestLine(path, chksum, size, mtime, format)
+                          for (path, chksum, size, mtime) in rows))
+        count += len(rows)
+    return count
+
+  @timed("db.importManifest")
+  def importManifest(self, lines, format="sum", root=None, trust=False, made=None):
+    """Loads the checksums in the lines of a manifest in the given format (see exportManifest) in
+    place of hashing the files, for paths relative to root (by default the current directory).
+    Unless trust is true every file is stat'ed, though not read: entries for files that are missing,
+    or whose size or mtime differ from the ones the manifest gives, are skipped, and the stat is
+    stored with the rest.  An entry without a size and mtime (as in every sha1sum manifest) can't
+    tell a file changed since the manifest was made, so its stat is only stored if the file was
+    last modified before made (the time the manifest was made, if known); otherwise its size and
+    mtime are left empty, and the checksum isn't taken as fresh until the file is hashed.  With trust the manifest's own size and mtime (if any) are stored
+    without looking at the files.  Rows are written MANIFEST_BATCH to a transaction.  The
+    checksum index is kept up to date as they are, as the duplicate counts kept for the directory
+    totals look files up by checksum.  Returns the number of entries imported and skipped;
+    raises ValueError, after importing the lines before it, at the first bad line."""
+    root = root or os.getcwd()
+    digestLength = self.checksum().digest_size * 2
+    imported = 0
+    skipped = 0
+    try:
+      with sqliteConn(self.database) as cursor:
+        cursor.execute("pragma cache_size = -%d;" % IMPORT_CACHE_KB)
+        batch = []
+        for (number, line) in enumerate(lines):
+          try:
+            entry = parseManifestLine(line, format)
+            if entry is None:
+              continue
+            (path, digest, size, mtime) = entry
+            if len(digest) != digestLength:
+              raise ValueError("%s is not a %s digest" % (digest, self.checksumName))
+          except ValueError as einst:
+            self._importBatch(cursor, batch)
+            raise ValueError("manifest line %d: %s" % (number + 1, einst))
+          if not path.startswith("/") or "/." in path or "//" in path:
+            # normpath is a good part of the cost of a line, and absolute paths rarely need it
+            path = os.path.normpath(os.path.join(root, path))
+          row = self._manifestRow(path, digest, size, mtime, trust, made)
+          if row is None:
+            skipped += 1
+            continue
+          batch.append(row)
+          imported += 1
+          if len(batch) >= MANIFEST_BATCH:
+            self._importBatch(cursor, batch)
+            batch = []
+        self._importBatch(cursor, batch)
+    finally:
+      if imported > 0 and len(self.algorithms) > 0:
+        # the imported files have none of the extra digests
+        self._execSql("update algorithms set complete = 0;")
+        self._loadAlgorithms()
+    return (imported, skipped)
+
+  @timed("db.lookupChecksum")
+  def lookupChecksum(self, path):
+    """Returns the stored (checksum, size, mtime) for path, or None if path has no entry.  size and
+    mtime are None for entries made before they were recorded."""
+    with sqliteConn(self.database) as cursor:
+      cursor.execute("select chksum, size, mtime from files where path = ?;", (path, ))
+      for row in cursor:
+        return row
+    return None
+
+  @timed("db.pathsForChecksum")
+  def pathsForChecksum(self, chksum, under=None, limit=None):
+    """Returns the paths of the (non-symlink) files with the given checksum, in path order.  If under
+    is given only paths below that directory are returned.  Uses csum_idx, so the cost depends on
+    the number of matches rather than the size of the database."""
+    sql = "select path from files where chksum = ? and symlink = 0"
+    args = [chksum]
+    if under is not None:
+      # every path below under sorts between under + "/" and under + "0" ("0" follows "/")
+      sql += " and path > ? and path < ?"
+      args.extend([under + "/", under + "0"])
+    sql += " order by path"
+    if limit is not None:
+      sql += " limit %d" % limit
     with sqliteConn(self.database) as cursor:
+      cursor.execute(sql + ";", args)
+      return [path for (path, ) in cursor]
+
+  @timed("db.lookupChecksums")
+  def lookupChecksums(self, paths, cursor=None):
+    """Returns a dict of the stored checksum of each of paths that has an entry, looking up
+    LOOKUP_BATCH paths per statement.  If cursor is given it is used instead of a new connection,
+    so that a long running caller can keep one connection and its page cache open."""
+    sql = "select path, chksum from files where path in (%s);"
+    return dict(self._selectIn(sql, paths, cursor))
+
+  @timed("db.lookupPaths")
+  def lookupPaths(self, chksums, limit=None, cursor=None):
+    """Returns a dict of the paths of the (non-symlink) files with each of chksums that any file
+    has, in path order and at most limit of them per checksum.  cursor is as for lookupChecksums."""
+    sql = "select chksum, path from files where chksum in (%s) and symlink = 0 order by chksum, path;"
+    found = {}
+    for (chksum, path) in self._selectIn(sql, chksums, cursor):
+      paths = found.setdefault(chksum, [])
+      if limit is None or len(paths) < limit:
+        paths.append(path)
+    return found
+
+  @timed("db.checksumsWithPrefix")
+  def checksumsWithPrefix(self, prefix, under=None):
+    """Returns the distinct checksums starting with the given hex prefix, in order, using a range
+    scan of csum_idx.  If under is given only checksums of files below that directory count."""
+    # the smallest string greater than every string starting with prefix
+    high = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    sql = "select distinct chksum from files where chksum >= ? and chksum < ? and symlink = 0"
+    args = [prefix, high]
+    if under is not None:
+      sql += " and path > ? and path < ?"
+      args.extend([under + "/", under + "0"])
+    with sqliteConn(self.database) as cursor:
+      cursor.execute(sql + " order by chksum;", args)
+      return [chksum for (chksum, ) in cursor]
+
+  @timed("db.markDirty")
+  def markDirty(self, path):
+    """Records that path has changed without hashing it.  The checksum is calculated the first time
+    it is asked for through freshChecksum, or by hashDirty."""
+    st = os.stat(path)
+    with self._publishing():
+      self._execSql(DIRTY_UPDATE, (path, st.st_size, st.st_mtime))
+      if self.events is not None:
+        self.events.publish("dirty", path, size=st.st_size, mtime=st.st_mtime)
+
+  @timed("db.dirtyPaths")
+  def dirtyPaths(self, limit=None):
+    """Returns the paths marked dirty and not hashed since, oldest first."""
+    sql = "select path from dirty order by rowid"
+    if limit is not None:
+      sql += " limit %d" % limit
+    with sqliteConn(self.database) as cursor:
+      cursor.execute(sql + ";")
+      return [path for (path, ) in cursor]
+
+  def isDirty(self, path):
+    """Returns true if path is waiting to be hashed."""
+    with sqliteConn(self.database) as cursor:
+      cursor.execute("select 1 from dirty where path = ?;", (path, ))
+      for row in cursor:
+        return True
+    return False
+
+  @timed("db.hashDirty")
+  def hashDirty(self, limit=None):
+    """Calculates the checksums of up to limit dirty files (all of them if limit is None), oldest
+    first.  Returns the number of files hashed or dropped.  Dirty files that no longer exist are
+    dropped.  A file that can't be read is logged and moved behind the other dirty files, to be
+    tried again after them, and dropped (keeping the checksum it had, which freshChecksum won't
+    trust) once it has failed DIRTY_ATTEMPTS times."""
+    done = 0
+    for path in self.dirtyPaths(limit):
       try:
-        for root, dirs, files in os.walk(fsroot):
-          for name in files:
-            path = os.path.join(root, name)
-            logging.info("Updating %s" % path)
-            self._updateChecksumAndLink(path, cursor)
-      except Exception as einst:
-        logging.error("Unable to update checksum for %s: %s" % (path, einst))
-        raise
-    logging.info("Done updating all checksums")
+        if os.path.exists(path):
+          self.updateChecksum(path)
+        else:
+          self._execSql(REMOVE_DIRTY, (path, ))
+        done += 1
+      except EnvironmentError:
+        # updateChecksum has logged it
+        self._dirtyFailed(path)
+    return done
+
+  def freshChecksum(self, path, rehash=False):
+    """Returns the stored checksum for path if the file's current size and mtime still match the
+    ones recorded with it.  Otherwise, if rehash is true or the file is marked dirty the checksum is
+    recalculated (and stored) and returned, and if not None is returned."""
+    st = os.stat(path)
+    entry = self.lookupChecksum(path)
+    if entry is not None:
+      (chksum, size, mtime) = entry
+      if size == st.st_size and mtime == st.st_mtime:
+        return chksum
+    if rehash or self.isDirty(path):
+      self.updateChecksum(path)
+      entry = self.lookupChecksum(path)
+      if entry is not None:
+        return entry[0]
+    return None
 
+  @timed("db.removeChecksum")
   def removeChecksum(self, path):
-    """ Remove the checksum/path entry for the given path from the database """
-    self._execSql(REMOVE_ROW, (path, ))
-
-  # Calculates the checksum and link status for the given path, then updates the DB entry
-  # and creates a hard link if the file has the same checksum as another file
-  # If path is nonexistent, this will log an error
-  def _updateChecksumAndLink(self, path, cursor):
-    if os.path.exists(path):
-      chksum = fileChecksum(path, self.checksum)
-      cursor.execute(CHECKSUM_UPDATE, (path, chksum, isLinkAsNum(path)))
-      self._hardlinkDup(path, chksum, cursor)
+    """ Remove the checksum/path entry for the given path from the database, along with any
+    pending dirty entry and block digests """
+    with self._publishing():
+      with sqliteConn(self.database) as cursor:
+        cursor.execute("begin immediate;")
+        self._removePath(path, cursor)
+      if self.events is not None:
+        self.events.publish("remove", path)
+
+  @timed("db.updateBlocks")
+  def updateBlocks(self, path, blocksize, ranges=None, expected=None):
+    """Updates the block digests and Merkle root of path, returning the number of blocks hashed.
+    If ranges (a list of (start, end) byte ranges) is given, only the blocks they touch are hashed,
+    plus the old last block and any new blocks if the size changed.  That is only safe if the file
+    was unchanged apart from those ranges since the stored digests were calculated, so expected must
+    be the file's stat from before the changes (e.g. when it was opened); if it doesn't match the
+    stored one, or there is nothing stored for blocksize, every block is hashed."""
+    st = os.stat(path)
+    count = blockCount(st.st_size, blocksize)
+    with sqliteConn(self.database) as cursor:
+      cursor.execute("select blocksize, size, mtime from merkle where path = ?;", (path, ))
+      stored = cursor.fetchone()
+
+    full = (ranges is None or expected is None or stored is None or stored[0] != blocksize or
+            stored[1] != expected.st_size or stored[2] != expected.st_mtime)
+    if full:
+      indexes = xrange(count)
+    else:
+      indexes = rangeBlocks(ranges, blocksize)
+      if stored[1] != st.st_size:
+        # the old last block may have been partial, and new blocks may not have been written
+        indexes.update(xrange(max(blockCount(stored[1], blocksize) - 1, 0), count))
+      indexes = [i for i in indexes if i < count]
+    # the blocks are read before the write transaction starts
+    digests = [(path, index, digest) for (index, digest) in
+               hashBlocks(path, blocksize, indexes, self.checksum)]
+
+    with sqliteConn(self.database) as cursor:
+      if full:
+        cursor.execute("delete from blocks where path = ?;", (path, ))
+      else:
+        cursor.execute("delete from blocks where path = ? and idx >= ?;", (path, count))
+      cursor.executemany(BLOCK_UPDATE, digests)
+      cursor.execute("select digest from blocks where path = ? order by idx;", (path, ))
+      root = merkleRoot([digest for (digest, ) in cursor.fetchall()], self.checksum)
+      cursor.execute(MERKLE_UPDATE, (path, blocksize, root, st.st_size, st.st_mtime))
+    return len(digests)
+
+  @timed("db.addAlgorithm")
+  def addAlgorithm(self, name):
+    """Starts calculating the named hashlib algorithm's digest for every file, in addition to the
+    database's main checksum.  Files hashed from now on get it straight away; the digests of files
+    already in the database are filled in by backfillAlgorithms."""
+    hashConstructor(name)
+    if name == self.checksumName or name in [n for (n, func) in self.algorithms]:
+      raise ValueError("%s is already calculated" % name)
+    with sqliteConn(self.database) as cursor:
+      cursor.execute("alter table files add column %s varchar;" % (ALGORITHM_COLUMN % name))
+      cursor.execute("insert into algorithms(name, complete) values(?, 0);", (name, ))
+    self._loadAlgorithms()
+
+  def incompleteAlgorithms(self):
+    """Returns the names of the extra algorithms that some files have no digest for yet."""
+    return [name for (name, func) in self.algorithms if not name in self.completeAlgorithms]
+
+  @timed("db.backfillAlgorithms")
+  def backfillAlgorithms(self, limit=None):
+    """Fills in the digests of the extra algorithms for up to limit files missing them (all of
+    them if limit is None), reading each file once for all of its missing digests.  Files changed
+    since they were last hashed are rehashed completely, and entries for files that no longer exist
+    are removed.  Returns the number of files read.  Which algorithms are incomplete is read from
+    the database every time, as another process may have stored files without them since.  The
+    rehashes and removals are published to events, if set; filling in extra digests isn't."""
+    self._loadAlgorithms()
+    missing = self.incompleteAlgorithms()
+    if len(missing) <= 0:
+      return 0
+    where = " or ".join("%s is null" % (ALGORITHM_COLUMN % name) for name in missing)
+    done = 0
+    completed = False
+    while limit is None or done < limit:
+      # each batch of files is read with no transaction open, then written in one
+      count = BATCH_SIZE if limit is None else min(BATCH_SIZE, limit - done)
+      with sqliteConn(self.database) as cursor:
+        cursor.execute("select path, size, mtime from files where %s limit %d;" % (where, count))
+        rows = cursor.fetchall()
+      removed = []
+      digests = []
+      hashed = []
+      for (path, size, mtime) in rows:
+        if not os.path.exists(path):
+          removed.append(path)
+          continue
+        st = os.stat(path)
+        if size == st.st_size and mtime == st.st_mtime:
+          digests.append((path, fileChecksums(path, [func for (name, func) in self.algorithms])))
+        else:
+          result = self.hashPath(path)
+          if result is None:
+            removed.append(path)
+            continue
+          hashed.append(result)
+        done += 1
+      with self._publishing():
+        with sqliteConn(self.database) as cursor:
+          cursor.execute("begin immediate;")
+          for path in removed:
+            logging.info("Removing entry for %s; file does not exist" % path)
+            self._removePath(path, cursor)
+          for (path, values) in digests:
+            self._updateAlgorithms(path, values, cursor)
+          for result in hashed:
+            self._storeHashed(result, cursor)
+        self._publishRemoved(removed)
+        self._publishHashed(hashed)
+      if len(rows) < count:
+        break
+
+    with sqliteConn(self.database) as cursor:
+      cursor.execute("begin immediate;")
+      cursor.execute("select 1 from files where %s limit 1;" % where)
+      if cursor.fetchone() is None:
+        for name in missing:
+          logging.info("All files have a %s digest" % name)
+          cursor.execute("update algorithms set complete = 1 where name = ?;", (name, ))
+        completed = True
+    if completed:
+      self._loadAlgorithms()
+    return done
+
+  @timed("db.filesAfter")
+  def filesAfter(self, after=None, limit=None):
+    """Returns the files (but not symlinks) with paths after the given one, in path order, as
+    (path, size, mtime, digests) where digests is a dict of the stored digests by algorithm name."""
+    where = "symlink = 0"
+    args = []
+    if after is not None:
+      where += " and path > ?"
+      args.append(after)
+    return self._fileDigests(where, args, "path", limit)
+
+  @timed("db.randomFiles")
+  def randomFiles(self, count):
+    """Returns count files (but not symlinks) picked at random, in the form given by filesAfter."""
+    return self._fileDigests("symlink = 0", [], "random()", count)
+
+  def getCheckpoint(self, name):
+    """Returns the value of the named checkpoint, or None if it isn't set."""
+    with sqliteConn(self.database) as cursor:
+      cursor.execute("select value from checkpoints where name = ?;", (name, ))
+      for (value, ) in cursor:
+        return value
+    return None
+
+  def setCheckpoint(self, name, value):
+    """Sets the named checkpoint to value, or clears it if value is None."""
+    if value is None:
+      self._execSql("delete from checkpoints where name = ?;", (name, ))
+    else:
+      self._execSql("insert or replace into checkpoints(name, value) values(?, ?);", (name, value))
+
+  @timed("db.changesSince")
+  def changesSince(self, seq):
+    """Yields the net change to every file whose entry changed after the change numbered seq, in
+    the order of their last changes: a dict of its current state ({"seq", "op": "update", "path",
+    "digest", "size", "mtime"} plus "symlink": true for symlinks) or {"seq", "op": "remove",
+    "path"} if it has no entry any more.  A rename is the removal of the old path and an update of
+    the new one.  The cost depends on the number of changes rather than of files.  Raises
+    ValueError if changes after seq have been removed by pruneChanges."""
+    pruned = int(self.getCheckpoint(CHANGES_PRUNED) or 0)
+    if seq < pruned:
+      raise ValueError("changes up to %d have been pruned; changes since %d are unknown" %
+                       (pruned, seq))
+    with sqliteConn(self.database) as cursor:
+      cursor.execute("""select changed.path, changed.last, files.chksum, files.size, files.mtime,
+files.symlink from (%s) as changed left join files on files.path = changed.path
+order by changed.last;""" % CHANGED_PATHS, (seq, seq))
+      for (path, last, chksum, size, mtime, symlink) in cursor:
+        if chksum is None:
+          yield {"seq": last, "op": "remove", "path": path}
+          continue
+        change = {"seq": last, "op": "update", "path": path, "digest": chksum, "size": size,
+                  "mtime": mtime}
+        if symlink:
+          change["symlink"] = True
+        yield change
+
+  def lastChange(self):
+    """Returns the seq of the latest change, 0 if there have been none."""
+    with sqliteConn(self.database) as cursor:
+      cursor.execute("select seq from sqlite_sequence where name = 'changes';")
+      for (seq, ) in cursor:
+        return seq
+    return 0
+
+  @timed("db.compactChanges")
+  def compactChanges(self):
+    """Removes every logged change superseded by a later change to the same paths, which leaves
+    changesSince's answers as they were.  Returns the number of changes removed."""
+    with sqliteConn(self.database) as cursor:
+      # a change can go if each path it touched changed again later
+      cursor.execute("delete from changes where seq not in (select last from (%s));" %
+                     CHANGED_PATHS, (0, 0))
+      return cursor.rowcount
+
+  @timed("db.pruneChanges")
+  def pruneChanges(self, days):
+    """Removes the changes logged more than days days ago, returning the number removed.
+    changesSince refuses to answer for the time they covered from then on."""
+    with sqliteConn(self.database) as cursor:
+      cursor.execute("begin immediate;")
+      cursor.execute("select max(seq) from changes where time < ?;", (time.time() - days * 86400, ))
+      (last, ) = cursor.fetchone()
+      if last is None:
+        return 0
+      cursor.execute("delete from changes where seq <= ?;", (last, ))
+      removed = cursor.rowcount
+      cursor.execute("insert or replace into checkpoints(name, value) values(?, ?);",
+                     (CHANGES_PRUNED, str(last)))
+    return removed
+
+  @timed("db.treeDigest")
+  def treeDigest(self, path):
+    """Returns the digest of the directory at path, or None if there are no files below it.  It is
+    the sum, modulo TREE_MODULUS, of the SHA256 of the name and digest of every file (but not
+    symlink) and directory directly in it, so two trees with the same names and contents have the
+    same digest wherever they are, and any change below a directory changes its digest.  Queued
+    changes are folded in first."""
+    self.updateTrees()
+    path = path.rstrip("/") or "/"
+    with sqliteConn(self.database) as cursor:
+      cursor.execute("select digest from dirs where path = ?;", (path, ))
+      for (digest, ) in cursor:
+        return digest
+    return None
+
+  @timed("db.treeChildren")
+  def treeChildren(self, path):
+    """Returns the (path, digest) of the directories directly in the directory at path, in path
+    order, to narrow down where two trees whose digests differ do.  Queued changes are folded in
+    first."""
+    self.updateTrees()
+    with sqliteConn(self.database) as cursor:
+      cursor.execute("select path, digest from dirs where parent = ? order by path;",
+                     (path.rstrip("/") or "/", ))
+      return cursor.fetchall()
+
+  @timed("db.dirReport")
+  def dirReport(self, path="/", top=REPORT_TOP):
+    """Returns the totals of the directory at path (None if there are no files below it) and of the
+    top directories below it with the most duplicated bytes, most first.  Each is a dict of its
+    path, files, bytes, dupFiles and dupBytes (in files whose checksum another file, anywhere,
+    has), and uniqueFiles (the rest) below it.  The totals are kept up to date as files change, so
+    this reads top rows from an index rather than the whole database.  Queued changes are folded
+    in first."""
+    self.updateTrees()
+    path = path.rstrip("/") or "/"
+    columns = ["path", "files", "bytes", "dupFiles", "dupBytes"]
+    sql = "select %s from dirs where " % ", ".join(columns)
+    with sqliteConn(self.database) as cursor:
+      cursor.execute(sql + "path = ?;", (path, ))
+      rows = cursor.fetchall()
+      if len(rows) <= 0:
+        return None
+      if path == "/":
+        cursor.execute(sql + "path != '/' order by dupBytes desc limit ?;", (top, ))
+      else:
+        cursor.execute(sql + "path > ? and path < ? order by dupBytes desc limit ?;",
+                       (path + "/", path + "0", top))
+      rows.extend(cursor.fetchall())
+    totals = [dict(zip(columns, row)) for row in rows]
+    for entry in totals:
+      entry["uniqueFiles"] = entry["files"] - entry["dupFiles"]
+    return (totals[0], totals[1:])
+
+  @timed("db.updateTrees")
+  def updateTrees(self, limit=None):
+    """Folds the changes to files queued since the last call (or at most limit of them) into the
+    digests of the directories above them, TREE_BATCH to a transaction, returning the number
+    folded in.  Each directory changed is written once per batch, however many of its files
+    changed, and only the directories with changes below them are touched."""
+    folded = 0
+    while limit is None or folded < limit:
+      batch = TREE_BATCH if limit is None else min(TREE_BATCH, limit - folded)
+      with sqliteConn(self.database) as cursor:
+        # the deltas and the directories they change are read under the write lock, so that
+        # another fold (in this process or another) can't apply the same ones
+        cursor.execute("begin immediate;")
+        cursor.execute("select id, path, chksum, size, sign, dups from tree_deltas order by id " +
+                       "limit ?;", (batch, ))
+        rows = cursor.fetchall()
+        if len(rows) <= 0:
+          break
+        self._foldTreeDeltas(cursor, rows)
+        cursor.execute("delete from tree_deltas where id <= ?;", (rows[-1][0], ))
+      folded += len(rows)
+    return folded
+
+  @timed("db.lookupDigests")
+  def lookupDigests(self, path):
+    """Returns a dict of every stored digest of path (the main checksum and those of any extra
+    algorithms) keyed by algorithm name, or None if path has no entry."""
+    columns = [ALGORITHM_COLUMN % name for (name, func) in self.algorithms]
+    with sqliteConn(self.database) as cursor:
+      cursor.execute("select %s from files where path = ?;" % ", ".join(["chksum"] + columns),
+                     (path, ))
+      for row in cursor:
+        names = [self.checksumName] + [name for (name, func) in self.algorithms]
+        return dict((name, digest) for (name, digest) in zip(names, row) if digest is not None)
+    return None
+
+  @timed("db.findDuplicates")
+  def findDuplicates(self, fsroot, sampleSize=SAMPLE_SIZE):
+    """Finds the groups of identical files under fsroot, reading as little as possible.  Files are
+    grouped by size first; files of the same size are compared by a checksum of their first and
+    last sampleSize bytes; only files whose samples match too are hashed completely.  Samples and
+    checksums are stored in the database and reused while the files' size and mtime are unchanged.
+    Empty files and symlinks are left out.  Returns the groups (lists of paths, in order) and the
+    number of bytes in the files and of bytes read."""
+    logging.info("Finding duplicates under %s" % fsroot)
+    bySize = {}
+    totalBytes = 0
+    for root, dirs, files in os.walk(fsroot):
+      for name in files:
+        path = os.path.join(root, name)
+        st = os.lstat(path)
+        if S_ISREG(st.st_mode) and st.st_size > 0:
+          bySize.setdefault(st.st_size, []).append((path, st))
+          totalBytes += st.st_size
+
+    readBytes = 0
+    groups = []
+    for (size, entries) in bySize.iteritems():
+      if len(entries) < 2:
+        continue
+
+      # what is stored for the files is read first, then the files themselves with no transaction
+      # open, then what was learned is written in one short transaction for each size
+      with sqliteConn(self.database) as cursor:
+        samples = self._freshValues(cursor, "select size, mtime, sample from samples where path = ?;",
+                                    entries)
+        checksums = self._freshValues(cursor, "select size, mtime, chksum from files where path = ?;",
+                                      entries)
+      sampleRows = []
+      checksumRows = []
+      hashedFiles = []
+
+      bySample = {}
+      for (path, st) in entries:
+        sample = samples.get(path)
+        if sample is None:
+          (sample, whole) = sampleChecksum(path, size, sampleSize, self.checksum)
+          readBytes += min(size, 2 * sampleSize)
+          sampleRows.append((path, st.st_size, st.st_mtime, sample))
+        bySample.setdefault(sample, []).append((path, st))
+
+      for (sample, sampled) in bySample.iteritems():
+        if len(sampled) < 2:
+          continue
+        byChecksum = {}
+        for (path, st) in sampled:
+          chksum = checksums.get(path)
+          if chksum is not None:
+            pass
+          elif size <= 2 * sampleSize and len(self.algorithms) <= 0:
+            # the sample covered the whole file, so it is the checksum
+            chksum = sample
+            checksumRows.append((path, chksum, 0, st.st_size, st.st_mtime))
+          else:
+            hashed = self.hashPath(path)
+            if hashed is None:
+              continue
+            chksum = hashed[2]
+            hashedFiles.append(hashed)
+            readBytes += size
+          byChecksum.setdefault(chksum, []).append(path)
+        groups.extend(sorted(paths) for paths in byChecksum.itervalues() if len(paths) > 1)
+
+      if len(sampleRows) + len(checksumRows) + len(hashedFiles) > 0:
+        with sqliteConn(self.database) as cursor:
+          cursor.execute("begin immediate;")
+          cursor.executemany("insert or replace into samples(path, size, mtime, sample) values(?, ?, ?, ?);",
+                             sampleRows)
+          cursor.executemany(CHECKSUM_UPDATE, checksumRows)
+          if len(checksumRows) > 0:
+            self._missedAlgorithms(0, cursor)
+          for hashed in hashedFiles:
+            self._storeHashed(hashed, cursor, False)
+    logging.info("Found %d groups of duplicates, reading %d of %d bytes" % (len(groups), readBytes,
+                 totalBytes))
+    return (sorted(groups), totalBytes, readBytes)
+
+  @timed("db.chunkReport")
+  def chunkReport(self, limit=20, fanout=100):
+    """Summarises the data shared between files at the chunk level.  Returns a dict with the number
+    of chunked files, the bytes in them, the bytes in distinct chunks, and the limit pairs of files
+    and of directories sharing the most bytes, as (bytes, path, path) tuples.  Chunks held by more
+    than fanout files count towards the totals but not towards the pairs (they are usually runs of
+    zeros or padding, and would make the pairs quadratic)."""
+    with sqliteConn(self.database) as cursor:
+      cursor.execute("select count(distinct path), coalesce(sum(size), 0) from file_chunks;")
+      (files, logicalBytes) = cursor.fetchone()
+      cursor.execute("select coalesce(sum(size), 0) from chunks;")
+      (uniqueBytes, ) = cursor.fetchone()
+
+      # the files holding each shared chunk
+      holders = {}
+      cursor.execute("""select c.digest, c.size, f.path from chunks c, file_chunks f
+where c.refs > 1 and f.digest = c.digest;""")
+      for (digest, size, path) in cursor:
+        if not digest in holders:
+          holders[digest] = (size, set())
+        holders[digest][1].add(path)
+
+    pairs = {}
+    dirPairs = {}
+    for (size, paths) in holders.itervalues():
+      if len(paths) > fanout:
+        continue
+      for pair in itertools.combinations(sorted(paths), 2):
+        pairs[pair] = pairs.get(pair, 0) + size
+      dirs = sorted(set(os.path.dirname(path) for path in paths))
+      for pair in itertools.combinations(dirs, 2):
+        dirPairs[pair] = dirPairs.get(pair, 0) + size
+
+    def top(shared):
+      ordered = sorted(((size, a, b) for ((a, b), size) in shared.iteritems()), reverse=True)
+      return ordered[:limit]
+    return {"files": files, "logicalBytes": logicalBytes, "uniqueBytes": uniqueBytes,
+            "filePairs": top(pairs), "dirPairs": top(dirPairs)}
+
+  @timed("db.lookupMerkle")
+  def lookupMerkle(self, path):
+    """Returns the stored (root, blocksize, size, mtime) of the block digests of path, or None."""
+    with sqliteConn(self.database) as cursor:
+      cursor.execute("select root, blocksize, size, mtime from merkle where path = ?;", (path, ))
+      for row in cursor:
+        return row
+    return None
+
+  # Runs sql, selecting (size, mtime, value) for a path, for each (path, stat) in entries.  Returns
+  # the values whose size and mtime are still the file's, by path.
+  def _freshValues(self, cursor, sql, entries):
+    values = {}
+    for (path, st) in entries:
+      cursor.execute(sql, (path, ))
+      for (size, mtime, value) in cursor.fetchall():
+        if size == st.st_size and mtime == st.st_mtime:
+          values[path] = value
+    return values
+
+  # Runs sql, whose %s is replaced by one placeholder per key, over keys in batches of
+  # LOOKUP_BATCH, yielding every row selected
+  def _selectIn(self, sql, keys, cursor=None):
+    keys = list(keys)
+    if cursor is None:
+      with sqliteConn(self.database) as cursor:
+        for row in self._selectIn(sql, keys, cursor):
+          yield row
+      return
+    for batch in batches(keys, LOOKUP_BATCH):
+      cursor.execute(sql % ", ".join(["?"] * len(batch)), batch)
+      for row in cursor.fetchall():
+        yield row
+
+  # Returns the files row (path, chksum, symlink, size, mtime) to import for a manifest entry, or
+  # None if the file is missing or has changed since the manifest was made
+  def _manifestRow(self, path, digest, size, mtime, trust, made=None):
+    if trust:
+      return (path, digest, 0, size, mtime)
+    try:
+      st = os.lstat(path)
+      symlink = 0
+      if S_ISLNK(st.st_mode):
+        # sha1sum follows symlinks, as hashPath does
+        st = os.stat(path)
+        symlink = 1
+    except OSError:
+      return None
+    if not S_ISREG(st.st_mode):
+      return None
+    if (size is not None and size != st.st_size) or (mtime is not None and mtime != st.st_mtime):
+      return None
+    if (size is None or mtime is None) and (made is None or st.st_mtime >= made):
+      # the file may have changed since the manifest was made
+      return (path, digest, symlink, None, None)
+    return (path, digest, symlink, st.st_size, st.st_mtime)
+
+  # Writes and commits a batch of imported rows, in path order so that they go into the pages of the
+  # path index one after another
+  def _importBatch(self, cursor, batch):
+    if len(batch) <= 0:
+      return
+    batch.sort()
+    cursor.executemany(CHECKSUM_UPDATE, batch)
+    cursor.commit()
+
+  # Removes every entry for path, in all of PATH_TABLES, releasing its chunks.  The chunks are read
+  # first, so the transaction must have begun with "begin immediate;"
+  def _removePath(self, path, cursor):
+    self._replaceChunks(path, [], cursor)
+    for table in PATH_TABLES:
+      cursor.execute("delete from %s where path = ?;" % table, (path, ))
+
+  # Returns true if the rules in ignore (if any) say the file at path should not be hashed.  The
+  # file is only stat'ed when there are size rules.
+  def _ignored(self, path, ignore):
+    if ignore is None:
+      return False
+    size = None
+    if ignore.needsSize:
+      try:
+        st = os.lstat(path)
+        if S_ISREG(st.st_mode):
+          size = st.st_size
+      except OSError:
+        pass
+    return ignore.ignored(path, size)
+
+  # Moves the dirty mark of path, which couldn't be hashed, behind the others, or drops it if that
+  # was its last attempt
+  def _dirtyFailed(self, path):
+    with sqliteConn(self.database) as cursor:
+      cursor.execute("begin immediate;")
+      cursor.execute("select size, mtime, attempts from dirty where path = ?;", (path, ))
+      row = cursor.fetchone()
+      if row is None:
+        return
+      (size, mtime, attempts) = row
+      cursor.execute(REMOVE_DIRTY, (path, ))
+      if attempts + 1 >= DIRTY_ATTEMPTS:
+        logging.error("Unable to hash %s after %d attempts; no longer trying" % (path, attempts + 1))
+        return
+      cursor.execute("insert into dirty(path, size, mtime, attempts) values(?, ?, ?, ?);",
+                     (path, size, mtime, attempts + 1))
+
+  # Holds publishLock, if events is set, from before a write's transaction until its events are
+  # published, so that two writes to the same path can't publish in the opposite order to their
+  # commits.  Writers that publish always take it before the database's write lock.
+  @contextmanager
+  def _publishing(self):
+    if self.events is None:
+      yield
     else:
-      # this happens for broken symlinks
-      logging.error("Path %s does not exist; skipping update" % path)
+      with self.publishLock:
+        yield
+
+  # Tells events (if set) of the removal of each of a list of committed paths
+  def _publishRemoved(self, paths):
+    if self.events is None:
+      return
+    for path in paths:
+      self.events.publish("remove", path)
+
+  # Tells events (if set) of the checksums in a list of committed hashPath results; None entries
+  # (for paths that had gone) are skipped
+  def _publishHashed(self, results):
+    if self.events is None:
+      return
+    for hashed in results:
+      if hashed is not None:
+        (path, st, chksum) = hashed[:3]
+        self.events.publish("update", path, digest=chksum, size=st.st_size, mtime=st.st_mtime)
+
+  # Stores the results of hashPath (but not the file's stat; that is up to the caller) and makes
+  # the hard link for a duplicate (if hardlink is true), in a transaction begun with "begin
+  # immediate;" as the chunks and duplicates are read first
+  def _storeHashed(self, hashed, cursor, hardlink=True):
+    (path, st, chksum, digests, chunks) = hashed
+    if chunks is not None:
+      self._replaceChunks(path, chunks, cursor)
+    cursor.execute(CHECKSUM_UPDATE, (path, chksum, isLinkAsNum(path), st.st_size, st.st_mtime))
+    self._updateAlgorithms(path, digests, cursor)
+    cursor.execute(REMOVE_DIRTY, (path, ))
+    if hardlink:
+      self._hardlinkDup(path, chksum, cursor)
+
+  # Replaces the chunks recorded for path with chunks, a list of (offset, size, digest), adjusting
+  # the reference counts by the difference so that only chunks that were added or dropped are
+  # touched, and removing chunks nothing refers to any more
+  def _replaceChunks(self, path, chunks, cursor):
+    cursor.execute("select offset, size, digest from file_chunks where path = ? order by idx;",
+                   (path, ))
+    old = [tuple(row) for row in cursor]
+    if old == chunks:
+      return
+
+    deltas = {}
+    for (offset, size, digest) in old:
+      deltas[digest] = (deltas.get(digest, (0, size))[0] - 1, size)
+    for (offset, size, digest) in chunks:
+      deltas[digest] = (deltas.get(digest, (0, size))[0] + 1, size)
+    for (digest, (delta, size)) in deltas.iteritems():
+      if delta > 0:
+        cursor.execute("insert or ignore into chunks(digest, size, refs) values(?, ?, 0);",
+                       (digest, size))
+      if delta != 0:
+        cursor.execute("update chunks set refs = refs + ? where digest = ?;", (delta, digest))
+      if delta < 0:
+        cursor.execute("delete from chunks where digest = ? and refs <= 0;", (digest, ))
+
+    cursor.execute("delete from file_chunks where path = ?;", (path, ))
+    for (idx, (offset, size, digest)) in enumerate(chunks):
+      cursor.execute(FILE_CHUNK_INSERT, (path, idx, digest, offset, size))
 
   # internal helper to link a path using an existing cursor.  This is in some sense an
   # antipattern method, but I really don't want to deal with this as a duplicated code
@@ -180,12 +1395,21 @@ order by chksum, link;""")
     if not os.path.islink(path):
       pathInode = os.stat(path).st_ino
       links = []
-      cursor.execute("select path from files where chksum = ? and path != ? and symlink = 0;",
-            (chksum, path))
+      # the extra digests have to match as well, where both files have them
+      confirm = self._algorithmColumns()
+      cursor.execute("select %s from files where path = ?;" % ", ".join(["path"] + confirm),
+            (path, ))
+      mine = cursor.fetchone()[1:]
+      cursor.execute("select %s from files where chksum = ? and path != ? and symlink = 0;" %
+            ", ".join(["path"] + confirm), (chksum, path))
 
       # i.e. find all different files with the same checksum
       for row in cursor:
-        (link, ) = row
+        link = row[0]
+        if [1 for (a, b) in zip(mine, row[1:]) if a is not None and b is not None and a != b]:
+          logging.warn("%s and %s have the same %s but different digests" % (path, link,
+                       self.checksumName))
+          continue
         if os.stat(link).st_ino != pathInode:
           links.append(link) # only hardlink files that don't point at the same inode
 
@@ -196,10 +1420,172 @@ order by chksum, link;""")
         del links[0]
         links.append(path)
 
-        # clean up any links with different inodes
+        # clean up any links with different inodes; they take on the canonical file's stat
+        canonicalStat = os.stat(canonicalLink)
         for link in links:
           cursor.execute(LINK_UPDATE, (1, link))
           linkFile(canonicalLink, link)
+          cursor.execute(STAT_UPDATE, (canonicalStat.st_size, canonicalStat.st_mtime, link))
+
+  # Selects (path, size, mtime, digests) for the files matching where
+  def _fileDigests(self, where, args, order, limit):
+    names = [self.checksumName] + [name for (name, func) in self.algorithms]
+    columns = ["chksum"] + [ALGORITHM_COLUMN % name for (name, func) in self.algorithms]
+    sql = "select path, size, mtime, %s from files where %s order by %s" % (", ".join(columns),
+                                                                             where, order)
+    if limit is not None:
+      sql += " limit %d" % limit
+    with sqliteConn(self.database) as cursor:
+      cursor.execute(sql + ";", args)
+      return [(row[0], row[1], row[2], dict((name, digest) for (name, digest) in zip(names, row[3:])
+                                              if digest is not None))
+              for row in cursor]
+
+  # Stores the digests of the extra algorithms for path, in the order of self.algorithms when it was
+  # hashed (algorithms are only ever added after the others)
+  def _updateAlgorithms(self, path, digests, cursor):
+    if len(digests) > 0:
+      names = [name for (name, func) in self.algorithms][:len(digests)]
+      columns = ", ".join("%s = ?" % (ALGORITHM_COLUMN % name) for name in names)
+      cursor.execute("update files set %s where path = ?;" % columns, list(digests) + [path])
+    self._missedAlgorithms(len(digests), cursor)
+
+  # Marks the algorithms after the first supplied incomplete again, as a file was just stored
+  # without their digests: they were added (by another process) after it was hashed, and may already
+  # have been marked complete.  backfillAlgorithms then fills the digests in.  The algorithms are
+  # reloaded if they have changed, so that files hashed from now on get every digest.
+  def _missedAlgorithms(self, supplied, cursor):
+    cursor.execute("select name from algorithms order by rowid;")
+    names = [name for (name, ) in cursor.fetchall()]
+    missed = names[supplied:]
+    if len(missed) > 0:
+      cursor.execute("update algorithms set complete = 0 where complete = 1 and name in (%s);" %
+                     ", ".join(["?"] * len(missed)), missed)
+    if names != [name for (name, func) in self.algorithms] or len(missed) > 0:
+      self._loadAlgorithms(cursor)
+
+  # Returns the files columns of the extra algorithms, only of those every file has a digest for if
+  # complete is true
+  def _algorithmColumns(self, complete=False):
+    return [ALGORITHM_COLUMN % name for (name, func) in self.algorithms
+            if not complete or name in self.completeAlgorithms]
+
+  # Reads the extra algorithms into self.algorithms, as (name, constructor), and the names of the
+  # complete ones into self.completeAlgorithms, through cursor if given
+  def _loadAlgorithms(self, cursor=None):
+    if cursor is None:
+      with sqliteConn(self.database) as cursor:
+        return self._loadAlgorithms(cursor)
+    algorithms = []
+    completeAlgorithms = set()
+    cursor.execute("select name, complete from algorithms order by rowid;")
+    for (name, complete) in cursor.fetchall():
+      algorithms.append((name, hashConstructor(name)))
+      if complete:
+        completeAlgorithms.add(name)
+    (self.algorithms, self.completeAlgorithms) = (algorithms, completeAlgorithms)
+
+  # Switches the database to write-ahead logging, so that reads never wait for a writer (or block
+  # one) and only writers wait for each other.  The mode is kept in the database file.
+  def _enableWal(self):
+    with sqliteConn(self.database) as cursor:
+      cursor.execute("pragma journal_mode=wal;")
+      (mode, ) = cursor.fetchone()
+    if mode.lower() != "wal":
+      logging.warn("%s is using the %s journal rather than write-ahead logging; readers and writers "
+                   "sharing it will wait for each other" % (self.database, mode))
+
+  # Applies queued tree_deltas rows to dirs, deepest directories first so that the change to each
+  # is complete before it is passed on to its parent
+  def _foldTreeDeltas(self, cursor, rows):
+    # the change to the sum, the entries and each of the totals of every directory
+    pending = {}
+    for (id, path, chksum, size, sign, dups) in rows:
+      (parent, name) = os.path.split(path)
+      change = pending.setdefault(parent, [0, 0, 0, 0, 0, 0])
+      size = size or 0
+      change[0] += sign * treeEntryDigest("f", name, chksum)
+      for (i, value) in enumerate((sign, sign, sign * size, dups, dups * size)):
+        change[i + 1] += value
+    while len(pending) > 0:
+      depth = max(treeDepth(path) for path in pending)
+      for path in [path for path in pending if treeDepth(path) == depth]:
+        change = pending.pop(path)
+        cursor.execute("select digest, entries, files, bytes, dupFiles, dupBytes from dirs " +
+                       "where path = ?;", (path, ))
+        row = cursor.fetchone()
+        (oldDigest, entries, files, bytes, dupFiles, dupBytes) = row or (None, 0, 0, 0, 0, 0)
+        digest = "%064x" % ((int(oldDigest or "0", 16) + change[0]) % TREE_MODULUS)
+        totals = (files + change[2], bytes + change[3], dupFiles + change[4], dupBytes + change[5])
+        entries += change[1]
+        (parent, name) = os.path.split(path) if path != "/" else (None, None)
+        if entries <= 0:
+          cursor.execute("delete from dirs where path = ?;", (path, ))
+          digest = None
+        elif row is not None:
+          cursor.execute("update dirs set digest = ?, entries = ?, files = ?, bytes = ?, " +
+                         "dupFiles = ?, dupBytes = ? where path = ?;",
+                         (digest, entries) + totals + (path, ))
+        else:
+          cursor.execute("insert into dirs(path, parent, digest, entries, files, bytes, dupFiles, " +
+                         "dupBytes) values(?, ?, ?, ?, ?, ?, ?, ?);",
+                         (path, parent, digest, entries) + totals)
+        if parent is None or (digest == oldDigest and not any(change[2:])):
+          continue
+        # the totals pass on to the parent as they are, and the entry for the directory changes
+        # with its digest
+        passed = pending.setdefault(parent, [0, 0, 0, 0, 0, 0])
+        for i in range(2, 6):
+          passed[i] += change[i]
+        if digest == oldDigest:
+          continue
+        if oldDigest is not None:
+          passed[0] -= treeEntryDigest("d", name, oldDigest)
+          passed[1] -= 1
+        if digest is not None:
+          passed[0] += treeEntryDigest("d", name, digest)
+          passed[1] += 1
+
+  # Adds any of FILES_COLUMNS that the files table does not have yet, any missing TABLES, and any of
+  # DIRTY_COLUMNS that the dirty table does not have yet
+  def _upgradeSchema(self):
+    with sqliteConn(self.database) as cursor:
+      cursor.execute("select name from sqlite_master where type = 'table';")
+      tables = [name for (name, ) in cursor]
+      cursor.execute("pragma table_info(files);")
+      existing = [row[1] for row in cursor]
+      for (name, definition) in FILES_COLUMNS:
+        if not name in existing:
+          logging.info("Adding column %s to files" % name)
+          cursor.execute("alter table files add column %s %s;" % (name, definition))
+      if "dirs" in tables:
+        cursor.execute("pragma table_info(dirs);")
+        if not "dupBytes" in [row[1] for row in cursor]:
+          # directory digests from before there were totals are rebuilt with them
+          for name in ("tree_replace", "tree_insert", "tree_delete", "tree_update"):
+            cursor.execute("drop trigger if exists %s;" % name)
+          cursor.execute("drop table dirs;")
+          cursor.execute("drop table tree_deltas;")
+          tables.remove("dirs")
+      for sql in TABLES:
+        cursor.execute(sql)
+      cursor.execute("pragma table_info(dirty);")
+      existing = [row[1] for row in cursor]
+      for (name, definition) in DIRTY_COLUMNS:
+        if not name in existing:
+          logging.info("Adding column %s to dirty" % name)
+          cursor.execute("alter table dirty add column %s %s;" % (name, definition))
+      if not "changes" in tables:
+        # files from before there was a log count as changed, so that changes since 0 covers them
+        cursor.execute("insert into changes(op, path, chksum) select 'update', path, chksum from files;")
+      if not "dirs" in tables:
+        # and files from before there were directory digests are counted and queued for them
+        cursor.execute("delete from digests;")
+        cursor.execute("insert into digests(chksum, copies) " +
+                       "select chksum, count(*) from files where symlink = 0 group by chksum;")
+        cursor.execute("insert into tree_deltas(path, chksum, size, sign, dups) " +
+                       "select path, chksum, size, 1, copies > 1 from files join digests using (chksum) " +
+                       "where symlink = 0;")
 
   # Makes sure the SQL statement has a "; at the end"
   def _formatSql(self, sql):
@@ -222,6 +1608,32 @@ order by chksum, link;""")
       logging.error("Unable to exec %s with args %s: %s" % (sql, sqlargs, einst))
       raise
 
+def printChunkReport(report):
+  print "Chunked files: %d" % report["files"]
+  print "Bytes in files: %d" % report["logicalBytes"]
+  print "Bytes in distinct chunks: %d (%d shared)" % (report["uniqueBytes"],
+      report["logicalBytes"] - report["uniqueBytes"])
+  print
+  print "Files sharing the most bytes:"
+  for (size, a, b) in report["filePairs"]:
+    print "%12d  %s  %s" % (size, a, b)
+  print
+  print "Directories sharing the most bytes:"
+  for (size, a, b) in report["dirPairs"]:
+    print "%12d  %s  %s" % (size, a, b)
+
+def printDirReport(report):
+  (totals, top) = report
+  print "Files below %s: %d (%d with no copy elsewhere)" % (totals["path"], totals["files"],
+      totals["uniqueFiles"])
+  print "Bytes in files: %d (%d duplicated)" % (totals["bytes"], totals["dupBytes"])
+  print
+  print "Directories with the most duplicated bytes:"
+  print "%14s %14s %10s %10s  %s" % ("dup bytes", "bytes", "files", "unique", "directory")
+  for entry in top:
+    print "%14d %14d %10d %10d  %s" % (entry["dupBytes"], entry["bytes"], entry["files"],
+        entry["uniqueFiles"], entry["path"])
+
 def main():
   usage = """%prog perform operations on the FUSE SHA1 filesystem database.  [options] database."""
   parser = OptionParser(usage = usage)
@@ -240,7 +1652,182 @@ def main():
                     action = "store_true",
                     dest = "vacuum",
                     default = False,
-                    help = "Remove entries for nonexistent files")
+                    help = "Remove entries for nonexistent files (and ignored ones, with --ignore-file)")
+
+  parser.add_option("--ignore-file",
+                    dest = "ignoreFile",
+                    help = "ignore rules (as for the mount's --ignore-file) whose files --vacuum removes",
+                    metavar="FILE")
+
+  parser.add_option("--ignore-root",
+                    dest = "ignoreRoot",
+                    default = "/",
+                    help = "the root anchored --ignore-file rules are relative to [default: %default]",
+                    metavar="DIR")
+
+  parser.add_option("--hash-dirty",
+                    action = "store_true",
+                    dest = "hashDirty",
+                    default = False,
+                    help = "Calculate the checksums of files changed under a --lazy mount")
+
+  parser.add_option("--lookup",
+                    dest = "lookup",
+                    help = "Print the checksum of PATH (the path in the root), calculating it if it is dirty",
+                    metavar="PATH")
+
+  parser.add_option("--add-algorithm",
+                    dest = "addAlgorithm",
+                    help = "Also calculate the hashlib ALGORITHM (e.g. sha256) for every file; existing " +
+                           "files are filled in by --backfill or in the background by the mount",
+                    metavar="ALGORITHM")
+
+  parser.add_option("--backfill",
+                    action = "store_true",
+                    dest = "backfill",
+                    default = False,
+                    help = "Calculate the digests of added algorithms for files that don't have them yet")
+
+  parser.add_option("--find-dups",
+                    dest = "findDups",
+                    help = "Print the groups of identical files under DIR, hashing only files whose " +
+                           "size and first and last 64KB match another file's",
+                    metavar="DIR")
+
+  parser.add_option("--verify",
+                    action = "store_true",
+                    dest = "verify",
+                    default = False,
+                    help = "Rehash files that haven't changed since they were hashed and report any " +
+                           "whose checksum no longer matches, as JSON lines.  Resumes where an " +
+                           "interrupted --verify stopped.")
+
+  parser.add_option("--workers",
+                    dest = "workers",
+                    type = "int",
+                    default = 4,
+                    help = "number of files --verify hashes at once [default: %default]")
+
+  parser.add_option("--bandwidth",
+                    dest = "bandwidth",
+                    type = "float",
+                    default = 0,
+                    help = "limit --verify to reading MB megabytes a second (0 for no limit)",
+                    metavar="MB")
+
+  parser.add_option("--sample",
+                    dest = "sample",
+                    type = "int",
+                    help = "--verify COUNT files picked at random instead of all of them",
+                    metavar="COUNT")
+
+  parser.add_option("--restart",
+                    action = "store_true",
+                    dest = "restart",
+                    default = False,
+                    help = "start --verify from the beginning rather than where it last stopped")
+
+  parser.add_option("--chunk-report",
+                    action = "store_true",
+                    dest = "chunkReport",
+                    default = False,
+                    help = "Report the data shared between files chunked under a --chunking mount")
+
+  parser.add_option("--changes-since",
+                    dest = "changesSince",
+                    type = "int",
+                    help = "Print the net change to every file changed after change SEQ as JSON lines " +
+                           "(0 for every file); exits with status 3 if those changes were pruned",
+                    metavar="SEQ")
+
+  parser.add_option("--prune-changes",
+                    dest = "pruneChanges",
+                    type = "float",
+                    help = "Remove the changes logged more than DAYS days ago",
+                    metavar="DAYS")
+
+  parser.add_option("--compact-changes",
+                    action = "store_true",
+                    dest = "compactChanges",
+                    default = False,
+                    help = "Remove the logged changes superseded by later ones, which --changes-since " +
+                           "doesn't need")
+
+  parser.add_option("--export",
+                    dest = "export",
+                    help = "Write the checksums of all files to FILE (- for standard output) as a manifest " +
+                           "in --format",
+                    metavar="FILE")
+
+  parser.add_option("--import",
+                    dest = "importFile",
+                    help = "Load the checksums in the manifest FILE (- for standard input) in --format, " +
+                           "as written by sha1sum/md5sum or --export, instead of hashing the files",
+                    metavar="FILE")
+
+  parser.add_option("--format",
+                    dest = "format",
+                    type = "choice",
+                    choices = MANIFEST_FORMATS,
+                    default = "sum",
+                    help = "manifest format for --export, --import and --diff: sum (as sha1sum prints it) or json " +
+                           "[default: %default]")
+
+  parser.add_option("--import-root",
+                    dest = "importRoot",
+                    help = "the directory relative paths in the --import manifest are under [default: the " +
+                           "current directory]; for a --diff manifest, the default is /",
+                    metavar="DIR")
+
+  parser.add_option("--trust",
+                    action = "store_true",
+                    dest = "trust",
+                    default = False,
+                    help = "--import entries without checking that the files exist and have the size and " +
+                           "mtime the manifest gives")
+
+  parser.add_option("--diff",
+                    dest = "diff",
+                    help = "Print the files missing, extra, changed (and with --match-digests, moved) in " +
+                           "the database or manifest OTHER as JSON lines, exiting 1 if there are any",
+                    metavar="OTHER")
+
+  parser.add_option("--diff-root",
+                    dest = "diffRoot",
+                    default = "/",
+                    help = "compare only the files below DIR with --diff [default: %default]",
+                    metavar="DIR")
+
+  parser.add_option("--other-root",
+                    dest = "otherRoot",
+                    default = "/",
+                    help = "the directory in OTHER that --diff-root is compared with [default: %default]",
+                    metavar="DIR")
+
+  parser.add_option("--match-digests",
+                    action = "store_true",
+                    dest = "matchDigests",
+                    default = False,
+                    help = "pair up files --diff finds missing and extra by checksum, reporting them as moved")
+
+  parser.add_option("--tree",
+                    dest = "tree",
+                    help = "Print the digest of the directory DIR, which is the same for any identical tree, " +
+                           "followed by those of the directories directly in it",
+                    metavar="DIR")
+
+  parser.add_option("--report",
+                    dest = "report",
+                    help = "Print the files and bytes below DIR, and the directories below it with the most " +
+                           "duplicated bytes",
+                    metavar="DIR")
+
+  parser.add_option("--top",
+                    dest = "top",
+                    type = "int",
+                    default = REPORT_TOP,
+                    help = "directories listed by --report [default: %default]",
+                    metavar="N")
 
   (options, args) = parser.parse_args()
 
@@ -252,15 +1839,138 @@ def main():
   if not os.path.exists(database):
     parser.error("%s does not exist" % database)
 
+  ignore = None
+  if None != options.ignoreFile:
+    try:
+      ignore = IgnoreRules.fromFile(options.ignoreFile, os.path.abspath(options.ignoreRoot))
+    except (IOError, ValueError) as einst:
+      parser.error(str(einst))
+
   sha1db = Sha1DB(database)
 
+  if None != options.importFile:
+    manifest = sys.stdin if options.importFile == "-" else open(options.importFile)
+    try:
+      root = os.path.abspath(options.importRoot) if options.importRoot else None
+      # a manifest file was made by the time it was last modified; a pipe doesn't say
+      st = os.fstat(manifest.fileno())
+      made = st.st_mtime if S_ISREG(st.st_mode) else None
+      (imported, skipped) = sha1db.importManifest(manifest, options.format, root, options.trust,
+                                                  made)
+    except ValueError as einst:
+      parser.error(str(einst))
+    finally:
+      if manifest != sys.stdin:
+        manifest.close()
+    print >> sys.stderr, "Imported %d checksums; skipped %d missing or changed files" % (imported,
+        skipped)
+
   # vacuum first, then dedup
   if options.vacuum:
-    sha1db.vacuum()
+    sha1db.vacuum(ignore)
+
+  if None != options.addAlgorithm:
+    try:
+      sha1db.addAlgorithm(options.addAlgorithm)
+    except ValueError as einst:
+      parser.error(str(einst))
+
+  if options.hashDirty:
+    sha1db.hashDirty()
+
+  if options.backfill:
+    sha1db.backfillAlgorithms()
 
   if None != options.dupdir:
     sha1db.dedup(options.dupdir, options.doSymlink)
 
+  if None != options.findDups:
+    (groups, totalBytes, readBytes) = sha1db.findDuplicates(os.path.abspath(options.findDups))
+    for paths in groups:
+      for path in paths:
+        print path
+      print
+    print >> sys.stderr, "%d groups of duplicates; read %d of %d bytes" % (len(groups), readBytes,
+        totalBytes)
+
+  if options.chunkReport:
+    printChunkReport(sha1db.chunkReport())
+
+  if None != options.pruneChanges:
+    print >> sys.stderr, "Pruned %d changes" % sha1db.pruneChanges(options.pruneChanges)
+
+  if options.compactChanges:
+    print >> sys.stderr, "Compacted away %d changes" % sha1db.compactChanges()
+
+  if None != options.changesSince:
+    try:
+      for change in sha1db.changesSince(options.changesSince):
+        print json.dumps(change, sort_keys=True)
+    except ValueError as einst:
+      print >> sys.stderr, str(einst)
+      sys.exit(3)
+
+  if None != options.export:
+    if options.export == "-":
+      sha1db.exportManifest(sys.stdout, options.format)
+    else:
+      with open(options.export, "wb") as out:
+        sha1db.exportManifest(out, options.format)
+
+  if None != options.diff:
+    if not os.path.exists(options.diff):
+      parser.error("%s does not exist" % options.diff)
+    manifestRoot = os.path.abspath(options.importRoot) if options.importRoot else "/"
+    differ = Differ(sha1db, options.diff, options.diffRoot, options.otherRoot, options.matchDigests,
+                    sys.stdout, options.format, manifestRoot)
+    try:
+      summary = differ.run()
+    except ValueError as einst:
+      parser.error(str(einst))
+    if any(summary[status] > 0 for status in ("missing", "extra", "changed", "moved")):
+      sys.exit(1)
+
+  if None != options.tree:
+    path = os.path.abspath(options.tree)
+    digest = sha1db.treeDigest(path)
+    if digest is None:
+      print >> sys.stderr, "No files below %s" % path
+      sys.exit(1)
+    print "%s  %s" % (digest, path)
+    for (child, digest) in sha1db.treeChildren(path):
+      print "%s  %s" % (digest, child)
+
+  if None != options.report:
+    path = os.path.abspath(options.report)
+    report = sha1db.dirReport(path, options.top)
+    if report is None:
+      print >> sys.stderr, "No files below %s" % path
+      sys.exit(1)
+    printDirReport(report)
+
+  if options.verify:
+    verifier = Verifier(sha1db, options.workers, int(options.bandwidth * 1048576), sys.stdout)
+    summary = verifier.run(options.sample, options.restart)
+    if summary["mismatch"] > 0 or summary["error"] > 0:
+      sys.exit(1)
+
+  if None != options.lookup:
+    path = os.path.abspath(options.lookup)
+    if not os.path.exists(path):
+      parser.error("%s does not exist" % path)
+    chksum = sha1db.freshChecksum(path)
+    if chksum is None:
+      print >> sys.stderr, "No current checksum for %s" % path
+      sys.exit(1)
+    print "%s  %s" % (chksum, path)
+    for (name, digest) in sorted(sha1db.lookupDigests(path).iteritems()):
+      if name != sha1db.checksumName:
+        print "%s  %s (%s)" % (digest, path, name)
+    merkle = sha1db.lookupMerkle(path)
+    st = os.stat(path)
+    if merkle is not None and merkle[2] == st.st_size and merkle[3] == st.st_mtime:
+      print "%s  %s (Merkle root of %d byte blocks)" % (merkle[0], path, merkle[1])
+
 
 if __name__ == '__main__':
   main()
@@ -0,0 +1,203 @@
+# Comparing two checksum databases, to check replicas and backups
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from fusesha1util import sqliteConn
+from pysqlite2 import dbapi2 as sqlite
+
+# Rows fetched from a database at a time, and spooled to the temporary database at a time
+FETCH_SIZE = 10000
+
+# What every SQLite database file starts with
+SQLITE_HEADER = "SQLite format 3\x00"
+
+def isDatabase(path):
+  """Returns whether path is an SQLite database (rather than, say, a manifest)."""
+  with open(path, "rb") as f:
+    return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+def checksumName(database):
+  """Returns the name of the checksum algorithm database was created with."""
+  with sqliteConn(database) as cursor:
+    cursor.execute("select chksum_type from versioning;")
+    for (name, ) in cursor:
+      return name
+  return None
+
+def filesInOrder(database, root="/"):
+  """Yields (path, digest) for every file (but not symlink) below root in database, in path order,
+  the paths relative to root (starting with /).  Rows are fetched FETCH_SIZE at a time."""
+  root = root.rstrip("/")
+  sql = "select path, chksum from files where symlink = 0"
+  args = []
+  if root:
+    # every path below root sorts between root + "/" and root + "0" ("0" follows "/"), and they
+    # stay in order with root taken off
+    sql += " and path > ? and path < ?"
+    args = [root + "/", root + "0"]
+  with sqliteConn(database) as cursor:
+    cursor.execute(sql + " order by path;", args)
+    while True:
+      rows = cursor.fetchmany(FETCH_SIZE)
+      if len(rows) <= 0:
+        break
+      for (path, chksum) in rows:
+        yield (path[len(root):], chksum)
+
+def mergeJoin(ours, theirs):
+  """Merge joins two streams of (key, value) in key order, yielding (key, ours, theirs) for every
+  key, with None for the side that doesn't have it."""
+  ours = iter(ours)
+  theirs = iter(theirs)
+  a = next(ours, None)
+  b = next(theirs, None)
+  while a is not None or b is not None:
+    if b is None or (a is not None and a[0] < b[0]):
+      yield (a[0], a[1], None)
+      a = next(ours, None)
+    elif a is None or b[0] < a[0]:
+      yield (b[0], None, b[1])
+      b = next(theirs, None)
+    else:
+      yield (a[0], a[1], b[1])
+      a = next(ours, None)
+      b = next(theirs, None)
+
+class Differ(object):
+  """Compares the files below root in the database of sha1db with those below otherRoot in other,
+  by their paths relative to the roots, and writes every difference to out as a JSON object per
+  line, followed by a summary object:
+
+    {"status": "missing", "path", "digest"}                  - only in sha1db
+    {"status": "extra", "path", "digest"}                    - only in other
+    {"status": "changed", "path", "digest", "otherDigest"}   - in both, with different content
+    {"status": "moved", "path", "otherPath", "digest"}       - with matchDigests, a file missing at
+                                                               path and extra at otherPath
+
+  Both databases are read in path order and merge joined, so memory use doesn't depend on their
+  size.  Without matchDigests the differences come out in path order.  With it, missing and extra
+  files are spooled to a temporary database on disk instead and merge joined by digest once the
+  rest is done, pairing them up as moves; what is left over follows them in digest order.
+
+  other may also be a manifest in format (see Sha1DB.exportManifest), which is first imported,
+  trusted, into a temporary database; its relative paths are taken to be below manifestRoot.
+
+    sha1db - the Sha1DB to compare
+    other - the database or manifest to compare with, which must use the same checksum algorithm
+    root, otherRoot - the directories compared in each
+    matchDigests - whether to match missing and extra files by digest
+    out - the file the differences are written to
+  """
+  def __init__(self, sha1db, other, root="/", otherRoot="/", matchDigests=False, out=None,
+               format="sum", manifestRoot="/"):
+    self.sha1db = sha1db
+    self.other = other
+    self.root = root
+    self.otherRoot = otherRoot
+    self.matchDigests = matchDigests
+    self.out = out
+    self.format = format
+    self.manifestRoot = manifestRoot
+    self.counts = dict((status, 0) for status in ("same", "missing", "extra", "changed", "moved"))
+
+  def run(self):
+    """Compares the databases, returning the summary.  Raises ValueError if other uses a different
+    checksum algorithm, or is a manifest with a bad line."""
+    start = time.time()
+    if isDatabase(self.other):
+      if checksumName(self.other) != self.sha1db.checksumName:
+        raise ValueError("%s uses %s checksums, not %s" % (self.other, checksumName(self.other),
+                                                           self.sha1db.checksumName))
+      return self._run(self.other, start)
+    tmpdir = tempfile.mkdtemp()
+    try:
+      # (sha1db imports this module, so its class is taken from the instance)
+      other = self.sha1db.__class__(os.path.join(tmpdir, "manifest.db"),
+                                    algorithm=self.sha1db.checksumName)
+      with open(self.other) as manifest:
+        other.importManifest(manifest, self.format, self.manifestRoot, True)
+      return self._run(other.database, start)
+    finally:
+      shutil.rmtree(tmpdir)
+
+  def _run(self, other, start):
+    spool = None
+    if self.matchDigests:
+      # "" opens a private temporary database, which SQLite keeps on disk and removes on close
+      spool = sqlite.connect("")
+      spool.execute("create table missing(digest varchar, path varchar);")
+      spool.execute("create table extra(digest varchar, path varchar);")
+    try:
+      self._compare(other, spool)
+      if spool is not None:
+        self._matchSpooled(spool)
+    finally:
+      if spool is not None:
+        spool.close()
+    summary = dict(self.counts)
+    summary.update({"status": "summary", "elapsed": time.time() - start})
+    self._write(summary)
+    return summary
+
+  # Merge joins the two databases by path, writing what changed and either writing or spooling
+  # what is missing and extra
+  def _compare(self, other, spool):
+    pending = {"missing": [], "extra": []}
+    for (path, ours, theirs) in mergeJoin(filesInOrder(self.sha1db.database, self.root),
+                                          filesInOrder(other, self.otherRoot)):
+      if ours == theirs:
+        self.counts["same"] += 1
+      elif ours is not None and theirs is not None:
+        self._result({"status": "changed", "path": path, "digest": ours, "otherDigest": theirs})
+      else:
+        status = "extra" if ours is None else "missing"
+        if spool is None:
+          self._result({"status": status, "path": path, "digest": ours or theirs})
+          continue
+        pending[status].append((ours or theirs, path))
+        if len(pending[status]) >= FETCH_SIZE:
+          spool.executemany("insert into %s values(?, ?);" % status, pending[status])
+          pending[status] = []
+    if spool is not None:
+      for (status, rows) in pending.iteritems():
+        spool.executemany("insert into %s values(?, ?);" % status, rows)
+      spool.commit()
+
+  # Pairs up spooled missing and extra files with the same digest as moves, in digest then path
+  # order, writing whatever is left as missing or extra
+  def _matchSpooled(self, spool):
+    spool.execute("create index missing_idx on missing(digest, path);")
+    spool.execute("create index extra_idx on extra(digest, path);")
+    missing = spool.cursor().execute("select digest, path from missing order by digest, path;")
+    extra = spool.cursor().execute("select digest, path from extra order by digest, path;")
+    m = missing.fetchone()
+    e = extra.fetchone()
+    while m is not None or e is not None:
+      if e is None or (m is not None and m[0] < e[0]):
+        self._result({"status": "missing", "path": m[1], "digest": m[0]})
+        m = missing.fetchone()
+      elif m is None or e[0] < m[0]:
+        self._result({"status": "extra", "path": e[1], "digest": e[0]})
+        e = extra.fetchone()
+      else:
+        self._result({"status": "moved", "path": m[1], "otherPath": e[1], "digest": m[0]})
+        m = missing.fetchone()
+        e = extra.fetchone()
+
+  def _result(self, result):
+    self.counts[result["status"]] += 1
+    self._write(result)
+
+  def _write(self, obj):
+    if self.out is not None:
+      self.out.write(json.dumps(obj, sort_keys=True) + "\n")
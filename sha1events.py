@@ -0,0 +1,228 @@
+# Change events: a live stream of the checksum updates made through the mount
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import errno
+import fcntl
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from collections import deque
+from stat import S_ISFIFO
+
+from fusesha1util import removeStaleSocket
+from sha1stats import STATS
+
+# Events queued for each subscriber before new ones are dropped
+BUFFER_SIZE = 10000
+
+# Seconds between checks for a stop while waiting for a subscriber or a FIFO reader
+POLL_INTERVAL = 0.5
+
+# Seconds join gives subscribers to take the events still queued for them; a socket subscriber
+# that hasn't by then is disconnected, and a FIFO writer is left to die with the process
+JOIN_TIMEOUT = 5.0
+
+class EventPublisher(object):
+  """Publishes change events to subscribers on a Unix socket at path or, if path is an existing
+  FIFO, to whatever reads the FIFO.  Each event is one line of JSON with the fields that apply:
+
+    {"seq": 12, "op": "update", "path": "/root/a.txt", "digest": "...", "size": 3, "mtime": 1.5}
+
+  op is update (a new checksum), dirty (changed, to be hashed later), remove or rename (with
+  oldPath); seq counts every event published.  publish only queues the event: every subscriber has
+  a thread of its own writing its queue out, so a slow or stuck subscriber never holds up the
+  mount.  Once bufferSize events are waiting for a subscriber, further events for it are dropped
+  until it catches up, when it is sent {"seq": N, "op": "overflow", "dropped": count} in their
+  place, N being the last one dropped.  Everything it knew about may have changed since, so it
+  should rescan (or look at the files it cares about again) before carrying on.
+
+    path - Unix socket to create, or FIFO to write to
+    bufferSize - the most events queued for one subscriber
+  """
+  def __init__(self, path, bufferSize=BUFFER_SIZE):
+    self.path = path
+    self.bufferSize = bufferSize
+    self.seq = 0
+    self.lock = threading.Lock()
+    self.subscribers = []
+    self.stopped = threading.Event()
+    self.listener = None
+    if os.path.exists(path) and S_ISFIFO(os.stat(path).st_mode):
+      self.thread = Subscriber(self, fifo=path)
+      self.subscribers.append(self.thread)
+    else:
+      removeStaleSocket(path)
+      self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      self.listener.bind(path)
+      os.chmod(path, 0600)
+      self.listener.listen(5)
+      self.listener.settimeout(POLL_INTERVAL)
+      self.thread = threading.Thread(target=self._accept, name="EventPublisher")
+      self.thread.daemon = True
+
+  def start(self):
+    self.thread.start()
+
+  def stop(self):
+    self.stopped.set()
+    with self.lock:
+      for subscriber in self.subscribers:
+        subscriber.wake()
+
+  def join(self):
+    deadline = time.time() + JOIN_TIMEOUT
+    self.thread.join(JOIN_TIMEOUT)
+    with self.lock:
+      subscribers = list(self.subscribers)
+    for subscriber in subscribers:
+      subscriber.join(max(deadline - time.time(), 0))
+      subscriber.disconnect()
+    if self.listener is not None:
+      self.listener.close()
+      try:
+        os.remove(self.path)
+      except OSError:
+        pass
+
+  def publish(self, op, path, oldPath=None, digest=None, size=None, mtime=None):
+    """Queues an event for every subscriber.  Never blocks on a subscriber."""
+    with self.lock:
+      self.seq += 1
+      event = {"seq": self.seq, "op": op, "path": path}
+      for (name, value) in (("oldPath", oldPath), ("digest", digest), ("size", size),
+                            ("mtime", mtime)):
+        if value is not None:
+          event[name] = value
+      for subscriber in self.subscribers:
+        subscriber.queue(event)
+    STATS.count("events.published")
+
+  def unsubscribe(self, subscriber):
+    with self.lock:
+      if subscriber in self.subscribers:
+        self.subscribers.remove(subscriber)
+
+  # Accepts subscribers on the socket until stopped
+  def _accept(self):
+    while not self.stopped.is_set():
+      try:
+        (connection, address) = self.listener.accept()
+      except socket.timeout:
+        continue
+      except socket.error as einst:
+        logging.error("Event socket %s failed: %s" % (self.path, einst))
+        return
+      connection.settimeout(None)
+      subscriber = Subscriber(self, connection=connection)
+      with self.lock:
+        self.subscribers.append(subscriber)
+      subscriber.start()
+      STATS.count("events.subscribers")
+
+class Subscriber(threading.Thread):
+  """Daemon thread writing the events queued for one subscriber: a connection to the socket, or a
+  FIFO, which is (re)opened whenever there is a reader.  Events queued while nobody reads the FIFO
+  are kept, up to the publisher's bufferSize."""
+  def __init__(self, publisher, connection=None, fifo=None):
+    threading.Thread.__init__(self, name="EventSubscriber")
+    self.daemon = True
+    self.publisher = publisher
+    self.connection = connection
+    self.fifo = fifo
+    self.events = deque()
+    self.dropped = 0
+    self.condition = threading.Condition()
+
+  def queue(self, event):
+    with self.condition:
+      # room is kept for the overflow marker that has to go before the next event
+      if len(self.events) + (2 if self.dropped > 0 else 1) > self.publisher.bufferSize:
+        self.dropped += 1
+        STATS.count("events.dropped")
+        return
+      if self.dropped > 0:
+        self.events.append({"seq": event["seq"] - 1, "op": "overflow", "dropped": self.dropped})
+        self.dropped = 0
+      self.events.append(event)
+      self.condition.notify()
+
+  def disconnect(self):
+    """Shuts down the subscriber's connection, interrupting a write it is stuck in."""
+    if self.connection is not None:
+      try:
+        self.connection.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+        pass
+
+  def wake(self):
+    with self.condition:
+      self.condition.notify()
+
+  def run(self):
+    try:
+      while not self.publisher.stopped.is_set():
+        out = self.connection or self._openFifo()
+        if out is None:
+          break
+        written = self._write(out)
+        if self.fifo is None:
+          break
+        os.close(out)
+        if not written:
+          # the reader went away; events wait for the next one
+          STATS.count("events.disconnects")
+    finally:
+      self.publisher.unsubscribe(self)
+      if self.connection is not None:
+        self.connection.close()
+
+  # Writes queued events to out until it stops accepting them (returning false) or the publisher
+  # is stopped
+  def _write(self, out):
+    while True:
+      with self.condition:
+        while len(self.events) <= 0 and not self.publisher.stopped.is_set():
+          self.condition.wait(POLL_INTERVAL)
+        if len(self.events) <= 0:
+          return True
+        events = list(self.events)
+        self.events.clear()
+      data = "".join(json.dumps(event, separators=(",", ":")) + "\n" for event in events)
+      try:
+        if self.connection is not None:
+          self.connection.sendall(data)
+        else:
+          while len(data) > 0:
+            data = data[os.write(out, data):]
+      except EnvironmentError as einst:
+        if einst.errno not in (errno.EPIPE, errno.ECONNRESET):
+          logging.error("Unable to write events: %s" % einst)
+        # some of them may not have been read, so the next FIFO reader starts with an overflow
+        with self.condition:
+          self.dropped += len(events)
+        return False
+
+  # Waits for a reader to open the FIFO, returning the descriptor to write to, or None if the
+  # publisher was stopped first
+  def _openFifo(self):
+    while not self.publisher.stopped.is_set():
+      try:
+        fd = os.open(self.fifo, os.O_WRONLY | os.O_NONBLOCK)
+      except OSError as einst:
+        if einst.errno != errno.ENXIO:
+          raise
+        self.publisher.stopped.wait(POLL_INTERVAL)
+        continue
+      # writes block once a reader is there, as they would on the socket
+      fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+      return fd
+    return None
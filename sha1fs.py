@@ -16,7 +16,7 @@
 #    See the file COPYING.
 #
 
-import os, sys
+import os, sys, time
 from os.path import join
 from errno import *
 from stat import *
@@ -33,8 +33,16 @@ import xmp
 from xmp import Xmp
 from xmp import flag2mode
 
-from fusesha1util import ewrap
-from sha1db import Sha1DB
+from fusesha1util import ewrap, LRUCache
+from sha1db import Sha1DB, TREE_BATCH
+from sha1events import EventPublisher
+from sha1handle import FileHandle
+from sha1idle import IdleWorker
+from sha1ignore import IgnoreRules
+from sha1query import QueryServer, QueryService
+from sha1rescan import Rescanner
+from sha1stats import STATS
+from sha1trace import TraceRecorder
 
 from pysqlite2 import dbapi2 as sqlite
 import logging
@@ -44,6 +52,16 @@ import logging
 LOG_FILENAME = "LOG"
 logging.basicConfig(filename=LOG_FILENAME,level=logging.INFO,)
 
+# Reserved directory in the mount for files generated by the filesystem itself.  Nothing under it
+# is mirrored from the root, and it is not listed in the mount's top level directory.
+VIRTUAL_DIR = "/.sha1fs"
+
+# Content addressed view of the mount.  BY_HASH_DIR/ab/<checksum> (and BY_HASH_DIR/<checksum>) is a
+# symlink to one file with that checksum; listing BY_HASH_DIR/ab shows every checksum starting
+# with "ab".
+BY_HASH_DIR = VIRTUAL_DIR + "/by-hash"
+HEX_DIGITS = "0123456789abcdef"
+
 # Converts OS R/W flags to filesystem R/W flags; here to support access controls
 def flag2accessflag(flags):
   md = {os.O_RDONLY: os.R_OK, os.O_WRONLY: os.W_OK, os.O_RDWR: (os.W_OK | os.R_OK)}
@@ -51,6 +69,34 @@ def flag2accessflag(flags):
 
   return m
 
+# Builds a stat result for an entry under VIRTUAL_DIR
+def virtualStat(mode, size=0):
+  now = int(time.time())
+  st = fuse.Stat()
+  st.st_mode = mode
+  st.st_ino = 0
+  st.st_dev = 0
+  st.st_nlink = 2 if S_ISDIR(mode) else 1
+  st.st_uid = os.getuid()
+  st.st_gid = os.getgid()
+  st.st_size = size
+  st.st_atime = now
+  st.st_mtime = now
+  st.st_ctime = now
+  return st
+
+# File handle for the generated files under VIRTUAL_DIR.  The contents are captured at open time
+# so that a reader sees a single consistent snapshot.
+class VirtualFile(object):
+  # the size reported by getattr is stale by the time the file is read, so bypass the page cache
+  direct_io = True
+
+  def __init__(self, contents):
+    self.contents = contents
+
+  def read(self, size, offset):
+    return self.contents[offset:offset + size]
+
 # The required FUSE class
 class Sha1FS(Xmp):
   def __init__(self, *args, **kw):
@@ -62,14 +108,43 @@ class Sha1FS(Xmp):
     self.database = None
     self.root = None
     self.useMd5 = False
-
-  # Initializes the database for this class.  If rescan is enabled, this will scan for new/updated files
-  # The latter operates on the root filesystem directly here as it is basically a non FUSE operation
+    self.algorithm = None
+    self.trace = None
+    self.traceRecorder = None
+    self.readahead = 0
+    self.mmapReads = False
+    self.writeBuffer = 0
+    self.maxWrite = 0
+    self.xattrRehash = False
+    self.xattrCacheSize = 65536
+    self.lazy = False
+    self.idleInterval = 5.0
+    self.idleWorker = None
+    self.merkleBlocksize = 0
+    self.chunking = False
+    self.verifyReads = False
+    self.ignoreFile = None
+    self.ignore = None
+    self.rescanner = None
+    self.querySocket = None
+    self.queryServer = None
+    self.eventsPath = None
+    self.eventPublisher = None
+
+    # Generated files under VIRTUAL_DIR, keyed by path, with the function producing their contents
+    self.virtualFiles = {VIRTUAL_DIR + "/stats": STATS.toJson}
+
+  # Initializes the database for this class.  If rescan is enabled, fsinit starts scanning for
+  # new/updated files once the filesystem is mounted.  The scan operates on the root filesystem
+  # directly as it is basically a non FUSE operation
   def initDB(self):
-    self.sha1db = Sha1DB(self.database, self.useMd5)
-
-    if (self.rescan):
-      self.sha1db.updateAllChecksums(self.root)
+    self.sha1db = Sha1DB(self.database, self.useMd5, self.chunking, self.algorithm)
+    # checksums served through getxattr, keyed by path, as (checksum, size, mtime)
+    self.xattrCache = LRUCache(self.xattrCacheSize)
+    if self.ignoreFile:
+      self.ignore = IgnoreRules.fromFile(self.ignoreFile, self.root)
+    else:
+      self.ignore = IgnoreRules(root=self.root)
 
   def getattr(self, path):
     """
@@ -80,7 +155,9 @@ class Sha1FS(Xmp):
     errno code if another error occurs.
     """
     with ewrap("getattr"):
-      if os.path.exists("." + path):
+      if self._isVirtual(path):
+        return self._virtualGetattr(path)
+      elif os.path.exists("." + path):
         logging.debug("getattr: %s" % path)
         return Xmp.getattr(self, path)
       else:
@@ -95,6 +172,9 @@ class Sha1FS(Xmp):
     """
     with ewrap("readlink"):
       logging.debug("readlink: %s" % path)
+      if self._isVirtual(path):
+        target = self._byHashTarget(path)
+        return target if target is not None else -ENOENT
       return Xmp.readlink(self, path)
 
   def readdir(self, path, offset):
@@ -111,18 +191,25 @@ class Sha1FS(Xmp):
     """
     with ewrap("readdir"):
       logging.debug("readdir: %s (offset %s)" % (path, offset))
+      if self._isVirtual(path):
+        return self._virtualReaddir(path)
       return Xmp.readdir(self, path, offset)
 
   def unlink(self, path):
     """Deletes a file."""
     with ewrap("unlink"):
+      if self._isVirtual(path):
+        return -EROFS
       logging.debug("unlink: %s" % path)
       Xmp.unlink(self, path)
+      self.xattrCache.discard(path)
       self.sha1db.removeChecksum(self.root + path)
 
   def rmdir(self, path):
     """Deletes a directory."""
     with ewrap("rmdir"):
+      if self._isVirtual(path):
+        return -EROFS
       logging.debug("rmdir: %s" % path)
       Xmp.rmdir(self, path)
 
@@ -146,6 +233,8 @@ class Sha1FS(Xmp):
     on the target system unless followed).
     """
     with ewrap("symlink"):
+      if self._isVirtual(name):
+        return -EROFS
       logging.debug("symlink: target %s, name: %s" % (target, name))
       Xmp.symlink(self, target, name)
 
@@ -159,8 +248,12 @@ class Sha1FS(Xmp):
     manually copy and delete the file, and this method will not be called.
     """
     with ewrap("rename"):
+      if self._isVirtual(old) or self._isVirtual(new):
+        return -EROFS
       logging.debug("rename: target %s, name: %s" % (self.root + old, self.root + new))
       Xmp.rename(self, old, new)
+      # old may be a directory, so every cached path under it is suspect
+      self.xattrCache.clear()
       self.sha1db.updatePath(self.root + old, self.root + new)
 
   def link(self, target, name):
@@ -170,24 +263,32 @@ class Sha1FS(Xmp):
     supported.
     """
     with ewrap("link"):
+      if self._isVirtual(name):
+        return -EROFS
       logging.debug("link: target %s, name: %s" % (target, name))
       Xmp.link(self, target, name)
 
   def chmod(self, path, mode):
     """Changes the mode of a file or directory."""
     with ewrap("chmod"):
+      if self._isVirtual(path):
+        return -EROFS
       logging.debug("chmod: %s (mode %s)" % (path, oct(mode)))
       Xmp.chmod(self, path, mode)
 
   def chown(self, path, user, group):
     """Changes the owner of a file or directory."""
     with ewrap("chown"):
+      if self._isVirtual(path):
+        return -EROFS
       logging.debug("chown: %s (uid %s, gid %s)" % (path, user, group))
       Xmp.chown(self, path, user, group)
 
   def truncate(self, path, len):
     # rewritten to ensure file closing
     with ewrap("truncate"):
+      if self._isVirtual(path):
+        return -EROFS
       with file("." + path, "a") as f:
         f.truncate(len)
 
@@ -218,6 +319,8 @@ class Sha1FS(Xmp):
     #   new files and directories, because they should be owned by this
     #   user/group.
     with ewrap("mknod"):
+      if self._isVirtual(path):
+        return -EROFS
       logging.debug("mknod: %s (mode %s, rdev %s)" % (path, oct(mode), rdev))
       Xmp.mknod(self, path, mode, rdev)
 
@@ -230,6 +333,8 @@ class Sha1FS(Xmp):
     # Should be S_IDIR (040000); I guess you can assume this.
     # Also see note about self.GetContext() in mknod.
     with ewrap("mkdir"):
+      if self._isVirtual(path):
+        return -EROFS
       logging.debug("mkdir: %s (mode %s)" % (path, oct(mode)))
       Xmp.mkdir(self, path, mode)
 
@@ -240,6 +345,8 @@ class Sha1FS(Xmp):
     Deprecated in favour of utimens.
     """
     with ewrap("utime"):
+      if self._isVirtual(path):
+        return -EROFS
       atime, mtime = times
       logging.debug("utime: %s (atime %s, mtime %s)" % (path, atime, mtime))
       Xmp.utime(self, path, times)
@@ -258,11 +365,50 @@ class Sha1FS(Xmp):
     # rewritten to use flag2accessflag and explicitly return 0 in the case of allowed access
     with ewrap("access"):
       logging.debug("access: %s (flags %s)" % (path, oct(flags)))
-      if not os.access("." + path, flag2accessflag(flags)):
+      if self._isVirtual(path):
+        return -EACCES if (flags & os.W_OK) else 0
+      elif not os.access("." + path, flag2accessflag(flags)):
         return -EACCES
       else:
         return 0
 
+  def getxattr(self, path, name, size):
+    """
+    Gets the value of an extended attribute.  The stored checksum of a
+    regular file is served as user.sha1 (or user.md5) without reading the
+    file, provided the file's size and mtime still match the ones recorded
+    with the checksum.  Returns -errno.ENODATA for any other attribute and
+    for files whose checksum is missing or stale (unless --xattr-rehash was
+    given, in which case stale checksums are recalculated first).
+    size: 0 to ask for the size of the value, otherwise the buffer size.
+    """
+    with ewrap("getxattr"):
+      logging.debug("getxattr: %s (name %s, size %s)" % (path, name, size))
+      if self._isVirtual(path) or name != self._xattrName():
+        return -ENODATA
+      value = self._xattrChecksum(path)
+      if value is None:
+        return -ENODATA
+      if size == 0:
+        return len(value)
+      return value
+
+  def listxattr(self, path, size):
+    """
+    Lists the names of the extended attributes of a file.  Regular files
+    always list their checksum attribute, even if getxattr will find it
+    stale.
+    size: 0 to ask for the joint size of the names plus null separators.
+    """
+    with ewrap("listxattr"):
+      logging.debug("listxattr: %s (size %s)" % (path, size))
+      names = []
+      if not self._isVirtual(path) and S_ISREG(os.lstat("." + path).st_mode):
+        names.append(self._xattrName())
+      if size == 0:
+        return len("".join(names)) + len(names)
+      return names
+
   def statfs(self):
     """
     Should return an object with statvfs attributes (f_bsize, f_frsize...).
@@ -307,8 +453,43 @@ class Sha1FS(Xmp):
       #   logging.debug("xyz not set")
 
       Xmp.fsinit(self)
+      if self.eventsPath:
+        # first, so that the background work below is published too
+        self.eventPublisher = EventPublisher(self.eventsPath)
+        self.eventPublisher.start()
+        self.sha1db.events = self.eventPublisher
+      deferred = self.lazy or self.merkleBlocksize > 0
+      if (deferred or self.sha1db.incompleteAlgorithms()) and self.idleInterval > 0:
+        # hash the files marked dirty on release, and fill in the digests of newly added
+        # algorithms, once the filesystem goes quiet
+        self.idleWorker = IdleWorker(self._idleWork, self.idleInterval)
+        self.idleWorker.start()
+      if self.rescan:
+        # hash everything under the root in the background, rather than keeping the mountpoint
+        # unavailable until it is done
+        self.rescanner = Rescanner(self.sha1db, self.root, self.ignore)
+        self.virtualFiles[VIRTUAL_DIR + "/rescan"] = self.rescanner.statusJson
+        self.rescanner.start()
+      if self.querySocket:
+        self.queryServer = QueryServer(self.querySocket, QueryService(self.sha1db))
+        self.queryServer.start()
       logging.debug("Filesystem %s mounted" % self.root)
 
+  def fsdestroy(self):
+    """
+    Will be called when the filesystem is unmounted.  Dumps the operation
+    statistics to the LOG.
+    """
+    with ewrap("fsdestroy"):
+      STATS.logSummary()
+      for worker in (self.idleWorker, self.rescanner, self.queryServer, self.eventPublisher):
+        if worker:
+          worker.stop()
+          worker.join()
+      if self.traceRecorder:
+        self.traceRecorder.close()
+      logging.debug("Filesystem %s unmounted" % self.root)
+
   ### FILE OPERATION METHODS ###
   # Methods in this section are operations for opening files and working on
   # open files.
@@ -341,7 +522,12 @@ class Sha1FS(Xmp):
       mode = flag2mode(flags)
       logging.debug("open: %s (flags %s) (mode %s)" % (path, oct(flags), mode))
 
-      fh = os.fdopen(os.open("." + path, flags), flag2mode(flags))
+      if self._isVirtual(path):
+        return self._virtualOpen(path, flags)
+
+      fh = FileHandle(os.fdopen(os.open("." + path, flags), flag2mode(flags)), flags,
+                      self.readahead, self.mmapReads, self.writeBuffer,
+                      self.sha1db.checksum if self.verifyReads else None)
 
       if fh is None:
         return -ENOENT
@@ -387,10 +573,13 @@ class Sha1FS(Xmp):
     available (and it is a non-blocking read), return -errno.EAGAIN.
     If it is a blocking read, just block until ready.
     """
-    with ewrap("read"):
+    with ewrap("read") as op:
       logging.debug("read: %s (size %s, offset %s, fh %s)" % (path, size, offset, fh))
-      fh.seek(offset)
-      return fh.read(size)
+      if isinstance(fh, VirtualFile):
+        return fh.read(size, offset)
+      data = fh.read(size, offset)
+      op.addBytes(len(data))
+      return data
 
   def write(self, path, buf, offset, fh=None):
     """
@@ -406,11 +595,14 @@ class Sha1FS(Xmp):
     be equal to len(buf) unless an error occured). May also be a negative
     int, which is an errno code.
     """
-    with ewrap("write"):
+    with ewrap("write") as op:
       logging.debug("write: %s (offset %s, fh %s)" % (path, offset, fh))
-      logging.debug("  buf: %r" % buf)
-      fh.seek(offset)
-      fh.write(buf)
+      # formatted lazily; formatting every buffer up front costs more than the write itself
+      logging.debug("  buf: %r", buf)
+      if isinstance(fh, VirtualFile):
+        return -EBADF
+      fh.write(buf, offset)
+      op.addBytes(len(buf))
       return len(buf)
 
   def fgetattr(self, path, fh=None):
@@ -421,7 +613,9 @@ class Sha1FS(Xmp):
     """
     with ewrap("fgetattr"):
       logging.debug("fgetattr: %s (fh %s)" % (path, fh))
-      return os.fstat(fh.fileno())
+      if isinstance(fh, VirtualFile):
+        return virtualStat(S_IFREG | 0444, len(fh.contents))
+      return fh.fstat()
 
   def ftruncate(self, path, size, fh=None):
     """
@@ -431,6 +625,8 @@ class Sha1FS(Xmp):
     """
     with ewrap("ftruncate"):
       logging.debug("ftruncate: %s (size %s, fh %s)" % (path, size, fh))
+      if isinstance(fh, VirtualFile):
+        return -EROFS
       fh.truncate(size)
 
   def _fflush(self, fh):
@@ -445,6 +641,8 @@ class Sha1FS(Xmp):
     """
     with ewrap("flush"):
       logging.debug("flush: %s (fh %s)" % (path, fh))
+      if isinstance(fh, VirtualFile):
+        return
       self._fflush(fh)
       # cf. xmp_flush() in fusexmp_fh.c
       os.close(os.dup(fh.fileno()))
@@ -456,21 +654,46 @@ class Sha1FS(Xmp):
     """
     with ewrap("release"):
       logging.debug("release: %s (flags %s, fh %s)" % (path, oct(flags), fh))
+      if isinstance(fh, VirtualFile):
+        return
       fh.close()
-
-      if not self._blacklisted(path):
-        saved = False
-        count = 0
-        while (not saved and count < 5):
-          count += 1
-          try:
+      self.xattrCache.discard(path)
+
+      if self._ignored(path):
+        STATS.count("ignore.release")
+        return
+
+      if self._verifyRead(path, fh) is not None:
+        # either the stored checksum is right, or it is the evidence of corruption
+        return
+
+      writable = (flags & (os.O_WRONLY | os.O_RDWR)) != 0
+      deferred = self.lazy or self.merkleBlocksize > 0
+      if deferred and not writable:
+        # nothing was written; only files never seen before need recording
+        if self.sha1db.lookupChecksum(self.root + path) is not None:
+          return
+
+      saved = False
+      count = 0
+      while (not saved and count < 5):
+        count += 1
+        try:
+          if self.merkleBlocksize > 0:
+            # rehash only the blocks written through this handle; the whole file checksum is
+            # left to be calculated lazily
+            self.sha1db.updateBlocks(self.root + path, self.merkleBlocksize,
+                                     fh.dirtyRanges if writable else None, fh.openStat)
+          if deferred:
+            self.sha1db.markDirty(self.root + path)
+          else:
             self.sha1db.updateChecksum(self.root + path)
-            saved = True
-          except Exception as einst:
-            logging.warn("Update failed; trying again")
+          saved = True
+        except Exception as einst:
+          logging.warn("Update failed; trying again")
 
-        if not saved:
-          logging.error("Unable to update checksum; quitting")
+      if not saved:
+        logging.error("Unable to update checksum; quitting")
 
   def fsync(self, path, datasync, fh=None):
     """
@@ -479,15 +702,138 @@ class Sha1FS(Xmp):
     """
     with ewrap("fsync"):
       logging.debug("fsync: %s (datasync %s, fh %s)" % (path, datasync, fh))
+      if isinstance(fh, VirtualFile):
+        return
       self._fflush(fh)
       if datasync and hasattr(os, 'fdatasync'):
         os.fdatasync(fh.fileno())
       else:
         os.fsync(fh.fileno())
 
-  def _blacklisted(self, path):
-    """Returns true if the path should not be kept in the checksum list."""
-    return path.find(".Trash") >= 0
+  def _isVirtual(self, path):
+    """Returns true if the path is in the reserved VIRTUAL_DIR namespace."""
+    return path == VIRTUAL_DIR or path.startswith(VIRTUAL_DIR + "/")
+
+  def _virtualGetattr(self, path):
+    if path in (VIRTUAL_DIR, BY_HASH_DIR) or self._byHashPrefix(path) is not None:
+      return virtualStat(S_IFDIR | 0555)
+    elif path in self.virtualFiles:
+      return virtualStat(S_IFREG | 0444, len(self.virtualFiles[path]()))
+    target = self._byHashTarget(path)
+    if target is not None:
+      return virtualStat(S_IFLNK | 0777, len(target))
+    return -ENOENT
+
+  def _virtualReaddir(self, path):
+    prefix = self._byHashPrefix(path)
+    if path != VIRTUAL_DIR and path != BY_HASH_DIR and prefix is None:
+      # not a directory
+      return
+    yield fuse.Direntry(".")
+    yield fuse.Direntry("..")
+    if path == VIRTUAL_DIR:
+      yield fuse.Direntry(os.path.basename(BY_HASH_DIR))
+    elif path == BY_HASH_DIR:
+      for a in HEX_DIGITS:
+        for b in HEX_DIGITS:
+          yield fuse.Direntry(a + b)
+    else:
+      for chksum in self.sha1db.checksumsWithPrefix(prefix, self.root):
+        yield fuse.Direntry(str(chksum))
+    for vpath in sorted(self.virtualFiles.keys()):
+      if os.path.dirname(vpath) == path:
+        yield fuse.Direntry(os.path.basename(vpath))
+
+  def _byHashPrefix(self, path):
+    """Returns the prefix if path is one of the two digit prefix directories in BY_HASH_DIR."""
+    if os.path.dirname(path) == BY_HASH_DIR:
+      prefix = os.path.basename(path)
+      if len(prefix) == 2 and prefix[0] in HEX_DIGITS and prefix[1] in HEX_DIGITS:
+        return prefix
+    return None
+
+  def _byHashTarget(self, path):
+    """Returns the symlink target for a checksum under BY_HASH_DIR, or None if path isn't one or
+    no file under the root has that checksum.  Targets are relative, so they resolve inside the
+    mount wherever it is mounted."""
+    parent = os.path.dirname(path)
+    chksum = os.path.basename(path)
+    if parent == BY_HASH_DIR:
+      up = "../../"
+    elif self._byHashPrefix(parent) is not None and chksum.startswith(os.path.basename(parent)):
+      up = "../../../"
+    else:
+      return None
+    if len(chksum) != self.sha1db.checksum().digest_size * 2:
+      return None
+    paths = self.sha1db.pathsForChecksum(chksum, self.root, 1)
+    if len(paths) <= 0:
+      return None
+    return up + paths[0][len(self.root) + 1:]
+
+  def _virtualOpen(self, path, flags):
+    if not path in self.virtualFiles:
+      return -ENOENT
+    if flags & (os.O_WRONLY | os.O_RDWR):
+      return -EACCES
+    return VirtualFile(self.virtualFiles[path]())
+
+  def _xattrName(self):
+    return "user." + self.sha1db.checksumName
+
+  def _xattrChecksum(self, path):
+    """Returns the checksum served through getxattr for path, or None if it is missing or stale."""
+    st = os.lstat("." + path)
+    if not S_ISREG(st.st_mode):
+      return None
+    cached = self.xattrCache.get(path)
+    if cached is not None and cached[1] == st.st_size and cached[2] == st.st_mtime:
+      return cached[0]
+
+    chksum = self.sha1db.freshChecksum(self.root + path, self.xattrRehash)
+    if chksum is not None:
+      self.xattrCache.put(path, (chksum, st.st_size, st.st_mtime))
+    return chksum
+
+  def _verifyRead(self, path, fh):
+    """Compares the checksum of a file read through fh from start to end with the stored one.
+    Returns true if they match, false if they don't although the file is unchanged since it was
+    hashed (i.e. it is corrupt), and None if the file wasn't read in full or can't be checked."""
+    (digest, hashed) = fh.readDigest()
+    if digest is None:
+      return None
+    entry = self.sha1db.lookupChecksum(self.root + path)
+    if entry is None:
+      return None
+    (chksum, size, mtime) = entry
+    st = os.stat("." + path)
+    if not (hashed == size == st.st_size == fh.openStat.st_size and
+            mtime == st.st_mtime == fh.openStat.st_mtime):
+      return None
+    if digest != chksum:
+      logging.error("Corruption: %s has %s %s, but %s was stored" % (path, self.sha1db.checksumName,
+                    digest, chksum))
+      STATS.count("verify.mismatch")
+      return False
+    STATS.count("verify.ok")
+    return True
+
+  def _idleWork(self):
+    """Does one file's worth of deferred hashing, or folds a batch of changes into the directory
+    digests, returning false if there was nothing to do."""
+    return self.sha1db.hashDirty(1) > 0 or self.sha1db.backfillAlgorithms(1) > 0 or \
+        self.sha1db.updateTrees(TREE_BATCH) > 0
+
+  def _ignored(self, path):
+    """Returns true if the ignore rules say the file at path should not be kept in the checksum
+    list.  The file is only stat'ed when there are size rules."""
+    size = None
+    if self.ignore.needsSize:
+      try:
+        size = os.stat(self.root + path).st_size
+      except OSError:
+        pass
+    return self.ignore.ignored(self.root + path, size)
 
   def main(self, *a, **kw):
     #self.file_class = self.Sha1File
@@ -514,7 +860,8 @@ Userspace SHA1 checksum FS: mirror the filesystem tree, adding and updating file
                          action = "store_true",
                          dest = "rescan",
                          default = False,
-                         help = "(Re)calculate checksums at mount time.")
+                         help = "(Re)calculate checksums in the background once mounted; progress is " +
+                                "in .sha1fs/rescan and the LOG.")
 
   server.parser.add_option("--use-md5",
                          action = "store_true",
@@ -522,7 +869,115 @@ Userspace SHA1 checksum FS: mirror the filesystem tree, adding and updating file
                          default = False,
                          help = "Use the (faster) MD5 checksum instead of SHA1.")
 
+  server.parser.add_option("--algorithm",
+                         dest = "algorithm",
+                         help = "checksum a new database with the hashlib ALGORITHM (e.g. sha256) " +
+                                "instead of SHA1",
+                         metavar="ALGORITHM")
+
+  server.parser.add_option("--trace",
+                         dest = "trace",
+                         help = "record every FUSE operation to TRACEFILE for replay with sha1trace.py",
+                         metavar="TRACEFILE")
+
+  server.parser.add_option("--readahead",
+                         dest = "readahead",
+                         type = "int",
+                         default = 0,
+                         help = "grow read-ahead up to BYTES for sequential reads of read-only files " +
+                                "(experimental)",
+                         metavar="BYTES")
+
+  server.parser.add_option("--mmap-reads",
+                         action = "store_true",
+                         dest = "mmapReads",
+                         default = False,
+                         help = "Serve reads of read-only files from an mmap of the file (experimental; " +
+                                "the mount dies if a mapped file is truncated behind its back).")
+
+  server.parser.add_option("--xattr-rehash",
+                         action = "store_true",
+                         dest = "xattrRehash",
+                         default = False,
+                         help = "Recalculate stale checksums when they are read through getxattr.")
+
+  server.parser.add_option("--xattr-cache",
+                         dest = "xattrCacheSize",
+                         type = "int",
+                         default = 65536,
+                         help = "number of checksums getxattr keeps in memory [default: %default]",
+                         metavar="ENTRIES")
+
+  server.parser.add_option("--write-buffer",
+                         dest = "writeBuffer",
+                         type = "int",
+                         default = 0,
+                         help = "collect up to BYTES of contiguous writes before writing them out",
+                         metavar="BYTES")
+
+  server.parser.add_option("--max-write",
+                         dest = "maxWrite",
+                         type = "int",
+                         default = 0,
+                         help = "ask the kernel for write requests of up to BYTES (big_writes)",
+                         metavar="BYTES")
+
+  server.parser.add_option("--lazy",
+                         action = "store_true",
+                         dest = "lazy",
+                         default = False,
+                         help = "Mark files dirty on release and hash them later, when asked for or when idle.")
+
+  server.parser.add_option("--idle-interval",
+                         dest = "idleInterval",
+                         type = "float",
+                         default = 5.0,
+                         help = "do deferred hashing (--lazy, --merkle-blocksize, sha1db.py --add-algorithm) " +
+                                "when a SECONDS period passes with at most one operation per second; " +
+                                "0 disables [default: %default]",
+                         metavar="SECONDS")
+
+  server.parser.add_option("--merkle-blocksize",
+                         dest = "merkleBlocksize",
+                         type = "int",
+                         default = 0,
+                         help = "keep digests of BYTES sized blocks so that release only rehashes the " +
+                                "blocks written; the whole file checksum is then calculated lazily",
+                         metavar="BYTES")
+
+  server.parser.add_option("--chunking",
+                         action = "store_true",
+                         dest = "chunking",
+                         default = False,
+                         help = "Also index content defined chunks of files as they are hashed, for sha1db.py --chunk-report.")
+
+  server.parser.add_option("--verify-reads",
+                         action = "store_true",
+                         dest = "verifyReads",
+                         default = False,
+                         help = "Hash files read from start to end and compare with the stored checksum on release.")
+
+  server.parser.add_option("--ignore-file",
+                         dest = "ignoreFile",
+                         help = "don't hash files matching the rules in FILE (gitignore style globs, " +
+                                "re:, ext:, minsize: and maxsize: lines)",
+                         metavar="FILE")
+
+  server.parser.add_option("--query-socket",
+                         dest = "querySocket",
+                         help = "answer batched checksum lookups on the Unix socket PATH (see sha1query.py)",
+                         metavar="PATH")
+
+  server.parser.add_option("--events",
+                         dest = "eventsPath",
+                         help = "publish checksum changes as JSON lines on the Unix socket PATH, or to PATH if it is a FIFO",
+                         metavar="PATH")
+
   server.parse(values=server, errex=1)
+  if server.maxWrite > 0:
+    # without big_writes the kernel splits writes into single pages, whatever max_write says
+    server.fuse_args.add("big_writes")
+    server.fuse_args.add("max_write", str(server.maxWrite))
   if not server.fuse_args.mountpoint:
     server.parser.print_help()
     print >> sys.stderr, "Error: missing FUSE mountpoint."
@@ -538,6 +993,25 @@ Userspace SHA1 checksum FS: mirror the filesystem tree, adding and updating file
     print >> sys.stderr, "Error: Missing root filesystem."
     sys.exit(2)
 
+  if server.ignoreFile:
+    server.ignoreFile = os.path.abspath(server.ignoreFile)
+    try:
+      IgnoreRules.fromFile(server.ignoreFile)
+    except (IOError, ValueError) as einst:
+      print >> sys.stderr, "Error: unusable ignore file: %s" % einst
+      sys.exit(2)
+
+  if server.querySocket:
+    server.querySocket = os.path.abspath(server.querySocket)
+
+  if server.eventsPath:
+    server.eventsPath = os.path.abspath(server.eventsPath)
+
+  if server.trace:
+    # the trace is opened before changing to the root so that relative paths work as expected
+    server.traceRecorder = TraceRecorder(os.path.abspath(server.trace))
+    server.traceRecorder.attach(server)
+
   try:
     if server.fuse_args.mount_expected():
       #print "Mounting", server.root, "at", server.fuse_args.mountpoint
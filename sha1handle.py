@@ -0,0 +1,270 @@
+# File handles returned by Sha1FS.open
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import mmap
+import os
+import threading
+
+from sha1merkle import addRange
+
+# Buffered writes are flushed up to a multiple of this many bytes, so that the writes that reach
+# the root filesystem start and end on block boundaries wherever possible
+WRITE_ALIGNMENT = 65536
+
+def pwrite(fd, data, offset):
+  """Writes all of data to fd at offset without using or moving the Python file position."""
+  if hasattr(os, "pwrite"):
+    written = 0
+    while written < len(data):
+      written += os.pwrite(fd, buffer(data, written), offset + written)
+  else:
+    os.lseek(fd, offset, os.SEEK_SET)
+    written = 0
+    while written < len(data):
+      written += os.write(fd, buffer(data, written))
+
+def pread(fd, size, offset):
+  """Reads up to size bytes from fd at offset, stopping early only at the end of the file."""
+  if hasattr(os, "pread"):
+    return os.pread(fd, size, offset)
+  os.lseek(fd, offset, os.SEEK_SET)
+  chunks = []
+  while size > 0:
+    d = os.read(fd, size)
+    if not d:
+      break
+    chunks.append(d)
+    size -= len(d)
+  return "".join(chunks)
+
+class FileHandle(object):
+  """Wraps the Python file object for an open file in the root filesystem.  Reads on read-only
+  handles can optionally be served from an mmap of the file, or through a read-ahead buffer that
+  grows while the reader stays sequential; both return buffer objects sliced from the map or the
+  buffer rather than copies.  Both are experimental, and only suitable for files that are not
+  changed behind the mount's back while they are open, which is the common case for large media
+  files.  The map is only checked against the file's size when a read goes past its end, so a file
+  that grows is followed, but reading a mapped page of a file truncated behind the mount's back
+  kills the process with SIGBUS.
+
+  Writes (and reads on writable handles) go straight to the file descriptor.  If writeBuffer is
+  set, contiguous writes are collected and written in one go once writeBuffer bytes are pending,
+  when the next write is not contiguous, or when the handle is flushed, synced, truncated, stat'ed,
+  read or closed.
+
+  The byte ranges changed by writes and truncates are kept in dirtyRanges, and the file's stat when
+  it was opened in openStat, so that release can rehash just the changed blocks.
+
+  If verifyHash is given (a checksum constructor), reads of a read-only handle that continue where
+  the previous one ended are hashed as they go, so that once the whole file has been read in order
+  readDigest gives its checksum without reading it again.  Reads that skip ahead stop the hashing.
+
+    file - the open Python file object
+    flags - the flags the file was opened with
+    readahead - the largest read-ahead window in bytes, or 0 to read exactly what is asked for
+    useMmap - true to serve reads from an mmap of the file
+    writeBuffer - the number of bytes of contiguous writes to collect, or 0 to write immediately
+    verifyHash - checksum constructor to hash sequential reads with, or None
+  """
+  def __init__(self, file, flags, readahead=0, useMmap=False, writeBuffer=0, verifyHash=None):
+    self.file = file
+    self.flags = flags
+    self.readOnly = (flags & (os.O_WRONLY | os.O_RDWR)) == 0
+    self.lock = threading.Lock()
+    self.openStat = os.fstat(file.fileno())
+    self.dirtyRanges = []
+
+    self.readahead = readahead if self.readOnly else 0
+    self.useMmap = useMmap and self.readOnly
+    self.map = None
+
+    # read-ahead state: the buffer (a new string every refill, so that the slices already handed
+    # out never change), where it starts in the file, the current window size and where the last
+    # read ended (to detect sequential access)
+    self.buf = ""
+    self.bufStart = 0
+    self.window = 0
+    self.lastEnd = -1
+
+    # write buffer state: the pending writes, where they start in the file and their total size
+    self.writeBuffer = 0 if self.readOnly else writeBuffer
+    self.pending = []
+    self.pendingStart = 0
+    self.pendingLen = 0
+
+    # verify-on-read state: the hash of the file so far and how many bytes it covers
+    self.hasher = verifyHash() if verifyHash is not None and self.readOnly else None
+    self.hashed = 0
+    self.hashLock = threading.Lock()
+
+  @property
+  def mode(self):
+    return self.file.mode
+
+  def fileno(self):
+    return self.file.fileno()
+
+  def read(self, size, offset):
+    """Returns up to size bytes starting at offset, as a string or (from the map or the read-ahead
+    buffer) a buffer object."""
+    data = self._read(size, offset)
+    if self.hasher is not None:
+      self._hashRead(data, offset)
+    return data
+
+  def readDigest(self):
+    """Returns the hex checksum of the bytes read in order from the start of the file, and how many
+    bytes that is; or (None, 0) if the reads weren't sequential or verifyHash wasn't given."""
+    with self.hashLock:
+      if self.hasher is None:
+        return (None, 0)
+      return (self.hasher.hexdigest(), self.hashed)
+
+  # Adds the part of data (read at offset) that follows on from what has been hashed so far.
+  # Rereads of data already hashed are ignored; a gap means the whole file will never be hashed.
+  def _hashRead(self, data, offset):
+    with self.hashLock:
+      if self.hasher is None:
+        return
+      end = offset + len(data)
+      if offset > self.hashed:
+        self.hasher = None
+      elif end > self.hashed:
+        self.hasher.update(buffer(data, self.hashed - offset))
+        self.hashed = end
+
+  def _read(self, size, offset):
+    if self.useMmap:
+      data = self._mmapRead(size, offset)
+      if data is not None:
+        return data
+    with self.lock:
+      if self.readahead > 0:
+        return self._readAhead(size, offset)
+      if not self.readOnly:
+        # writes bypass the file object, so its read buffer can't be trusted here
+        self._writePending()
+        return pread(self.fileno(), size, offset)
+      self.file.seek(offset)
+      return self.file.read(size)
+
+  def write(self, buf, offset):
+    """Writes buf at offset, returning the number of bytes written."""
+    with self.lock:
+      addRange(self.dirtyRanges, offset, offset + len(buf))
+      if self.writeBuffer <= 0:
+        pwrite(self.fileno(), buf, offset)
+        return len(buf)
+
+      if self.pendingLen > 0 and offset != self.pendingStart + self.pendingLen:
+        self._writePending()
+      if self.pendingLen <= 0 and len(buf) >= WRITE_ALIGNMENT:
+        # already big enough that collecting it would only add a copy
+        pwrite(self.fileno(), buf, offset)
+        return len(buf)
+      if self.pendingLen <= 0:
+        self.pendingStart = offset
+      self.pending.append(buf)
+      self.pendingLen += len(buf)
+      if self.pendingLen >= self.writeBuffer:
+        self._writePending(WRITE_ALIGNMENT)
+    return len(buf)
+
+  def flush(self):
+    with self.lock:
+      self._writePending()
+    self.file.flush()
+
+  def truncate(self, size):
+    with self.lock:
+      self._writePending()
+      current = os.fstat(self.fileno()).st_size
+      addRange(self.dirtyRanges, min(size, current), max(size, current))
+      self.file.truncate(size)
+
+  def fstat(self):
+    with self.lock:
+      self._writePending()
+    return os.fstat(self.fileno())
+
+  def close(self):
+    # the file is closed even if the pending writes can't be written out (ENOSPC, EIO), and the
+    # error raised
+    try:
+      with self.lock:
+        try:
+          self._writePending()
+        finally:
+          # not closed: a buffer taken from it may still be in use; it is unmapped along with
+          # the last of them
+          self.map = None
+    finally:
+      self.file.close()
+
+  # Writes out the pending writes.  With an alignment, only the part of them that ends on a
+  # multiple of alignment is written, unless that would leave everything pending.
+  def _writePending(self, alignment=0):
+    if self.pendingLen <= 0:
+      return
+    data = "".join(self.pending)
+    cut = len(data)
+    if alignment > 0:
+      aligned = ((self.pendingStart + len(data)) // alignment) * alignment - self.pendingStart
+      if aligned > 0:
+        cut = aligned
+    pwrite(self.fileno(), data[:cut], self.pendingStart)
+    if cut < len(data):
+      self.pending = [data[cut:]]
+    else:
+      self.pending = []
+    self.pendingStart += cut
+    self.pendingLen = len(data) - cut
+
+  # Returns a buffer of the slice of the mapped file, or None if the file can't be mapped (e.g. it
+  # is empty or not a regular file).  The file's size is only looked at when a read goes past the
+  # end of the map, and the map replaced if it has grown (or shrunk).  A replaced map isn't closed,
+  # as buffers taken from it may still be in use; it is unmapped along with the last of them.
+  def _mmapRead(self, size, offset):
+    with self.lock:
+      if self.map is None or offset + size > len(self.map):
+        filesize = os.fstat(self.fileno()).st_size
+        if filesize <= 0:
+          self.map = None
+          return None
+        if self.map is None or filesize != len(self.map):
+          try:
+            self.map = mmap.mmap(self.fileno(), filesize, access=mmap.ACCESS_READ)
+          except (EnvironmentError, mmap.error):
+            self.useMmap = False
+            return None
+      if offset >= len(self.map):
+        return ""
+      return buffer(self.map, offset, size)
+
+  # Serves a read from the read-ahead buffer, refilling it with a window that doubles on every
+  # sequential miss (up to self.readahead) and collapses back to nothing on a random access
+  def _readAhead(self, size, offset):
+    start = offset - self.bufStart
+    if start >= 0 and start + size <= len(self.buf):
+      data = buffer(self.buf, start, size)
+    else:
+      if offset == self.lastEnd:
+        self.window = min(self.readahead, max(2 * self.window, 2 * size))
+      else:
+        self.window = 0
+
+      self.file.seek(offset)
+      if self.window > size:
+        self.buf = self.file.read(self.window)
+        self.bufStart = offset
+        data = buffer(self.buf, 0, size)
+      else:
+        self.buf = ""
+        data = self.file.read(size)
+    self.lastEnd = offset + len(data)
+    return data
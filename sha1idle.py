@@ -0,0 +1,56 @@
+# Background work that only runs while the filesystem is quiet
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import logging
+import threading
+
+from sha1stats import STATS
+
+class IdleWorker(threading.Thread):
+  """Daemon thread that calls work() while the FUSE operation rate, as counted by STATS, stays at
+  or below maxRate operations per second.  The rate is sampled every interval seconds; work() is
+  called repeatedly until it returns false (nothing left to do), the rate goes up again or the
+  worker is stopped.  Each call to work() should only do a small piece of work (e.g. hash one file)
+  so that the worker gets out of the way quickly.
+
+    work - callable doing one unit of work, returning true if there may be more to do
+    interval - seconds between samples of the operation rate
+    maxRate - the highest operation rate considered idle
+  """
+  def __init__(self, work, interval=5.0, maxRate=1.0):
+    threading.Thread.__init__(self, name="IdleWorker")
+    self.daemon = True
+    self.work = work
+    self.interval = interval
+    self.maxRate = maxRate
+    self.stopped = threading.Event()
+
+  def stop(self):
+    self.stopped.set()
+
+  def run(self):
+    calls = STATS.filesystemCalls()
+    while not self.stopped.wait(self.interval):
+      (calls, idle) = self._idleSince(calls, self.interval)
+      while idle and not self.stopped.is_set():
+        try:
+          if not self.work():
+            break
+        except Exception as einst:
+          logging.error("Idle work failed: %s" % einst)
+          break
+        # work() makes no FUSE calls itself, so any new ones mean the filesystem is busy again
+        (calls, idle) = self._idleSince(calls, 0)
+
+  # Returns the current call count and whether the rate since the previous count was idle.  With
+  # no elapsed time, any new call counts as busy.
+  def _idleSince(self, calls, elapsed):
+    now = STATS.filesystemCalls()
+    if elapsed <= 0:
+      return (now, now == calls)
+    return (now, (now - calls) / elapsed <= self.maxRate)
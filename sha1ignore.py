@@ -0,0 +1,180 @@
+# Ignore rules: which files are left out of the checksum database
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import re
+
+# Rules that always apply, before any from an ignore file.  Nothing with .Trash in its path has
+# ever been hashed.
+DEFAULT_RULES = ["*.Trash*"]
+
+# Size suffixes understood by minsize: and maxsize:
+SIZE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+
+def parseSize(text):
+  """Returns the number of bytes in text, a whole number optionally followed by K, M, G or T."""
+  match = re.match(r"^\s*(\d+)\s*([kmgt]?)b?\s*$", text.lower())
+  if match is None:
+    raise ValueError("%s is not a size" % text)
+  return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+def globRegex(glob):
+  """Returns a regular expression matching the paths (relative to the root and starting with /) that
+  the gitignore style glob applies to.  A glob without a slash other than a trailing one matches a
+  name at any depth; otherwise it is anchored at the root.  * and ? don't match /, ** matches
+  anything, and a trailing slash only matches directories.  Matching a directory matches
+  everything under it."""
+  anchored = "/" in glob.rstrip("/")
+  dirOnly = glob.endswith("/")
+  glob = glob.strip("/")
+  out = []
+  i = 0
+  while i < len(glob):
+    c = glob[i]
+    if glob.startswith("**/", i):
+      out.append("(?:[^/]*/)*")
+      i += 3
+      continue
+    if glob.startswith("**", i):
+      out.append(".*")
+      i += 2
+      continue
+    if c == "*":
+      out.append("[^/]*")
+    elif c == "?":
+      out.append("[^/]")
+    elif c == "\\" and i + 1 < len(glob):
+      i += 1
+      out.append(re.escape(glob[i]))
+    elif c == "[" and glob.find("]", i + 2) > 0:
+      end = glob.find("]", i + 2)
+      body = glob[i + 1:end].replace("\\", "\\\\")
+      if body.startswith("!"):
+        body = "^" + body[1:]
+      out.append("[%s]" % body)
+      i = end
+    else:
+      out.append(re.escape(c))
+    i += 1
+  return ("^/" if anchored else "/") + "".join(out) + ("/" if dirOnly else "(?:/|$)")
+
+def simplifyUnanchored(regex):
+  """Drops the parts of an unanchored glob's regular expression that any path matches: a * at
+  either end of the name.  *.swp becomes a search for .swp at the end of a name rather than an
+  attempt at every slash, which is several times faster."""
+  if regex.startswith("/[^/]*"):
+    regex = regex[6:]
+  if regex.endswith("[^/]*(?:/|$)"):
+    regex = regex[:-12]
+  return regex
+
+class IgnoreRules(object):
+  """Decides which files are not hashed, from rules compiled once into a few regular expressions
+  (plus a set of extensions and a size range) so that checking a path takes a handful of C calls.
+  Each rule is a line:
+
+    *.swp, build/, /tmp/**   - a gitignore style glob (see globRegex)
+    re:REGEX                 - a regular expression searched for in the path
+    ext:.iso .tmp            - file extensions, in any case
+    minsize:1                - files smaller than this
+    maxsize:4G               - files larger than this
+    !RULE                    - a glob or re: rule re-including paths matched by the other rules
+
+  Blank lines and lines starting with # are skipped.  Paths are matched relative to root, starting
+  with /.  Size rules apply whatever the other rules say; a file whose size isn't known (such as a
+  directory) is only matched by the others.
+  """
+  def __init__(self, lines=(), root="/"):
+    self.root = root.rstrip("/")
+    self.rootSlash = self.root + "/"
+    self.extensions = set()
+    self.minSize = 0
+    self.maxSize = float("inf")
+    # unanchored globs, anchored globs and regular expressions are compiled separately: a pattern
+    # starting with a literal lets the regex engine skip straight to the places it can match
+    unanchored = []
+    anchored = []
+    regexes = []
+    negated = []
+    for (number, line) in enumerate(DEFAULT_RULES + list(lines)):
+      line = line.strip()
+      if not line or line.startswith("#"):
+        continue
+      negate = line.startswith("!")
+      if negate:
+        line = line[1:]
+      try:
+        if line.startswith("re:"):
+          regex = line[3:].strip()
+          re.compile(regex)
+          (negated if negate else regexes).append(regex)
+        elif negate:
+          if line.split(":")[0] in ("ext", "minsize", "maxsize"):
+            raise ValueError("only globs and re: rules can be negated")
+          negated.append(globRegex(line))
+        elif line.startswith("ext:"):
+          for ext in line[4:].split():
+            self.extensions.add(("." + ext.lstrip(".")).lower())
+        elif line.startswith("minsize:"):
+          self.minSize = parseSize(line[8:])
+        elif line.startswith("maxsize:"):
+          self.maxSize = parseSize(line[8:])
+        else:
+          regex = globRegex(line)
+          if regex.startswith("^/"):
+            anchored.append(regex[2:])
+          else:
+            unanchored.append(simplifyUnanchored(regex))
+      except (ValueError, re.error) as einst:
+        raise ValueError("ignore rule %d (%s): %s" % (number + 1 - len(DEFAULT_RULES), line, einst))
+    # the globs are matched from the end of the root in the full path, saving a copy of the
+    # relative path; re: rules get the copy, so that ^ anchors them at the root
+    self.globs = []
+    if len(unanchored) > 0:
+      self.globs.append(self._compile(unanchored).search)
+    if len(anchored) > 0:
+      self.globs.append(self._compile(anchored, "/").match)
+    self.regexes = self._compile(regexes)
+    self.negated = self._compile(negated)
+    # callers only need to stat files for the size rules
+    self.needsSize = self.minSize > 0 or self.maxSize != float("inf")
+
+  @classmethod
+  def fromFile(cls, path, root="/"):
+    """Returns the rules in the file at path, on top of the defaults."""
+    with open(path) as f:
+      return cls(f.readlines(), root)
+
+  def ignored(self, path, size=None):
+    """Returns true if the file at path, size bytes long, should not be hashed."""
+    if size is not None and (size < self.minSize or size > self.maxSize):
+      return True
+    return self._matches(path)
+
+  def ignoredDir(self, path):
+    """Returns true if everything under the directory at path is ignored, so a scan can skip it.
+    That is never certain while there are ! rules."""
+    if self.negated is not None:
+      return False
+    return self._matches(path.rstrip("/") + "/")
+
+  def _matches(self, path):
+    start = len(self.root) if path.startswith(self.rootSlash) else 0
+    dot = path.rfind(".") if self.extensions else -1
+    if not (dot > path.rfind("/") and path[dot:].lower() in self.extensions):
+      for match in self.globs:
+        if match(path, start) is not None:
+          break
+      else:
+        if self.regexes is None or self.regexes.search(path[start:]) is None:
+          return False
+    return self.negated is None or self.negated.search(path[start:]) is None
+
+  def _compile(self, patterns, prefix=""):
+    if len(patterns) <= 0:
+      return None
+    return re.compile(prefix + "(?:%s)" % "|".join("(?:%s)" % p for p in patterns))
@@ -0,0 +1,66 @@
+# Block level Merkle digests, so that a partial rewrite only rehashes the blocks it touched
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import binascii
+import hashlib
+
+def blockCount(size, blocksize):
+  """Returns the number of blocks in a file of size bytes.  An empty file has no blocks."""
+  return (size + blocksize - 1) // blocksize
+
+def addRange(ranges, start, end):
+  """Adds the byte range [start, end) to ranges, a list of (start, end) tuples, merging it into the
+  last range when they touch so that sequential writes keep the list short."""
+  if end < start:
+    return
+  if len(ranges) > 0:
+    (lastStart, lastEnd) = ranges[-1]
+    if start <= lastEnd and end >= lastStart:
+      ranges[-1] = (min(start, lastStart), max(end, lastEnd))
+      return
+  ranges.append((start, end))
+
+def rangeBlocks(ranges, blocksize):
+  """Returns the set of block indexes touched by the byte ranges.  An empty range still touches the
+  block it is in (it marks where a file was truncated)."""
+  blocks = set()
+  for (start, end) in ranges:
+    last = max(start, end - 1)
+    blocks.update(xrange(start // blocksize, last // blocksize + 1))
+  return blocks
+
+def hashBlocks(path, blocksize, indexes, checksum_func=hashlib.sha1):
+  """Yields (index, hex digest) for each of the given blocks of the file at path, in index order.
+  Blocks past the end of the file are skipped."""
+  with open(path, 'rb') as fobj:
+    for index in sorted(indexes):
+      fobj.seek(index * blocksize)
+      data = fobj.read(blocksize)
+      if not data:
+        break
+      m = checksum_func()
+      m.update(data)
+      yield (index, m.hexdigest())
+
+def merkleRoot(digests, checksum_func=hashlib.sha1):
+  """Returns the hex root of the binary tree over the given hex block digests, in block order.
+  Each parent is the checksum of its two children's raw digests; an odd node at the end of a level
+  moves up unchanged.  The root of no blocks is the checksum of nothing."""
+  level = [binascii.unhexlify(d) for d in digests]
+  if len(level) <= 0:
+    return checksum_func().hexdigest()
+  while len(level) > 1:
+    parents = []
+    for i in xrange(0, len(level) - 1, 2):
+      m = checksum_func()
+      m.update(level[i] + level[i + 1])
+      parents.append(m.digest())
+    if len(level) % 2 == 1:
+      parents.append(level[-1])
+    level = parents
+  return binascii.hexlify(level[0])
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+
+# Checksum query daemon: answers batched lookups against the checksum database over a Unix socket
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import errno
+import json
+import logging
+import os
+import socket
+import SocketServer
+import sys
+import threading
+import time
+
+from fusesha1util import LRUCache, removeStaleSocket
+from sha1db import CHANGES_PRUNED, Sha1DB
+from sha1stats import STATS
+
+from pysqlite2 import dbapi2 as sqlite
+from optparse import OptionParser
+
+# Entries kept by each of the caches (by path and by digest), and the most paths returned for
+# (and cached per) digest
+CACHE_SIZE = 65536
+MAX_PATHS = 100
+
+# The most logged changes read to drop just the cache entries they affect; after more than this
+# (or if the changes since the last request have been pruned) the caches are emptied instead
+MAX_CHANGES = 4096
+
+# Returned by the caches for a key they don't hold, as None is a cached "no entry"
+MISSING = object()
+
+class QueryService(object):
+  """Answers lookups from one long lived read connection to the database of sha1db, caching both
+  the checksum of each path looked up and the paths of each checksum.  Every answer costs one
+  "pragma data_version" on that connection, which changes whenever any other connection (the
+  mount's included) commits.  The changes logged since the last answer then say which paths
+  changed, and only the entries of those paths and of their old and new checksums are dropped, so
+  nothing stale is ever returned.  After more than MAX_CHANGES changes, or once the changes since
+  the last answer have been pruned, the caches are emptied instead.
+
+    sha1db - the Sha1DB to answer from
+    cacheSize - entries kept by each cache
+    maxPaths - the most paths kept and returned for a digest
+  """
+  def __init__(self, sha1db, cacheSize=CACHE_SIZE, maxPaths=MAX_PATHS):
+    self.sha1db = sha1db
+    self.maxPaths = maxPaths
+    self.byPath = LRUCache(cacheSize)
+    self.byDigest = LRUCache(cacheSize)
+    # the digests in byDigest listing each path, which a change to the path drops.  The checksum
+    # a path had before a change isn't logged, so this is the only way to find them.
+    self.listedIn = {}
+    self.indexLimit = cacheSize
+    # one connection shared by the handler threads, one request at a time
+    self.connection = sqlite.connect(sha1db.database, check_same_thread=False,
+                                     isolation_level=None)
+    self.lock = threading.Lock()
+    self.dataVersion = None
+    self.lastSeq = None
+
+  def close(self):
+    with self.lock:
+      self.connection.close()
+
+  def digests(self, paths):
+    """Returns a dict of the stored checksum of each of paths, None for paths with no entry."""
+    with self.lock:
+      cursor = self._cursor()
+      try:
+        (found, missing) = self._cached(self.byPath, paths)
+        if len(missing) > 0:
+          stored = self.sha1db.lookupChecksums(missing, cursor)
+          for path in missing:
+            found[path] = stored.get(path)
+            self.byPath.put(path, found[path])
+      finally:
+        cursor.close()
+    return found
+
+  def paths(self, digests, limit=None):
+    """Returns a dict of the paths of the files with each of digests, in path order and at most
+    limit (or maxPaths) of them; digests no file has map to an empty list."""
+    limit = self.maxPaths if limit is None else min(limit, self.maxPaths)
+    with self.lock:
+      cursor = self._cursor()
+      try:
+        (found, missing) = self._cached(self.byDigest, digests)
+        if len(missing) > 0:
+          stored = self.sha1db.lookupPaths(missing, self.maxPaths, cursor)
+          for digest in missing:
+            found[digest] = stored.get(digest, [])
+            self.byDigest.put(digest, found[digest])
+            self._index(digest, found[digest])
+      finally:
+        cursor.close()
+    return dict((digest, paths[:limit]) for (digest, paths) in found.iteritems())
+
+  def exists(self, digests):
+    """Returns a dict saying for each of digests whether any file has it."""
+    return dict((digest, len(paths) > 0) for (digest, paths) in self.paths(digests, 1).iteritems())
+
+  def handle(self, request):
+    """Answers one decoded request, returning the response to encode:
+
+      {"op": "digests", "paths": [...]}               -> {"digests": {path: digest or null}}
+      {"op": "paths", "digests": [...], "limit": N}   -> {"paths": {digest: [path, ...]}}
+      {"op": "exists", "digests": [...]}              -> {"exists": {digest: true or false}}
+
+    A request that can't be answered gets {"error": message}."""
+    start = time.time()
+    op = None
+    try:
+      op = request.get("op")
+      if op == "digests":
+        response = {"digests": self.digests(self._keys(request, "paths"))}
+      elif op == "paths":
+        response = {"paths": self.paths(self._keys(request, "digests"), request.get("limit"))}
+      elif op == "exists":
+        response = {"exists": self.exists(self._keys(request, "digests"))}
+      else:
+        raise ValueError("unknown op %r" % op)
+    except (AttributeError, TypeError, ValueError, sqlite.Error) as einst:
+      STATS.record("query.%s" % op, time.time() - start, True)
+      return {"error": str(einst)}
+    STATS.record("query.%s" % op, time.time() - start)
+    return response
+
+  # Returns a cursor on the connection, dropping the cache entries changed by commits made since
+  # the last request.  Must be called holding the lock.
+  def _cursor(self):
+    cursor = self.connection.cursor()
+    cursor.execute("pragma data_version;")
+    (version, ) = cursor.fetchone()
+    if version != self.dataVersion:
+      if self.dataVersion is not None:
+        STATS.count("query.invalidations")
+      # the checkpoint and the changes are read from one snapshot, so a prune can't fall between
+      cursor.execute("begin;")
+      try:
+        self._invalidate(cursor)
+      finally:
+        cursor.execute("commit;")
+      self.dataVersion = version
+    return cursor
+
+  # Drops the cache entries of every path logged as changed since lastSeq (both paths of a
+  # rename), of the digests whose cached paths include one, and of the checksums the paths have
+  # now.  Hard linking a duplicate changes no answer, so those changes are skipped.  Empties the
+  # caches if that can't be done from the log.
+  def _invalidate(self, cursor):
+    cursor.execute("select value from checkpoints where name = ?;", (CHANGES_PRUNED, ))
+    pruned = max([int(value) for (value, ) in cursor] or [0])
+    if self.lastSeq is not None and self.lastSeq >= pruned:
+      cursor.execute("select seq, op, path, oldPath, chksum from changes where seq > ? "
+                     "order by seq limit ?;", (self.lastSeq, MAX_CHANGES + 1))
+      changes = cursor.fetchall()
+      if len(changes) <= MAX_CHANGES:
+        for (seq, op, path, oldPath, chksum) in changes:
+          self.lastSeq = seq
+          if op == "link":
+            continue
+          for changed in (path, oldPath):
+            if changed is not None:
+              self.byPath.discard(changed)
+              for digest in self.listedIn.pop(changed, ()):
+                self.byDigest.discard(digest)
+          if chksum is not None:
+            self.byDigest.discard(chksum)
+        STATS.count("query.changes", len(changes))
+        return
+    if self.lastSeq is not None:
+      STATS.count("query.clears")
+    self.byPath.clear()
+    self.byDigest.clear()
+    self.listedIn = {}
+    cursor.execute("select seq from sqlite_sequence where name = 'changes';")
+    self.lastSeq = max([seq for (seq, ) in cursor] or [0])
+
+  # Records that the cached paths of digest include paths.  Digests the cache has since dropped
+  # are only removed from the index when it is rebuilt from the cache, once it has doubled.
+  def _index(self, digest, paths):
+    for path in paths:
+      self.listedIn.setdefault(path, set()).add(digest)
+    if len(self.listedIn) > self.indexLimit:
+      self.listedIn = {}
+      for (cached, cachedPaths) in self.byDigest.items():
+        for path in cachedPaths:
+          self.listedIn.setdefault(path, set()).add(cached)
+      self.indexLimit = max(2 * len(self.listedIn), self.byDigest.maxsize)
+
+  # Splits keys into a dict of the cached values and a list of those not in cache
+  def _cached(self, cache, keys):
+    found = {}
+    missing = []
+    for key in keys:
+      value = cache.get(key, MISSING)
+      if value is MISSING:
+        missing.append(key)
+      else:
+        found[key] = value
+    STATS.count("query.hits", len(found))
+    STATS.count("query.misses", len(missing))
+    return (found, missing)
+
+  def _keys(self, request, name):
+    keys = request.get(name)
+    if not isinstance(keys, list):
+      raise ValueError("%s must be a list" % name)
+    return keys
+
+class QueryHandler(SocketServer.StreamRequestHandler):
+  """Answers newline separated JSON requests on one connection until the client closes it."""
+  def handle(self):
+    for line in iter(self.rfile.readline, ""):
+      try:
+        response = self.server.service.handle(json.loads(line))
+      except ValueError as einst:
+        response = {"error": "bad request: %s" % einst}
+      self.wfile.write(json.dumps(response) + "\n")
+      self.wfile.flush()
+
+class QueryServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  """Serves a QueryService on a Unix socket at socketPath, a thread per client.  A socket file left
+  behind by a server that is gone is replaced; one still answering is an error (EADDRINUSE).  The
+  socket is only accessible by its owner.  start runs the server in a daemon thread, as the mount
+  does; stop shuts it down and removes the socket."""
+  daemon_threads = True
+
+  def __init__(self, socketPath, service):
+    self.socketPath = socketPath
+    self.service = service
+    self.thread = None
+    removeStaleSocket(socketPath)
+    SocketServer.UnixStreamServer.__init__(self, socketPath, QueryHandler)
+    os.chmod(socketPath, 0600)
+
+  def start(self):
+    self.thread = threading.Thread(target=self.serve_forever, name="QueryServer")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    if self.thread is not None:
+      self.shutdown()
+    self.server_close()
+    self.service.close()
+    try:
+      os.remove(self.socketPath)
+    except OSError:
+      pass
+
+  def join(self):
+    if self.thread is not None:
+      self.thread.join()
+
+class QueryClient(object):
+  """Sends lookups to a QueryServer over one connection, which is kept open between calls.  Each
+  method takes a whole batch of keys, which is answered in one round trip.  Errors returned by the
+  server are raised as ValueError."""
+  def __init__(self, socketPath):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.connect(socketPath)
+    self.rfile = self.sock.makefile("rb")
+
+  def close(self):
+    self.rfile.close()
+    self.sock.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, trace):
+    self.close()
+
+  def digests(self, paths):
+    """Returns a dict of the checksum of each of paths, None for paths with no entry."""
+    return self._request({"op": "digests", "paths": list(paths)})["digests"]
+
+  def paths(self, digests, limit=None):
+    """Returns a dict of the paths of the files with each of digests, in path order."""
+    request = {"op": "paths", "digests": list(digests)}
+    if limit is not None:
+      request["limit"] = limit
+    return self._request(request)["paths"]
+
+  def exists(self, digests):
+    """Returns a dict saying for each of digests whether any file has it."""
+    return self._request({"op": "exists", "digests": list(digests)})["exists"]
+
+  def _request(self, request):
+    self.sock.sendall(json.dumps(request) + "\n")
+    line = self.rfile.readline()
+    if not line:
+      raise IOError(errno.ECONNRESET, "query server closed the connection")
+    response = json.loads(line)
+    if "error" in response:
+      raise ValueError(response["error"])
+    return response
+
+def main():
+  usage = """%prog answers checksum lookups against a FUSE SHA1 database on a Unix socket, without
+a mount (sha1fs.py --query-socket runs the same server inside the mount).  [options] database"""
+  parser = OptionParser(usage = usage)
+  parser.add_option("--socket",
+                    dest = "socket",
+                    help = "Unix socket to listen on (required)",
+                    metavar="PATH")
+  parser.add_option("--cache-size",
+                    dest = "cacheSize",
+                    type = "int",
+                    default = CACHE_SIZE,
+                    help = "paths and digests each kept in memory [default: %default]",
+                    metavar="ENTRIES")
+
+  (options, args) = parser.parse_args()
+
+  if len(args) != 1:
+    parser.error("You must give the database to answer from.")
+  if not options.socket:
+    parser.error("--socket is required.")
+
+  server = QueryServer(os.path.abspath(options.socket),
+                       QueryService(Sha1DB(args[0]), options.cacheSize))
+  logging.warn("answering lookups against %s on %s" % (args[0], server.socketPath))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.stop()
+
+if __name__ == "__main__":
+  main()
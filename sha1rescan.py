@@ -0,0 +1,176 @@
+# Rescanning the root in the background once the filesystem is mounted
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import json
+import logging
+import os
+import threading
+import time
+
+from stat import S_ISREG
+
+from sha1stats import STATS
+
+# Files hashed between commits, and the longest the hashing for one commit may take
+BATCH_SIZE = 100
+BATCH_SECONDS = 1.0
+
+# Seconds between progress lines in the LOG
+LOG_INTERVAL = 30.0
+
+class Rescanner(threading.Thread):
+  """Daemon thread that rehashes every file under fsroot, as --rescan used to before mounting.
+  The tree is walked first to count the files and bytes to hash, so that progress can be given
+  with an ETA.  Files are hashed outside of any transaction and stored in small batches with
+  Sha1DB.storeHashed, which leaves alone any file changed through the mount since it was hashed.
+  Whenever FUSE operations were made while a file was hashed, the scan sleeps for pause seconds
+  before the next one, so that it only gets the time the mount doesn't need.
+
+    sha1db - the Sha1DB to store the checksums in
+    fsroot - the directory to scan
+    ignore - IgnoreRules for files not to hash, or None
+    pause - seconds to sleep after a file hashed while the filesystem was in use
+  """
+  def __init__(self, sha1db, fsroot, ignore=None, pause=0.1):
+    threading.Thread.__init__(self, name="Rescanner")
+    self.daemon = True
+    self.sha1db = sha1db
+    self.fsroot = fsroot
+    self.ignore = ignore
+    self.pause = pause
+    self.stopped = threading.Event()
+    self.lock = threading.Lock()
+    self.state = "waiting"
+    self.totalFiles = 0
+    self.totalBytes = 0
+    self.files = 0
+    self.bytes = 0
+    self.changed = 0
+    self.errors = 0
+    self.started = None
+    self.hashingStarted = None
+    self.finished = None
+
+  def stop(self):
+    self.stopped.set()
+
+  def status(self):
+    """Returns the progress so far as a dict.  eta is the estimated number of seconds left, from
+    the rate bytes have been hashed at, or None until there is a rate."""
+    with self.lock:
+      now = self.finished or time.time()
+      status = {"state": self.state, "files": self.files, "bytes": self.bytes,
+                "totalFiles": self.totalFiles, "totalBytes": self.totalBytes,
+                "changed": self.changed, "errors": self.errors,
+                "elapsed": (now - self.started) if self.started else 0, "eta": None}
+      if self.state == "hashing" and self.bytes > 0:
+        rate = self.bytes / max(now - self.hashingStarted, 0.001)
+        status["eta"] = (self.totalBytes - self.bytes) / rate
+    return status
+
+  def statusJson(self):
+    """Returns the status as a JSON document, for the mount's virtual status file."""
+    return json.dumps(self.status(), indent=1, sort_keys=True) + "\n"
+
+  def run(self):
+    self.started = time.time()
+    try:
+      self._setState("counting")
+      files = self._count()
+      self._setState("hashing")
+      self.hashingStarted = time.time()
+      self._log()
+      self._hash(files)
+      self._setState("stopped" if self.stopped.is_set() else "done")
+    except Exception as einst:
+      logging.error("Rescan of %s failed: %s" % (self.fsroot, einst))
+      self._setState("failed")
+    self.finished = time.time()
+    self._log()
+
+  # Walks the tree, returning the (path, size) of the files to hash
+  def _count(self):
+    files = []
+    for root, dirs, names in os.walk(self.fsroot):
+      if self.stopped.is_set():
+        break
+      if self.ignore is not None:
+        dirs[:] = [name for name in dirs if not self.ignore.ignoredDir(os.path.join(root, name))]
+      for name in names:
+        path = os.path.join(root, name)
+        try:
+          st = os.lstat(path)
+        except OSError:
+          continue
+        size = st.st_size if S_ISREG(st.st_mode) else None
+        if self.ignore is not None and self.ignore.ignored(path, size):
+          STATS.count("ignore.rescan")
+          continue
+        files.append((path, size or 0))
+        with self.lock:
+          self.totalFiles += 1
+          self.totalBytes += size or 0
+    return files
+
+  def _hash(self, files):
+    batch = []
+    batchStart = time.time()
+    lastLog = time.time()
+    calls = STATS.filesystemCalls()
+    for (path, size) in files:
+      if self.stopped.is_set():
+        break
+      try:
+        hashed = self.sha1db.hashPath(path)
+        if hashed is not None:
+          batch.append(hashed)
+      except EnvironmentError as einst:
+        logging.error("Rescan could not hash %s: %s" % (path, einst))
+        with self.lock:
+          self.errors += 1
+      with self.lock:
+        self.files += 1
+        self.bytes += size
+
+      if len(batch) >= BATCH_SIZE or time.time() - batchStart >= BATCH_SECONDS:
+        self._store(batch)
+        batch = []
+        batchStart = time.time()
+      if time.time() - lastLog >= LOG_INTERVAL:
+        self._log()
+        lastLog = time.time()
+
+      # the mount comes first: back off for a moment whenever it was used during that file
+      now = STATS.filesystemCalls()
+      if now != calls:
+        self.stopped.wait(self.pause)
+        calls = STATS.filesystemCalls()
+    self._store(batch)
+
+  def _store(self, batch):
+    if len(batch) <= 0:
+      return
+    stored = self.sha1db.storeHashed(batch)
+    STATS.count("rescan.files", stored)
+    if stored < len(batch):
+      STATS.count("rescan.changed", len(batch) - stored)
+      with self.lock:
+        self.changed += len(batch) - stored
+
+  def _setState(self, state):
+    with self.lock:
+      self.state = state
+
+  # Progress goes to the LOG at WARN, the level fusesha1util configures it with, so it is kept
+  def _log(self):
+    status = self.status()
+    eta = "" if status["eta"] is None else ", ETA %ds" % status["eta"]
+    logging.warn("rescan %s: %d/%d files, %d/%d bytes, %d changed during the scan, %d errors, "
+                 "%.0fs elapsed%s" % (status["state"], status["files"], status["totalFiles"],
+                 status["bytes"], status["totalBytes"], status["changed"], status["errors"],
+                 status["elapsed"], eta))
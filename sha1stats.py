@@ -0,0 +1,162 @@
+# Per-operation counters and latency histograms for the FUSE SHA1 filesystem
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import json
+import logging
+import thread
+import threading
+import time
+
+from functools import wraps
+
+# Latencies are bucketed by powers of two in microseconds.  Bucket 0 holds anything under 1us,
+# bucket i holds [2^(i-1), 2^i) us and the last bucket holds everything slower than that.
+NUM_BUCKETS = 32
+
+# Indexes into the per-operation entry lists kept by OpStats
+CALLS, ERRORS, BYTES, SECONDS, HISTOGRAM = range(5)
+
+def bucketFor(elapsed):
+  """Returns the histogram bucket index for an elapsed time given in seconds."""
+  return min(int(elapsed * 1000000).bit_length(), NUM_BUCKETS - 1)
+
+def bucketBound(index):
+  """Returns the exclusive upper bound, in microseconds, of the given histogram bucket."""
+  return 1 << index
+
+def newEntry():
+  """Returns an empty per-operation entry."""
+  return [0, 0, 0, 0.0, [0] * NUM_BUCKETS]
+
+def addEntry(total, entry):
+  """Adds the counters of entry to those of total."""
+  for i in (CALLS, ERRORS, BYTES, SECONDS):
+    total[i] += entry[i]
+  for i, n in enumerate(list(entry[HISTOGRAM])):
+    total[HISTOGRAM][i] += n
+
+class OpStats:
+  """Records call counts, error counts, bytes moved, and log-bucketed latency histograms keyed
+  by operation name.  Every thread records into its own table, found by its thread id, so that
+  recording never takes a lock.  The tables of threads that are no longer running are folded
+  into a retired table whenever the counters are read, so that the number of tables stays that of
+  the threads recording.  A thread started outside Python (such as a FUSE worker) is only known to
+  be running while threading knows of it; otherwise its table is folded too, and it starts a new one
+  on its next call (a call it records at that moment can be lost)."""
+  def __init__(self):
+    self._lock = threading.Lock()
+    # the tables of the threads that have recorded since the last fold, keyed by thread id
+    self._tables = {}
+    self._retired = {}
+
+  def _table(self):
+    ident = thread.get_ident()
+    table = self._tables.get(ident)
+    if table is None:
+      # only this thread adds a table under its id, and setdefault is atomic
+      table = self._tables.setdefault(ident, {})
+    return table
+
+  # Folds the tables of the threads that are no longer running into the retired table, returning
+  # the remaining tables and a copy of the retired one
+  def _allTables(self):
+    running = set(t.ident for t in threading.enumerate())
+    with self._lock:
+      for ident in [ident for ident in self._tables.keys() if not ident in running]:
+        for name, entry in self._tables.pop(ident).items():
+          addEntry(self._retired.setdefault(name, newEntry()), entry)
+      retired = dict((name, [entry[CALLS], entry[ERRORS], entry[BYTES], entry[SECONDS],
+                             list(entry[HISTOGRAM])]) for (name, entry) in self._retired.items())
+      return self._tables.values() + [retired]
+
+  def _entry(self, name):
+    table = self._table()
+    entry = table.get(name)
+    if entry is None:
+      entry = newEntry()
+      table[name] = entry
+    return entry
+
+  def record(self, name, elapsed, error=False, nbytes=0):
+    """Records one call of the named operation that took elapsed seconds and moved nbytes."""
+    entry = self._entry(name)
+    entry[CALLS] += 1
+    if error:
+      entry[ERRORS] += 1
+    entry[BYTES] += nbytes
+    entry[SECONDS] += elapsed
+    entry[HISTOGRAM][bucketFor(elapsed)] += 1
+
+  def count(self, name, n=1):
+    """Adds n to the calls of the named counter, for events that have no duration."""
+    self._entry(name)[CALLS] += n
+
+  def totalCalls(self):
+    """Returns the number of calls recorded across all operations and threads."""
+    tables = self._allTables()
+    return sum(entry[CALLS] for table in tables for (name, entry) in table.items())
+
+  def filesystemCalls(self):
+    """Returns the number of FUSE operation calls recorded.  Internal timings such as the database
+    ones are recorded under dotted names (db.dedup, sqlite.commit) and are left out."""
+    tables = self._allTables()
+    return sum(entry[CALLS] for table in tables for (name, entry) in table.items() if not "." in name)
+
+  def snapshot(self):
+    """Returns a dict keyed by operation name of the merged counters for all threads.  Each
+    value is a dict with calls, errors, bytes, seconds and histogram, the latter a list of
+    [upper bound in microseconds, count] pairs for the non-empty buckets."""
+    merged = {}
+    for table in self._allTables():
+      # items() copies the table in one step, so a thread recording concurrently is harmless
+      for name, entry in table.items():
+        addEntry(merged.setdefault(name, newEntry()), entry)
+
+    result = {}
+    for name, total in merged.iteritems():
+      result[name] = {
+        "calls": total[CALLS],
+        "errors": total[ERRORS],
+        "bytes": total[BYTES],
+        "seconds": total[SECONDS],
+        "histogram": [[bucketBound(i), n] for i, n in enumerate(total[HISTOGRAM]) if n > 0]}
+    return result
+
+  def toJson(self):
+    """Returns the current snapshot as a JSON document."""
+    return json.dumps(self.snapshot(), indent=1, sort_keys=True) + "\n"
+
+  def logSummary(self):
+    """Writes one line per operation to the LOG.  This logs at WARN, the level the LOG is
+    configured with by fusesha1util, so that the summary is always kept."""
+    snapshot = self.snapshot()
+    for name in sorted(snapshot.keys()):
+      op = snapshot[name]
+      mean = (op["seconds"] / op["calls"]) if op["calls"] > 0 else 0
+      logging.warn("stats %s: %d calls, %d errors, %d bytes, %.6fs total, %.6fs mean" %
+          (name, op["calls"], op["errors"], op["bytes"], op["seconds"], mean))
+
+# Process-wide statistics shared by the filesystem and the database
+STATS = OpStats()
+
+def timed(name):
+  """Decorator that records the latency of every call to the wrapped function in STATS under
+  name.  Calls that raise are counted as errors."""
+  def decorator(func):
+    @wraps(func)
+    def wrapper(*args, **kw):
+      start = time.time()
+      try:
+        result = func(*args, **kw)
+      except:
+        STATS.record(name, time.time() - start, True)
+        raise
+      STATS.record(name, time.time() - start)
+      return result
+    return wrapper
+  return decorator
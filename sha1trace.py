@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# Records the FUSE operations made against a mounted Sha1FS and replays them without FUSE
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import errno
+import json
+import logging
+import os
+import threading
+import time
+
+from inspect import isgenerator
+from optparse import OptionParser
+
+LOG_FILENAME = "LOG"
+logging.basicConfig(filename=LOG_FILENAME,level=logging.INFO,)
+
+TRACE_HEADER = "# sha1trace 1\n"
+
+# The Sha1FS methods that are recorded.  Methods the filesystem does not implement are skipped.
+TRACED_OPS = ("getattr", "readlink", "readdir", "unlink", "rmdir", "symlink", "rename", "link",
+              "chmod", "chown", "truncate", "mknod", "mkdir", "utime", "access", "open", "read",
+              "write", "fgetattr", "ftruncate", "flush", "release", "fsync", "getxattr",
+              "listxattr")
+
+# Every field in a trace line is a one letter type tag followed by a value:
+#   h<id>   an open file handle, numbered in the order the handles were opened
+#   b<n>    a buffer of n bytes (written data and read results; the contents are not kept)
+#   i<n>    an integer
+#   t<a,b>  a tuple of numbers, e.g. the times given to utime
+#   s<str>  a string (escaped so that it never contains a tab or newline)
+#   e<n>    an errno raised by the operation
+#   n       None
+#   o       any other result (e.g. a stat object)
+# A line is: start (us since the trace began), elapsed (us), op, result, args...
+
+class TraceRecorder:
+  """Wraps the FUSE methods of a filesystem object so that every call is appended to a trace
+  file.  The recorder is attached before the filesystem is mounted and closed at unmount."""
+  def __init__(self, tracefile):
+    self.tracefile = open(tracefile, "w")
+    self.tracefile.write(TRACE_HEADER)
+    self.lock = threading.Lock()
+    self.handles = {} # handle ids keyed by id() of the handle object
+    self.nextHandle = 0
+    self.start = time.time()
+
+  def attach(self, server):
+    """Replaces the traced methods of server with recording wrappers."""
+    for op in TRACED_OPS:
+      if hasattr(server, op):
+        setattr(server, op, self._wrap(op, getattr(server, op)))
+
+  def close(self):
+    with self.lock:
+      self.tracefile.close()
+
+  def _wrap(self, op, method):
+    def traced(*args, **kw):
+      if "fh" in kw:
+        args = args + (kw.pop("fh"), )
+      start = time.time()
+      try:
+        result = method(*args, **kw)
+        if isgenerator(result):
+          result = list(result)
+      except EnvironmentError as einst:
+        self._record(op, start, args, "e%d" % (einst.errno or 0))
+        raise
+      self._record(op, start, args, self._encodeResult(op, result))
+      return result
+    return traced
+
+  def _record(self, op, start, args, result):
+    now = time.time()
+    fields = [self._encodeArg(op, i, arg) for i, arg in enumerate(args)]
+    line = "%d\t%d\t%s\t%s\t%s\n" % (int((start - self.start) * 1000000),
+        int((now - start) * 1000000), op, result, "\t".join(fields))
+    with self.lock:
+      if op == "release" and len(args) > 2:
+        self.handles.pop(id(args[2]), None)
+      self.tracefile.write(line)
+
+  def _encodeResult(self, op, result):
+    if op == "open" and not isinstance(result, (int, long)) and result is not None:
+      with self.lock:
+        hid = self.nextHandle
+        self.nextHandle += 1
+        self.handles[id(result)] = hid
+      return "h%d" % hid
+    if isinstance(result, str):
+      return "b%d" % len(result)
+    if isinstance(result, (int, long)):
+      return "i%d" % result
+    if isinstance(result, list):
+      return "i%d" % len(result)
+    if result is None:
+      return "n"
+    return "o"
+
+  def _encodeArg(self, op, index, arg):
+    if op == "write" and index == 1:
+      return "b%d" % len(arg)
+    hid = self.handles.get(id(arg))
+    if hid is not None:
+      return "h%d" % hid
+    if isinstance(arg, (int, long)):
+      return "i%d" % arg
+    if isinstance(arg, tuple):
+      return "t" + ",".join(str(x) for x in arg)
+    if arg is None:
+      return "n"
+    return "s" + str(arg).encode("string_escape")
+
+def readTrace(tracefile):
+  """Generator over the calls in a trace file.  Yields (start, elapsed, op, result, args) with
+  start and elapsed in seconds and the raw (still tagged) result and argument fields."""
+  with open(tracefile) as f:
+    for line in f:
+      if line.startswith("#"):
+        continue
+      fields = line.rstrip("\n").split("\t")
+      if len(fields) < 4:
+        continue
+      args = fields[4:] if (len(fields) > 4 and fields[4] != "") else []
+      yield (int(fields[0]) / 1000000.0, int(fields[1]) / 1000000.0, fields[2], fields[3], args)
+
+def percentile(ordered, fraction):
+  """Returns the value at the given fraction (0-1) of an already sorted list."""
+  if len(ordered) <= 0:
+    return 0
+  return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class TraceReplayer:
+  """Drives a filesystem object directly with the calls from a trace, without FUSE.  Written data
+  is synthesized, since traces only keep buffer sizes."""
+  def __init__(self, server):
+    self.server = server
+    self.handles = {} # replayed handles keyed by trace handle id
+    self.buffers = {}
+
+  def prepareRoot(self, tracefile, root):
+    """Creates the directories and files the trace uses before creating them itself, so that a
+    trace taken against a populated root can be replayed into an empty scratch root.  Files are
+    made large enough to satisfy every read in the trace."""
+    created = set()
+    dirs = set()
+    extents = {}
+    for (start, elapsed, op, result, args) in readTrace(tracefile):
+      path = self._decode(args[0]) if len(args) > 0 else None
+      if op in ("mknod", "mkdir", "symlink", "link") and len(args) > 0:
+        created.add(self._decode(args[-1]) if op in ("symlink", "link") else path)
+      elif op == "readdir" and not path in created:
+        dirs.add(path)
+      elif op in ("open", "read", "truncate") and not path in created:
+        extent = 0
+        if op == "read":
+          extent = int(args[1][1:]) + int(args[2][1:])
+        extents[path] = max(extents.get(path, 0), extent)
+
+    for path in dirs:
+      if not os.path.isdir(root + path):
+        os.makedirs(root + path)
+    block = "\xa5" * 65536
+    for path, extent in extents.iteritems():
+      if os.path.exists(root + path):
+        continue
+      if not os.path.isdir(os.path.dirname(root + path)):
+        os.makedirs(os.path.dirname(root + path))
+      with open(root + path, "wb") as f:
+        while extent > 0:
+          f.write(block[:min(extent, len(block))])
+          extent -= len(block)
+
+  def replay(self, tracefile):
+    """Replays every call in the trace and returns a report dict with the overall throughput and
+    the latency percentiles of each op."""
+    logging.info("Replaying trace %s" % tracefile)
+    latencies = {}
+    errors = {}
+    bytesRead = 0
+    bytesWritten = 0
+    begin = time.time()
+    for (start, elapsed, op, result, args) in readTrace(tracefile):
+      method = getattr(self.server, op, None)
+      if method is None:
+        continue
+      decoded = [self._decode(arg) for arg in args]
+      callStart = time.time()
+      try:
+        value = method(*decoded)
+        if isgenerator(value):
+          value = list(value)
+      except Exception:
+        # e.g. a call on a handle whose open already failed during the replay
+        value = -errno.EIO
+      callElapsed = time.time() - callStart
+      latencies.setdefault(op, []).append(callElapsed)
+
+      if isinstance(value, (int, long)) and value < 0:
+        errors[op] = errors.get(op, 0) + 1
+      if op == "open" and result.startswith("h") and not isinstance(value, (int, long)):
+        self.handles[result] = value
+      elif op == "release" and len(args) > 2:
+        self.handles.pop(args[2], None)
+      elif op == "read" and isinstance(value, str):
+        bytesRead += len(value)
+      elif op == "write" and isinstance(value, (int, long)) and value > 0:
+        bytesWritten += value
+    total = time.time() - begin
+
+    report = {"seconds": total,
+              "bytes_read": bytesRead,
+              "bytes_written": bytesWritten,
+              "ops": {}}
+    calls = 0
+    for op, values in latencies.iteritems():
+      values.sort()
+      calls += len(values)
+      report["ops"][op] = {"calls": len(values),
+                           "errors": errors.get(op, 0),
+                           "p50": percentile(values, 0.50),
+                           "p90": percentile(values, 0.90),
+                           "p99": percentile(values, 0.99),
+                           "max": values[-1]}
+    report["calls"] = calls
+    report["ops_per_second"] = (calls / total) if total > 0 else 0
+    report["read_mb_per_second"] = (bytesRead / total / 1048576) if total > 0 else 0
+    report["write_mb_per_second"] = (bytesWritten / total / 1048576) if total > 0 else 0
+    return report
+
+  def _decode(self, field):
+    tag, value = field[:1], field[1:]
+    if tag == "h":
+      return self.handles.get(field)
+    if tag == "b":
+      n = int(value)
+      buf = self.buffers.get(n)
+      if buf is None:
+        buf = "\x5a" * n
+        self.buffers[n] = buf
+      return buf
+    if tag == "i":
+      return int(value)
+    if tag == "t":
+      return tuple(float(x) for x in value.split(","))
+    if tag == "s":
+      return value.decode("string_escape")
+    return None
+
+def main():
+  usage = """%prog replays a trace recorded with sha1fs.py --trace against a scratch root and
+database without mounting anything.  [options] tracefile"""
+  parser = OptionParser(usage = usage)
+  parser.add_option("--root",
+                    dest = "root",
+                    help = "scratch directory to replay the trace against (required)",
+                    metavar="ROOT")
+  parser.add_option("--database",
+                    dest = "database",
+                    help = "scratch SQLite checksum database (required)",
+                    metavar="DATABASE")
+  parser.add_option("--use-md5",
+                    action = "store_true",
+                    dest = "useMd5",
+                    default = False,
+                    help = "Use the (faster) MD5 checksum instead of SHA1.")
+  parser.add_option("--no-populate",
+                    action = "store_false",
+                    dest = "populate",
+                    default = True,
+                    help = "Don't create the files the trace expects to exist before replaying.")
+
+  (options, args) = parser.parse_args()
+
+  if len(args) != 1:
+    parser.error("You must give the trace file to replay.")
+  if not options.root or not options.database:
+    parser.error("--root and --database are required.")
+
+  # imported here as sha1fs needs fuse-python, which recording inside sha1fs does not
+  from sha1fs import Sha1FS
+
+  tracefile = os.path.abspath(args[0])
+  root = os.path.abspath(options.root)
+  if not os.path.isdir(root):
+    os.makedirs(root)
+
+  server = Sha1FS()
+  # an empty command line, so that fsinit sees the same state it would after a real mount
+  server.parse(args=[], values=server, errex=1)
+  server.root = root
+  server.database = os.path.abspath(options.database)
+  server.useMd5 = options.useMd5
+  server.initDB()
+
+  replayer = TraceReplayer(server)
+  if options.populate:
+    replayer.prepareRoot(tracefile, root)
+
+  os.chdir(root)
+  server.fsinit()
+  report = replayer.replay(tracefile)
+  server.fsdestroy()
+
+  print json.dumps(report, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+  main()
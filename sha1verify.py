@@ -0,0 +1,161 @@
+# Scrubbing: checks stored checksums against the data to find files that changed on their own
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+# Bytes read at a time, and the unit the bandwidth cap is applied in
+READ_SIZE = 1048576
+
+# Files verified between checkpoints
+BATCH_SIZE = 256
+
+# Name of the checkpoint kept in the database by full verifications
+CHECKPOINT = "verify"
+
+class RateLimiter(object):
+  """Token bucket shared by several threads, limiting them to rate bytes a second in total (no
+  limit if rate is 0).  Up to a second's worth of unused allowance can be saved up."""
+  def __init__(self, rate):
+    self.rate = rate
+    self.lock = threading.Lock()
+    self.allowance = rate
+    self.last = time.time()
+
+  def consume(self, nbytes):
+    """Waits until nbytes may be read."""
+    if self.rate <= 0:
+      return
+    with self.lock:
+      now = time.time()
+      self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+      self.last = now
+      self.allowance -= nbytes
+      wait = -self.allowance / self.rate
+    if wait > 0:
+      time.sleep(wait)
+
+def hashFile(path, funcs, limiter):
+  """Returns the hex digests of the file at path for each of the checksum functions, reading it
+  once at no more than the limiter allows."""
+  ms = [func() for func in funcs]
+  with open(path, 'rb') as fobj:
+    while True:
+      limiter.consume(READ_SIZE)
+      d = fobj.read(READ_SIZE)
+      if not d:
+        break
+      for m in ms:
+        m.update(d)
+  return [m.hexdigest() for m in ms]
+
+class Verifier(object):
+  """Rehashes files whose size and mtime are still the ones recorded with their checksums and
+  compares the result with every stored digest.  A file that fails that has changed without its
+  stat changing, which means corruption.  Every file that isn't ok is written to out as one JSON
+  object per line, followed by a summary object.
+
+    sha1db - the Sha1DB to verify
+    workers - the number of files hashed at once
+    bandwidth - the most bytes read a second across all workers, or 0 for no limit
+    out - the file the results are written to
+  """
+  def __init__(self, sha1db, workers=4, bandwidth=0, out=None):
+    self.sha1db = sha1db
+    self.workers = workers
+    self.limiter = RateLimiter(bandwidth)
+    self.out = out
+    self.funcs = dict([(sha1db.checksumName, sha1db.checksum)] + sha1db.algorithms)
+    self.counts = dict((status, 0) for status in ("ok", "mismatch", "changed", "missing", "error"))
+    self.bytes = 0
+
+  def run(self, sample=None, restart=False):
+    """Verifies every file, in path order, starting after the saved checkpoint unless restart is
+    true; or if sample is given, that many files picked at random (without checkpoints).  Returns
+    the summary."""
+    start = time.time()
+    pool = ThreadPool(self.workers)
+    try:
+      if sample is not None:
+        for row in self._verifyRows(pool, self.sha1db.randomFiles(sample)):
+          pass
+      else:
+        after = None if restart else self.sha1db.getCheckpoint(CHECKPOINT)
+        if after is not None:
+          logging.info("Resuming verification after %s" % after)
+        while True:
+          rows = self.sha1db.filesAfter(after, BATCH_SIZE)
+          if len(rows) <= 0:
+            break
+          try:
+            for row in self._verifyRows(pool, rows):
+              after = row[0]
+          finally:
+            # whatever happens, the next run carries on after the last file finished
+            self.sha1db.setCheckpoint(CHECKPOINT, after)
+        self.sha1db.setCheckpoint(CHECKPOINT, None)
+    finally:
+      pool.terminate()
+
+    summary = dict(self.counts)
+    summary.update({"status": "summary", "bytes": self.bytes, "elapsed": time.time() - start})
+    self._write(summary)
+    return summary
+
+  # Verifies the rows (see Sha1DB.filesAfter) on the pool, yielding each row in order once its
+  # result has been written
+  def _verifyRows(self, pool, rows):
+    for (row, (result, nbytes)) in itertools.izip(rows, pool.imap(self._verify, rows)):
+      self.counts[result["status"]] += 1
+      self.bytes += nbytes
+      if result["status"] != "ok":
+        self._write(result)
+      yield row
+
+  # Verifies one file, returning its result and the number of bytes read
+  def _verify(self, row):
+    (path, size, mtime, digests) = row
+    result = {"path": path, "status": "ok"}
+    try:
+      st = os.stat(path)
+    except OSError:
+      result["status"] = "missing"
+      return (result, 0)
+    if size is None or size != st.st_size or mtime != st.st_mtime:
+      # changed through some other route since it was hashed; nothing to compare with
+      result["status"] = "changed"
+      return (result, 0)
+
+    names = sorted(name for name in digests.keys() if name in self.funcs)
+    try:
+      actual = hashFile(path, [self.funcs[name] for name in names], self.limiter)
+    except EnvironmentError as einst:
+      result.update({"status": "error", "error": str(einst)})
+      return (result, 0)
+    for (name, digest) in zip(names, actual):
+      if digest != digests[name]:
+        if os.stat(path).st_mtime != mtime:
+          # written to while it was being read
+          result["status"] = "changed"
+        else:
+          logging.error("%s does not match its stored %s" % (path, name))
+          result.update({"status": "mismatch", "algorithm": name, "expected": digests[name],
+                         "actual": digest, "size": size, "mtime": mtime})
+        break
+    return (result, size)
+
+  def _write(self, obj):
+    if self.out is not None:
+      self.out.write(json.dumps(obj, sort_keys=True) + "\n")
+      self.out.flush()
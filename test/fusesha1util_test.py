@@ -50,6 +50,18 @@ class TestSha1FuseUtil(unittest.TestCase):
 		self.assertEqual("9519b846c2b3a933bd348cc983f3796180ad2761", fsu.fileChecksum(self._sha1file))
 		self.assertEqual("5af12c8f98e305b8ecfd91a4d5d0a302", fsu.fileChecksum(self._sha1file, hashlib.md5))
 
+	def testFileChecksums(self):
+		self.assertRaises(IOError, lambda: fsu.fileChecksums(None, [hashlib.sha1]))
+		sha256 = fsu.hashConstructor("sha256")
+		self.assertEqual(["9519b846c2b3a933bd348cc983f3796180ad2761", "5af12c8f98e305b8ecfd91a4d5d0a302",
+			fsu.fileChecksum(self._sha1file, sha256)],
+			fsu.fileChecksums(self._sha1file, [hashlib.sha1, hashlib.md5, sha256]))
+
+	def testHashConstructor(self):
+		self.assertEqual(hashlib.md5, fsu.hashConstructor("md5"))
+		self.assertRaises(ValueError, lambda: fsu.hashConstructor("nosuchhash"))
+		self.assertRaises(ValueError, lambda: fsu.hashConstructor("sha1; drop table files"))
+
 	def testLinkFileBad(self):
 		self.assertRaises(OSError, lambda: fsu.linkFile(None, None))
 		self.assertRaises(OSError, lambda: fsu.linkFile("", ""))
@@ -135,6 +147,20 @@ class TestSha1FuseUtil(unittest.TestCase):
 		fsu.safeUnlink(testfile)
 		self.assertFalse(os.path.exists(testfile))
 
+	def testLRUCache(self):
+		cache = fsu.LRUCache(2)
+		cache.put("a", 1)
+		cache.put("b", 2)
+		self.assertEqual(1, cache.get("a"))
+		# b is now the least recently used
+		cache.put("c", 3)
+		self.assertEqual(None, cache.get("b"))
+		self.assertEqual(1, cache.get("a"))
+		self.assertEqual(3, cache.get("c"))
+		cache.discard("a")
+		self.assertEqual("missing", cache.get("a", "missing"))
+		self.assertEqual(1, len(cache))
+
 	def assertSymlink(self, link):
 		self.assertTrue(os.path.exists(link))
 		self.assertTrue(os.path.islink(link))
@@ -0,0 +1,86 @@
+# Tests for the content defined chunking
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import os
+import random
+import hashlib
+import shutil
+import tempfile
+
+sys.path.append("../")
+import sha1chunk
+
+class TestSha1Chunk(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		rng = random.Random(0)
+		self.data = "".join(chr(rng.getrandbits(8)) for i in xrange(500000))
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def chunk(self, name, contents):
+		path = os.path.join(self.tmpdir, name)
+		with open(path, "wb") as f:
+			f.write(contents)
+		return sha1chunk.chunkFile(path)
+
+	def testChunks(self):
+		(chksum, chunks) = self.chunk("a", self.data)
+		self.assertEqual(hashlib.sha1(self.data).hexdigest(), chksum)
+		offset = 0
+		for (start, size, digest) in chunks:
+			self.assertEqual(offset, start)
+			self.assertTrue(size <= sha1chunk.MAX_CHUNK)
+			self.assertEqual(hashlib.sha1(self.data[start:start + size]).hexdigest(), digest)
+			offset += size
+		self.assertEqual(len(self.data), offset)
+		self.assertTrue(len(chunks) > 10)
+
+	def testInsertKeepsChunks(self):
+		(chksum, chunks) = self.chunk("a", self.data)
+		(chksum, shifted) = self.chunk("b", "header" + self.data[:250000] + "x" + self.data[250000:])
+		before = set(digest for (offset, size, digest) in chunks)
+		after = set(digest for (offset, size, digest) in shifted)
+		# only the chunks around the two edits differ
+		self.assertTrue(len(before - after) <= 4)
+
+	def testInsertKeepsChunksWithoutNewlines(self):
+		data = self.data.replace("\n", "\x0b")
+		(chksum, chunks) = self.chunk("a", data)
+		(chksum, shifted) = self.chunk("b", "header" + data[:250000] + "x" + data[250000:])
+		self.assertTrue(len(chunks) > 10)
+		before = set(digest for (offset, size, digest) in chunks)
+		after = set(digest for (offset, size, digest) in shifted)
+		self.assertTrue(len(before - after) <= 4)
+
+	def testConstantRunIsCutAtMaxChunk(self):
+		(chksum, chunks) = self.chunk("zeros", "\0" * 300000)
+		self.assertEqual([sha1chunk.MAX_CHUNK] * 4, [size for (offset, size, digest) in chunks[:4]])
+
+	def testWindowMarks(self):
+		data = self.data[:5000]
+		table = [ord(c) for c in sha1chunk.TABLE]
+		expected = []
+		for i in xrange(len(data)):
+			h = 0
+			for c in data[max(i + 1 - sha1chunk.WINDOW, 0):i + 1]:
+				h ^= table[ord(c)]
+			expected.append(chr(h))
+		self.assertEqual("".join(expected), sha1chunk.windowMarks(data))
+		self.assertEqual("".join(expected)[3000:], sha1chunk.windowMarks(data[3000:], data[:3000]))
+
+	def testEmptyFile(self):
+		(chksum, chunks) = self.chunk("empty", "")
+		self.assertEqual(hashlib.sha1("").hexdigest(), chksum)
+		self.assertEqual([], chunks)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,556 @@
+# Tests for the checksum database
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import os
+import hashlib
+import multiprocessing
+import shutil
+import StringIO
+import tempfile
+import threading
+import time
+
+sys.path.append("../")
+from fusesha1util import sqliteConn
+from sha1db import Sha1DB, DIRTY_ATTEMPTS
+from sha1ignore import IgnoreRules
+from sha1stats import STATS
+
+# Updates the checksums of paths one at a time, as a mount's release does, putting the slowest
+# update and the number of times the database was found locked on results
+def releaseFiles(database, paths, results):
+	sha1db = Sha1DB(database)
+	slowest = 0
+	for path in paths:
+		start = time.time()
+		sha1db.updateChecksum(path)
+		slowest = max(slowest, time.time() - start)
+	results.put((slowest, STATS.snapshot().get("sqlite.busy", {}).get("calls", 0)))
+
+# Runs the maintenance commands over root repeatedly, as sha1db.py would
+def maintain(database, root, rounds, results):
+	sha1db = Sha1DB(database)
+	for i in range(rounds):
+		sha1db.updateAllChecksums(root)
+		sha1db.vacuum()
+	results.put((0, STATS.snapshot().get("sqlite.busy", {}).get("calls", 0)))
+
+class TestSha1DB(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.root = os.path.join(self.tmpdir, "root")
+		os.mkdir(self.root)
+		self.database = os.path.join(self.tmpdir, "sha1.db")
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def makeFile(self, name, contents):
+		path = os.path.join(self.root, name)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		with open(path, "wb") as f:
+			f.write(contents)
+		return path
+
+	def testUpgradeOldSchema(self):
+		with sqliteConn(self.database) as cursor:
+			cursor.execute("create table files(path varchar not null primary key, chksum varchar not null, symlink boolean default 0);")
+			cursor.execute("create table versioning(chksum_type varchar not null);")
+			cursor.execute("insert into versioning(chksum_type) values('md5');")
+			cursor.execute("insert into files(path, chksum) values('/old', 'abc');")
+			cursor.execute("create table dirty(path varchar not null primary key, size integer, mtime real);")
+			cursor.execute("insert into dirty(path) values('/old');")
+		sha1db = Sha1DB(self.database)
+		self.assertEqual("md5", sha1db.checksumName)
+		with sqliteConn(self.database) as cursor:
+			cursor.execute("select attempts from dirty;")
+			self.assertEqual([(0, )], cursor.fetchall())
+		self.assertEqual(("abc", None, None), tuple(sha1db.lookupChecksum("/old")))
+		# files from before the change log are in it
+		self.assertEqual(["/old"], [change["path"] for change in sha1db.changesSince(0)])
+
+	def testFreshChecksum(self):
+		sha1db = Sha1DB(self.database)
+		path = self.makeFile("a.txt", "hello")
+		self.assertEqual(None, sha1db.freshChecksum(path))
+		sha1db.updateChecksum(path)
+		self.assertEqual(hashlib.sha1("hello").hexdigest(), sha1db.freshChecksum(path))
+
+		with open(path, "ab") as f:
+			f.write(" world")
+		self.assertEqual(None, sha1db.freshChecksum(path))
+		self.assertEqual(hashlib.sha1("hello world").hexdigest(), sha1db.freshChecksum(path, True))
+
+	def testUpdatePathAndRemove(self):
+		sha1db = Sha1DB(self.database)
+		path = self.makeFile("dir/a.txt", "hello")
+		sha1db.updateChecksum(path)
+		sha1db.updatePath(os.path.join(self.root, "dir"), os.path.join(self.root, "moved"))
+		self.assertEqual(None, sha1db.lookupChecksum(path))
+		moved = os.path.join(self.root, "moved", "a.txt")
+		self.assertEqual(hashlib.sha1("hello").hexdigest(), sha1db.lookupChecksum(moved)[0])
+		sha1db.removeChecksum(moved)
+		self.assertEqual(None, sha1db.lookupChecksum(moved))
+
+	def testChecksumLookups(self):
+		sha1db = Sha1DB(self.database)
+		for name in ("b.txt", "a.txt", "sub/c.txt"):
+			sha1db.updateChecksum(self.makeFile(name, "same"))
+		sha1db.updateChecksum(self.makeFile("d.txt", "different"))
+		chksum = hashlib.sha1("same").hexdigest()
+		self.assertEqual([os.path.join(self.root, "a.txt")], sha1db.pathsForChecksum(chksum, self.root, 1))
+		self.assertEqual([os.path.join(self.root, "sub", "c.txt")],
+			sha1db.pathsForChecksum(chksum, os.path.join(self.root, "sub")))
+		self.assertEqual([], sha1db.pathsForChecksum(chksum, self.root + "x"))
+		self.assertEqual([chksum], sha1db.checksumsWithPrefix(chksum[:2], self.root))
+		self.assertEqual([], sha1db.checksumsWithPrefix(chksum[:2], os.path.join(self.root, "none")))
+
+	def testDirty(self):
+		sha1db = Sha1DB(self.database)
+		a = self.makeFile("a.txt", "hello")
+		b = self.makeFile("dir/b.txt", "world")
+		sha1db.markDirty(a)
+		sha1db.markDirty(b)
+		self.assertEqual([a, b], sha1db.dirtyPaths())
+		self.assertEqual(None, sha1db.lookupChecksum(a))
+
+		# asking for the checksum of a dirty file calculates it
+		self.assertEqual(hashlib.sha1("hello").hexdigest(), sha1db.freshChecksum(a))
+		self.assertFalse(sha1db.isDirty(a))
+
+		# moves and removals never hash
+		moved = os.path.join(self.root, "moved", "b.txt")
+		sha1db.updatePath(os.path.join(self.root, "dir"), os.path.join(self.root, "moved"))
+		self.assertEqual([moved], sha1db.dirtyPaths())
+		sha1db.removeChecksum(moved)
+		self.assertEqual([], sha1db.dirtyPaths())
+		self.assertEqual(None, sha1db.lookupChecksum(moved))
+
+		sha1db.markDirty(b)
+		os.remove(b)
+		sha1db.markDirty(self.makeFile("c.txt", "again"))
+		self.assertEqual(2, sha1db.hashDirty())
+		self.assertEqual([], sha1db.dirtyPaths())
+		self.assertEqual(None, sha1db.lookupChecksum(b))
+		self.assertEqual(hashlib.sha1("again").hexdigest(),
+			sha1db.lookupChecksum(os.path.join(self.root, "c.txt"))[0])
+
+		# a file that can't be read goes behind the others, until it has failed too often
+		unreadable = os.path.join(self.root, "unreadable")
+		os.mkdir(unreadable)
+		sha1db.markDirty(unreadable)
+		d = self.makeFile("d.txt", "later")
+		sha1db.markDirty(d)
+		self.assertEqual(0, sha1db.hashDirty(1))
+		self.assertEqual([d, unreadable], sha1db.dirtyPaths())
+		self.assertEqual(1, sha1db.hashDirty(1))
+		for i in range(DIRTY_ATTEMPTS - 1):
+			self.assertEqual([unreadable], sha1db.dirtyPaths())
+			self.assertEqual(0, sha1db.hashDirty())
+		self.assertEqual([], sha1db.dirtyPaths())
+
+	def testUpdateBlocks(self):
+		sha1db = Sha1DB(self.database)
+		path = self.makeFile("big.bin", os.urandom(10000))
+		self.assertEqual(10, sha1db.updateBlocks(path, 1000))
+		opened = os.stat(path)
+
+		with open(path, "r+b") as f:
+			f.seek(4500)
+			f.write("x" * 100)
+			f.seek(10500)
+			f.write("y")
+		self.assertEqual(3, sha1db.updateBlocks(path, 1000, [(4500, 4600), (10500, 10501)], opened))
+		partial = sha1db.lookupMerkle(path)[0]
+		sha1db.removeChecksum(path)
+		self.assertEqual(None, sha1db.lookupMerkle(path))
+		self.assertEqual(11, sha1db.updateBlocks(path, 1000))
+		self.assertEqual(partial, sha1db.lookupMerkle(path)[0])
+
+		# ranges are ignored when the file isn't the one the digests were calculated for
+		with open(path, "r+b") as f:
+			f.truncate(2500)
+		self.assertEqual(3, sha1db.updateBlocks(path, 1000, [], opened))
+
+	def testChunks(self):
+		sha1db = Sha1DB(self.database, chunking=True)
+		data = os.urandom(200000)
+		a = self.makeFile("one/a.bin", data)
+		b = self.makeFile("two/b.bin", "header" + data)
+		sha1db.updateChecksum(a)
+		sha1db.updateChecksum(b)
+		self.assertEqual(hashlib.sha1(data).hexdigest(), sha1db.lookupChecksum(a)[0])
+
+		report = sha1db.chunkReport()
+		self.assertEqual(2, report["files"])
+		self.assertEqual(2 * len(data) + 6, report["logicalBytes"])
+		(shared, first, second) = report["filePairs"][0]
+		self.assertEqual((a, b), (first, second))
+		self.assertTrue(shared > len(data) / 2)
+		self.assertEqual([(shared, os.path.dirname(a), os.path.dirname(b))], report["dirPairs"])
+
+		# rewriting and removing files keeps the reference counts right
+		self.makeFile("two/b.bin", "other")
+		sha1db.updateChecksum(b)
+		sha1db.removeChecksum(a)
+		with sqliteConn(self.database) as cursor:
+			cursor.execute("select sum(size), sum(refs) from chunks;")
+			self.assertEqual((5, 1), tuple(cursor.fetchone()))
+
+	def testAlgorithms(self):
+		sha1db = Sha1DB(self.database, algorithm="md5")
+		a = self.makeFile("a.txt", "hello")
+		sha1db.updateChecksum(a)
+		sha1db.addAlgorithm("sha256")
+		self.assertRaises(ValueError, lambda: sha1db.addAlgorithm("md5"))
+		self.assertEqual(["sha256"], sha1db.incompleteAlgorithms())
+
+		# new files get every digest when they are hashed; old ones when they are backfilled
+		b = self.makeFile("b.txt", "world")
+		sha1db.updateChecksum(b)
+		self.assertEqual({"md5": hashlib.md5("world").hexdigest(),
+			"sha256": hashlib.sha256("world").hexdigest()}, sha1db.lookupDigests(b))
+		self.assertEqual({"md5": hashlib.md5("hello").hexdigest()}, sha1db.lookupDigests(a))
+		self.assertEqual(1, sha1db.backfillAlgorithms())
+		self.assertEqual(hashlib.sha256("hello").hexdigest(), sha1db.lookupDigests(a)["sha256"])
+		self.assertEqual([], sha1db.incompleteAlgorithms())
+
+		reopened = Sha1DB(self.database)
+		self.assertEqual("md5", reopened.checksumName)
+		self.assertEqual([], reopened.incompleteAlgorithms())
+		self.assertEqual(0, reopened.backfillAlgorithms())
+
+		# a process that loaded the algorithms before one was added and completed elsewhere stores
+		# a file without its digest: the algorithm is incomplete again, and the process catches up
+		reopened.addAlgorithm("sha1")
+		self.assertEqual(2, reopened.backfillAlgorithms())
+		self.makeFile("a.txt", "changed")
+		sha1db.updateChecksum(a)
+		self.assertEqual(None, sha1db.lookupDigests(a).get("sha1"))
+		self.assertEqual(["sha1"], Sha1DB(self.database).incompleteAlgorithms())
+		self.assertEqual(1, reopened.backfillAlgorithms())
+		self.assertEqual(hashlib.sha1("changed").hexdigest(), reopened.lookupDigests(a)["sha1"])
+		self.assertEqual([], reopened.incompleteAlgorithms())
+		sha1db.updateChecksum(b)
+		self.assertEqual(hashlib.sha1("world").hexdigest(), sha1db.lookupDigests(b)["sha1"])
+
+	def testDedup(self):
+		sha1db = Sha1DB(self.database)
+		a = self.makeFile("a.txt", "same")
+		b = self.makeFile("dir/b.txt", "same")
+		c = self.makeFile("dir/c.txt", "same")
+		self.makeFile("unique.txt", "unique")
+		sha1db.updateAllChecksums(self.root)
+		dupdir = os.path.join(self.tmpdir, "dups")
+		sha1db.dedup(dupdir, False)
+		# the first of the group stays where it was, and only the others are moved
+		self.assertEqual("same", open(a).read())
+		self.assertNotEqual(None, sha1db.lookupChecksum(a))
+		for path in (b, c):
+			self.assertFalse(os.path.exists(path))
+			self.assertEqual(None, sha1db.lookupChecksum(path))
+		self.assertEqual(2, sum(len(files) for (root, dirs, files) in os.walk(dupdir)))
+
+		d = self.makeFile("d.txt", "other")
+		e = self.makeFile("dir/e.txt", "other")
+		sha1db.updateAllChecksums(self.root)
+		sha1db.dedup(os.path.join(self.tmpdir, "dups2"), True)
+		self.assertFalse(os.path.islink(d))
+		self.assertEqual(os.path.abspath(d), os.readlink(e))
+		self.assertEqual("other", open(e).read())
+
+	def testFindDuplicates(self):
+		sha1db = Sha1DB(self.database)
+		data = os.urandom(300000)
+		a = self.makeFile("a.bin", data)
+		b = self.makeFile("dir/b.bin", data)
+		# same size, sample and all, but different in the middle
+		self.makeFile("c.bin", data[:150000] + "x" + data[150001:])
+		self.makeFile("unique.bin", os.urandom(1000))
+		small1 = self.makeFile("small1.txt", "small")
+		small2 = self.makeFile("small2.txt", "small")
+		self.makeFile("empty1", "")
+		self.makeFile("empty2", "")
+
+		(groups, totalBytes, readBytes) = sha1db.findDuplicates(self.root, 1000)
+		self.assertEqual([[a, b], [small1, small2]], groups)
+		self.assertEqual(3 * 300000 + 1000 + 10, totalBytes)
+		# three samples and two small files, then three full reads of the sample matches
+		self.assertEqual(3 * 2000 + 10 + 3 * 300000, readBytes)
+		self.assertEqual(hashlib.sha1("small").hexdigest(), sha1db.lookupChecksum(small1)[0])
+		# nothing is hard linked by a scan
+		self.assertNotEqual(os.stat(a).st_ino, os.stat(b).st_ino)
+
+		# the second scan only reads what changed
+		self.makeFile("unique2.bin", os.urandom(1000))
+		(groups, totalBytes, readBytes) = sha1db.findDuplicates(self.root, 1000)
+		self.assertEqual([[a, b], [small1, small2]], groups)
+		self.assertEqual(2 * 1000, readBytes)
+
+	def testCheckpoints(self):
+		sha1db = Sha1DB(self.database)
+		self.assertEqual(None, sha1db.getCheckpoint("verify"))
+		sha1db.setCheckpoint("verify", "/a")
+		self.assertEqual("/a", sha1db.getCheckpoint("verify"))
+		sha1db.setCheckpoint("verify", None)
+		self.assertEqual(None, sha1db.getCheckpoint("verify"))
+
+	def testChanges(self):
+		sha1db = Sha1DB(self.database)
+		a = self.makeFile("a.txt", "one")
+		b = self.makeFile("b.txt", "two")
+		c = os.path.join(self.root, "c.txt")
+		d = self.makeFile("d.txt", "three")
+		sha1db.updateChecksum(a)
+		sha1db.updateChecksum(b)
+		mark = sha1db.lastChange()
+		self.assertEqual(2, mark)
+		# rehashing an unchanged file changes nothing
+		sha1db.updateChecksum(a)
+		self.assertEqual(mark, sha1db.lastChange())
+		with sqliteConn(self.database) as cursor:
+			cursor.execute("select count(*) from tree_deltas;")
+			self.assertEqual(2, cursor.fetchone()[0])
+
+		self.makeFile("a.txt", "changed")
+		sha1db.updateChecksum(a)
+		os.rename(b, c)
+		sha1db.updatePath(b, c)
+		sha1db.updateChecksum(d)
+		sha1db.removeChecksum(d)
+		def net(seq):
+			return sorted((change["seq"], change["path"], change["op"], change.get("digest"))
+				for change in sha1db.changesSince(seq))
+		expected = [(3, a, "update", hashlib.sha1("changed").hexdigest()), (4, b, "remove", None),
+			(4, c, "update", hashlib.sha1("two").hexdigest()), (6, d, "remove", None)]
+		self.assertEqual(expected, net(mark))
+		self.assertEqual(expected, net(0))
+		self.assertEqual([], net(6))
+
+		# only the changes superseded by later ones go, which changes nothing for any seq
+		before = [net(seq) for seq in range(7)]
+		self.assertEqual(3, sha1db.compactChanges())
+		self.assertEqual(before, [net(seq) for seq in range(7)])
+
+		self.assertEqual(3, sha1db.pruneChanges(0))
+		self.assertRaises(ValueError, lambda: list(sha1db.changesSince(mark)))
+		self.assertEqual([], net(6))
+		self.assertEqual(6, sha1db.lastChange())
+
+	def testTreeDigests(self):
+		sha1db = Sha1DB(self.database)
+		for top in ("one", "two"):
+			for (name, contents) in (("a.txt", "a"), ("sub/b.txt", "b"), ("sub/deeper/c.txt", "c")):
+				sha1db.updateChecksum(self.makeFile(os.path.join(top, name), contents))
+		one = os.path.join(self.root, "one")
+		two = os.path.join(self.root, "two")
+		# identical trees have the same digest wherever they are
+		self.assertEqual(sha1db.treeDigest(one), sha1db.treeDigest(two + "/"))
+		self.assertEqual([one, two], [path for (path, digest) in sha1db.treeChildren(self.root)])
+		before = sha1db.treeDigest(two)
+
+		c = self.makeFile("two/sub/deeper/c.txt", "changed")
+		sha1db.updateChecksum(c)
+		self.assertNotEqual(sha1db.treeDigest(one), sha1db.treeDigest(two))
+		self.assertNotEqual(dict(sha1db.treeChildren(one + "/sub")).values(),
+			dict(sha1db.treeChildren(two + "/sub")).values())
+		self.makeFile("two/sub/deeper/c.txt", "c")
+		sha1db.updateChecksum(c)
+		self.assertEqual(before, sha1db.treeDigest(two))
+
+		# renaming a file changes the digest, and renaming it back restores it
+		os.rename(c, c + ".moved")
+		sha1db.updatePath(c, c + ".moved")
+		self.assertNotEqual(before, sha1db.treeDigest(two))
+		os.rename(c + ".moved", c)
+		sha1db.updatePath(c + ".moved", c)
+		self.assertEqual(before, sha1db.treeDigest(two))
+
+		# the same as a database filled in another order from scratch
+		other = Sha1DB(os.path.join(self.tmpdir, "other.db"))
+		for name in ("sub/deeper/c.txt", "a.txt", "sub/b.txt"):
+			other.updateChecksum(os.path.join(two, name))
+		self.assertEqual(before, other.treeDigest(two))
+
+		for name in ("a.txt", "sub/b.txt", "sub/deeper/c.txt"):
+			sha1db.removeChecksum(os.path.join(two, name))
+		self.assertEqual(None, sha1db.treeDigest(two))
+		self.assertEqual([one], [path for (path, digest) in sha1db.treeChildren(self.root)])
+
+	def testConcurrentTreeFolds(self):
+		sha1db = Sha1DB(self.database)
+		other = Sha1DB(self.database)
+		paths = [self.makeFile("d%d/f%d.txt" % (i % 3, i), "file %d" % i) for i in range(20)]
+		for path in paths:
+			sha1db.updateChecksum(path)
+
+		# one fold is held just before it applies its batch while the other runs
+		folding = threading.Event()
+		release = threading.Event()
+		fold = sha1db._foldTreeDeltas
+		def held(cursor, rows):
+			folding.set()
+			release.wait(10)
+			fold(cursor, rows)
+		sha1db._foldTreeDeltas = held
+		first = threading.Thread(target=sha1db.updateTrees)
+		first.start()
+		folding.wait(10)
+		second = threading.Thread(target=other.updateTrees)
+		second.start()
+		time.sleep(0.2)
+		release.set()
+		first.join()
+		second.join()
+
+		# each change was folded in once
+		scratch = Sha1DB(os.path.join(self.tmpdir, "scratch.db"))
+		for path in paths:
+			scratch.updateChecksum(path)
+		self.assertEqual(scratch.treeDigest(self.root), other.treeDigest(self.root))
+		self.assertEqual(20, other.dirReport(self.root)[0]["files"])
+
+	def testDirReport(self):
+		sha1db = Sha1DB(self.database)
+		def expected(path):
+			with sqliteConn(self.database) as cursor:
+				cursor.execute("select path, chksum, size from files where symlink = 0;")
+				rows = cursor.fetchall()
+			copies = {}
+			for (p, chksum, size) in rows:
+				copies[chksum] = copies.get(chksum, 0) + 1
+			below = [(chksum, size) for (p, chksum, size) in rows if p.startswith(path + "/")]
+			dups = [size for (chksum, size) in below if copies[chksum] > 1]
+			return {"path": path, "files": len(below), "bytes": sum(size for (c, size) in below),
+				"dupFiles": len(dups), "dupBytes": sum(dups), "uniqueFiles": len(below) - len(dups)}
+		def check():
+			for path in (self.root, os.path.join(self.root, "one"), os.path.join(self.root, "two")):
+				report = sha1db.dirReport(path)
+				self.assertEqual(expected(path), report[0])
+				for entry in report[1]:
+					self.assertEqual(expected(entry["path"]), entry)
+
+		a = self.makeFile("one/a.txt", "aaaa")
+		b = self.makeFile("one/sub/b.txt", "bb")
+		c = self.makeFile("two/c.txt", "aaaa")
+		for path in (a, b, c):
+			sha1db.updateChecksum(path)
+		check()
+		(totals, top) = sha1db.dirReport(self.root, 2)
+		self.assertEqual((3, 10, 2, 8), (totals["files"], totals["bytes"], totals["dupFiles"],
+			totals["dupBytes"]))
+		self.assertEqual([4, 4], [entry["dupBytes"] for entry in top])
+
+		# rehashing, a copy that stops being one, a rename and a removal
+		sha1db.updateChecksum(a)
+		check()
+		self.makeFile("two/c.txt", "ccccc")
+		sha1db.updateChecksum(c)
+		check()
+		self.assertEqual(0, sha1db.dirReport(self.root)[0]["dupBytes"])
+		self.makeFile("one/sub/d.txt", "bb")
+		sha1db.updateChecksum(os.path.join(self.root, "one/sub/d.txt"))
+		os.rename(b, c + ".moved")
+		sha1db.updatePath(b, c + ".moved")
+		check()
+		sha1db.removeChecksum(c + ".moved")
+		check()
+		# a symlink left by dedup doesn't count
+		with sqliteConn(self.database) as cursor:
+			cursor.execute("update files set symlink = 1 where path = ?;", (a, ))
+		check()
+		self.assertEqual(None, sha1db.dirReport(os.path.join(self.root, "none")))
+
+	def testManifests(self):
+		sha1db = Sha1DB(self.database)
+		paths = [self.makeFile("a.txt", "one"), self.makeFile("sub/b.txt", "two"),
+			self.makeFile("odd\\name\n.txt", "three")]
+		for path in paths:
+			sha1db.updateChecksum(path)
+		out = StringIO.StringIO()
+		self.assertEqual(3, sha1db.exportManifest(out))
+		lines = out.getvalue().splitlines()
+		# as sha1sum prints them, escaping the odd name
+		self.assertEqual("%s  %s" % (hashlib.sha1("one").hexdigest(), paths[0]), lines[0])
+		self.assertEqual("\\%s  %s" % (hashlib.sha1("three").hexdigest(),
+			paths[2].replace("\\", "\\\\").replace("\n", "\\n")), lines[1])
+		self.assertEqual(3, len(lines))
+
+		# relative to a root, with a file that has gone since the manifest was made
+		manifest = ["%s  ./%s" % (line[:40], line[42 + len(self.root) + 1:]) for line in (lines[0], lines[2])]
+		manifest += ["", hashlib.sha1("x").hexdigest() + " *gone.txt"]
+		other = Sha1DB(os.path.join(self.tmpdir, "other.db"))
+		self.assertEqual((2, 1), other.importManifest(manifest, root=self.root))
+		# with no stat in the manifest, and no time it was made, the files may have changed since
+		self.assertEqual((hashlib.sha1("two").hexdigest(), None, None), other.lookupChecksum(paths[1]))
+		self.assertEqual(None, other.freshChecksum(paths[1]))
+		self.assertEqual((2, 1), other.importManifest(manifest, root=self.root, made=time.time() + 1))
+		self.assertEqual(hashlib.sha1("two").hexdigest(), other.freshChecksum(paths[1]))
+		self.assertEqual([paths[0]], other.pathsForChecksum(hashlib.sha1("one").hexdigest()))
+		self.assertRaises(ValueError, lambda: other.importManifest(["abc  /short.txt"]))
+		self.assertRaises(ValueError, lambda: other.importManifest(["{}"], "json"))
+
+		# JSON carries the stat, so files changed since are skipped unless the manifest is trusted
+		out = StringIO.StringIO()
+		sha1db.exportManifest(out, "json")
+		self.makeFile("a.txt", "changed")
+		for (trust, counts) in ((False, (2, 1)), (True, (3, 0))):
+			other = Sha1DB(os.path.join(self.tmpdir, "json%s.db" % trust))
+			self.assertEqual(counts, other.importManifest(out.getvalue().splitlines(True), "json", trust=trust))
+			self.assertEqual(hashlib.sha1("three").hexdigest(), other.lookupChecksum(paths[2])[0])
+
+	def testIgnore(self):
+		sha1db = Sha1DB(self.database)
+		kept = self.makeFile("a.txt", "hello")
+		swap = self.makeFile(".a.txt.swp", "swap")
+		built = self.makeFile("build/out.o", "object")
+		empty = self.makeFile("empty.txt", "")
+		ignore = IgnoreRules(["*.swp", "build/", "minsize:1"], self.root)
+		sha1db.updateAllChecksums(self.root, ignore)
+		self.assertEqual(hashlib.sha1("hello").hexdigest(), sha1db.lookupChecksum(kept)[0])
+		for path in (swap, built, empty):
+			self.assertEqual(None, sha1db.lookupChecksum(path))
+
+		# files hashed before a rule was added are removed by vacuum
+		sha1db.updateChecksum(swap)
+		sha1db.markDirty(built)
+		sha1db.vacuum(IgnoreRules(["*.swp"], self.root))
+		self.assertEqual(None, sha1db.lookupChecksum(swap))
+		self.assertEqual([built], sha1db.dirtyPaths())
+		self.assertNotEqual(None, sha1db.lookupChecksum(kept))
+		sha1db.vacuum(ignore)
+		self.assertEqual([], sha1db.dirtyPaths())
+
+	def testSharedBetweenProcesses(self):
+		sha1db = Sha1DB(self.database)
+		with sqliteConn(self.database) as cursor:
+			cursor.execute("pragma journal_mode;")
+			self.assertEqual("wal", cursor.fetchone()[0])
+
+		paths = [self.makeFile("p%d/f%d.txt" % (i % 4, i), "file %d" % i) for i in range(200)]
+		results = multiprocessing.Queue()
+		processes = [multiprocessing.Process(target=releaseFiles,
+			args=(self.database, paths[i::4], results)) for i in range(4)]
+		processes.append(multiprocessing.Process(target=maintain, args=(self.database, self.root, 3, results)))
+		for process in processes:
+			process.start()
+		outcomes = [results.get(timeout=120) for process in processes]
+		for process in processes:
+			process.join()
+			self.assertEqual(0, process.exitcode)
+
+		for (i, path) in enumerate(paths):
+			self.assertEqual(hashlib.sha1("file %d" % i).hexdigest(), sha1db.lookupChecksum(path)[0])
+		# nothing waits anywhere near as long as the old 30 second timeout
+		self.assertTrue(max(slowest for (slowest, busy) in outcomes) < 5.0)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,89 @@
+# Tests for comparing checksum databases
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import os
+import json
+import shutil
+import StringIO
+import tempfile
+
+sys.path.append("../")
+import sha1diff
+from fusesha1util import sqliteConn
+from sha1db import Sha1DB
+from sha1diff import Differ, mergeJoin
+
+class TestDiff(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.sha1db = Sha1DB(os.path.join(self.tmpdir, "a.db"))
+		self.other = Sha1DB(os.path.join(self.tmpdir, "b.db"))
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def fill(self, sha1db, entries):
+		with sqliteConn(sha1db.database) as cursor:
+			cursor.executemany("insert into files(path, chksum) values(?, ?);", entries)
+
+	def diff(self, other, *args, **kwargs):
+		out = StringIO.StringIO()
+		summary = Differ(self.sha1db, other, out=out, *args, **kwargs).run()
+		results = [json.loads(line) for line in out.getvalue().splitlines()]
+		self.assertEqual(summary["status"], results.pop()["status"])
+		return (results, summary)
+
+	def testMergeJoin(self):
+		self.assertEqual([(1, "a", None), (2, "b", "B"), (3, None, "C")],
+			list(mergeJoin([(1, "a"), (2, "b")], [(2, "B"), (3, "C")])))
+
+	def testDiff(self):
+		self.fill(self.sha1db, [("/a/same", "1" * 40), ("/a/changed", "2" * 40), ("/a/gone", "3" * 40),
+			("/a/old", "4" * 40), ("/elsewhere", "5" * 40)])
+		self.fill(self.other, [("/b/same", "1" * 40), ("/b/changed", "6" * 40), ("/b/new", "4" * 40),
+			("/b/added", "7" * 40)])
+
+		(results, summary) = self.diff(self.other.database, "/a", "/b/")
+		self.assertEqual([
+			{"status": "extra", "path": "/added", "digest": "7" * 40},
+			{"status": "changed", "path": "/changed", "digest": "2" * 40, "otherDigest": "6" * 40},
+			{"status": "missing", "path": "/gone", "digest": "3" * 40},
+			{"status": "extra", "path": "/new", "digest": "4" * 40},
+			{"status": "missing", "path": "/old", "digest": "4" * 40}], results)
+		self.assertEqual((1, 2, 2, 1, 0), (summary["same"], summary["missing"], summary["extra"],
+			summary["changed"], summary["moved"]))
+
+		# spooled a row at a time, matched by digest
+		sha1diff.FETCH_SIZE = 1
+		try:
+			(results, summary) = self.diff(self.other.database, "/a", "/b", matchDigests=True)
+		finally:
+			sha1diff.FETCH_SIZE = 10000
+		self.assertEqual([
+			{"status": "changed", "path": "/changed", "digest": "2" * 40, "otherDigest": "6" * 40},
+			{"status": "missing", "path": "/gone", "digest": "3" * 40},
+			{"status": "moved", "path": "/old", "otherPath": "/new", "digest": "4" * 40},
+			{"status": "extra", "path": "/added", "digest": "7" * 40}], results)
+
+	def testManifest(self):
+		self.fill(self.sha1db, [("/a/same", "1" * 40), ("/a/changed", "2" * 40)])
+		manifest = os.path.join(self.tmpdir, "SHA1SUMS")
+		with open(manifest, "w") as f:
+			f.write("%s  same\n%s  changed\n" % ("1" * 40, "6" * 40))
+		(results, summary) = self.diff(manifest, "/a")
+		self.assertEqual([{"status": "changed", "path": "/changed", "digest": "2" * 40,
+			"otherDigest": "6" * 40}], results)
+		self.assertEqual(1, summary["same"])
+
+		md5db = Sha1DB(os.path.join(self.tmpdir, "md5.db"), useMd5=True)
+		self.assertRaises(ValueError, self.diff, md5db.database)
+
+if __name__ == '__main__':
+	unittest.main()
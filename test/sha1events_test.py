@@ -0,0 +1,141 @@
+# Tests for the change event stream
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import os
+import hashlib
+import json
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+sys.path.append("../")
+from sha1db import Sha1DB
+from sha1events import EventPublisher, Subscriber
+
+class TestEvents(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.sha1db = Sha1DB(os.path.join(self.tmpdir, "sha1.db"))
+		self.publisher = None
+
+	def tearDown(self):
+		if self.publisher is not None:
+			self.publisher.stop()
+			self.publisher.join()
+		shutil.rmtree(self.tmpdir)
+
+	def makeFile(self, name, contents):
+		path = os.path.join(self.tmpdir, name)
+		with open(path, "wb") as f:
+			f.write(contents)
+		return path
+
+	def readEvents(self, f, count):
+		return [json.loads(f.readline()) for i in range(count)]
+
+	def testSocket(self):
+		self.publisher = EventPublisher(os.path.join(self.tmpdir, "events.sock"))
+		self.publisher.start()
+		self.sha1db.events = self.publisher
+		client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		client.connect(self.publisher.path)
+		f = client.makefile("rb")
+		# events are only queued for subscribers already accepted
+		while len(self.publisher.subscribers) <= 0:
+			self.publisher.stopped.wait(0.01)
+
+		path = self.makeFile("a.txt", "contents")
+		self.sha1db.updateChecksum(path)
+		os.rename(path, path + ".moved")
+		self.sha1db.updatePath(path, path + ".moved")
+		self.sha1db.markDirty(path + ".moved")
+		self.sha1db.removeChecksum(path + ".moved")
+		events = self.readEvents(f, 4)
+		self.assertEqual([1, 2, 3, 4], [event["seq"] for event in events])
+		self.assertEqual({"seq": 1, "op": "update", "path": path, "digest": hashlib.sha1("contents").hexdigest(),
+			"size": 8, "mtime": os.stat(path + ".moved").st_mtime}, events[0])
+		self.assertEqual({"seq": 2, "op": "rename", "path": path + ".moved", "oldPath": path}, events[1])
+		self.assertEqual(("dirty", 8), (events[2]["op"], events[2]["size"]))
+		self.assertEqual({"seq": 4, "op": "remove", "path": path + ".moved"}, events[3])
+		f.close()
+		client.close()
+
+	def testOverflow(self):
+		self.publisher = EventPublisher(os.path.join(self.tmpdir, "events.sock"), 3)
+		self.publisher.start()
+		# a subscriber that never writes anything out
+		subscriber = Subscriber(self.publisher)
+		for seq in range(1, 7):
+			subscriber.queue({"seq": seq, "op": "remove", "path": "/%d" % seq})
+		self.assertEqual([1, 2, 3], [event["seq"] for event in subscriber.events])
+		self.assertEqual(3, subscriber.dropped)
+
+		subscriber.events.clear()
+		subscriber.queue({"seq": 7, "op": "remove", "path": "/7"})
+		self.assertEqual([{"seq": 6, "op": "overflow", "dropped": 3}, {"seq": 7, "op": "remove", "path": "/7"}],
+			list(subscriber.events))
+		self.assertEqual(0, subscriber.dropped)
+
+	def testBackfillPublished(self):
+		self.publisher = EventPublisher(os.path.join(self.tmpdir, "events.sock"))
+		self.publisher.start()
+		# a subscriber that is never started, so its events stay queued
+		subscriber = Subscriber(self.publisher)
+		self.publisher.subscribers.append(subscriber)
+		unchanged = self.makeFile("unchanged.txt", "same")
+		changed = self.makeFile("changed.txt", "before")
+		removed = self.makeFile("removed.txt", "gone")
+		for path in (unchanged, changed, removed):
+			self.sha1db.updateChecksum(path)
+		self.sha1db.addAlgorithm("sha256")
+		self.makeFile("changed.txt", "after, and longer")
+		os.remove(removed)
+		self.sha1db.events = self.publisher
+		self.assertEqual(2, self.sha1db.backfillAlgorithms())
+		# filling in a digest for a file that hasn't changed isn't an event
+		self.assertEqual([("remove", removed, None), ("update", changed, hashlib.sha1("after, and longer").hexdigest())],
+			[(event["op"], event["path"], event.get("digest")) for event in subscriber.events])
+		self.publisher.unsubscribe(subscriber)
+
+	def testCommitsPublishInOrder(self):
+		self.publisher = EventPublisher(os.path.join(self.tmpdir, "events.sock"))
+		self.publisher.start()
+		# a subscriber that is never started, so its events stay queued
+		subscriber = Subscriber(self.publisher)
+		self.publisher.subscribers.append(subscriber)
+		self.sha1db.events = self.publisher
+		path = self.makeFile("a.txt", "contents")
+		self.sha1db.updateChecksum(path)
+		# a write that publishes can't commit while another is between its commit and its events
+		with self.sha1db.publishLock:
+			remover = threading.Thread(target=self.sha1db.removeChecksum, args=(path, ))
+			remover.start()
+			time.sleep(0.2)
+			self.assertNotEqual(None, self.sha1db.lookupChecksum(path))
+		remover.join()
+		self.assertEqual(None, self.sha1db.lookupChecksum(path))
+		self.assertEqual(["update", "remove"], [event["op"] for event in subscriber.events])
+		self.publisher.unsubscribe(subscriber)
+
+	def testFifo(self):
+		fifo = os.path.join(self.tmpdir, "events.fifo")
+		os.mkfifo(fifo)
+		self.publisher = EventPublisher(fifo)
+		self.publisher.start()
+		# published before anything reads the FIFO, so kept until a reader comes
+		self.publisher.publish("remove", "/a")
+		with open(fifo) as f:
+			self.publisher.publish("remove", "/b")
+			self.assertEqual(["/a", "/b"], [event["path"] for event in self.readEvents(f, 2)])
+
+if __name__ == '__main__':
+	unittest.main()
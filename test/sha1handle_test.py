@@ -0,0 +1,132 @@
+# Tests for the Sha1FS file handles
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import os
+import random
+import shutil
+import tempfile
+
+sys.path.append("../")
+import sha1handle
+
+class TestSha1Handle(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.path = os.path.join(self.tmpdir, "data.bin")
+		self.data = os.urandom(1000000)
+		with open(self.path, "wb") as f:
+			f.write(self.data)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def openHandle(self, flags, mode, **kw):
+		return sha1handle.FileHandle(os.fdopen(os.open(self.path, flags), mode), flags, **kw)
+
+	def assertReads(self, fh):
+		rng = random.Random(0)
+		for offset in range(0, len(self.data) + 8192, 8192):
+			self.assertEqual(self.data[offset:offset + 8192], str(fh.read(8192, offset)))
+		for i in range(200):
+			offset = rng.randint(0, len(self.data))
+			size = rng.randint(1, 200000)
+			self.assertEqual(self.data[offset:offset + size], str(fh.read(size, offset)))
+
+	def testReadAhead(self):
+		fh = self.openHandle(os.O_RDONLY, "r", readahead=262144)
+		self.assertReads(fh)
+		# a slice handed out isn't changed by the refills after it
+		fh.read(4096, 0)
+		first = fh.read(4096, 4096)
+		for offset in range(8192, 500000, 4096):
+			fh.read(4096, offset)
+		self.assertEqual(self.data[4096:8192], str(first))
+		fh.close()
+
+	def testMmap(self):
+		fh = self.openHandle(os.O_RDONLY, "r", useMmap=True)
+		self.assertReads(fh)
+		fh.close()
+
+	def testVerifyHash(self):
+		import hashlib
+		fh = self.openHandle(os.O_RDONLY, "r", readahead=262144, verifyHash=hashlib.sha1)
+		for offset in range(0, len(self.data), 100000):
+			fh.read(100000, offset)
+			# rereads are fine
+			fh.read(10, offset)
+		self.assertEqual((hashlib.sha1(self.data).hexdigest(), len(self.data)), fh.readDigest())
+		fh.close()
+
+		fh = self.openHandle(os.O_RDONLY, "r", verifyHash=hashlib.sha1)
+		fh.read(10, 0)
+		fh.read(10, 20)
+		self.assertEqual((None, 0), fh.readDigest())
+		fh.close()
+
+	def testMmapEmptyFile(self):
+		open(self.path, "w").close()
+		fh = self.openHandle(os.O_RDONLY, "r", useMmap=True)
+		self.assertEqual("", str(fh.read(4096, 0)))
+		fh.close()
+
+	def testMmapGrownBehindItsBack(self):
+		with open(self.path, "wb") as f:
+			f.write(self.data[:10000])
+		fh = self.openHandle(os.O_RDONLY, "r", useMmap=True)
+		first = fh.read(4096, 0)
+		self.assertEqual(self.data[8192:10000], str(fh.read(4096, 8192)))
+		self.assertEqual("", str(fh.read(4096, 32768)))
+		with open(self.path, "ab") as f:
+			f.write(self.data[10000:])
+		# reads past the end of the map look at the file again
+		self.assertEqual(self.data[8192:12288], str(fh.read(4096, 8192)))
+		self.assertEqual(self.data[32768:36864], str(fh.read(4096, 32768)))
+		# and what was read from the old map is still there
+		self.assertEqual(self.data[:4096], str(first))
+		fh.close()
+
+	def testBufferedWrites(self):
+		fh = self.openHandle(os.O_RDWR, "r+", writeBuffer=100000)
+		expected = bytearray(self.data)
+		for offset in range(0, 300000, 1000):
+			fh.write("a" * 1000, offset)
+		expected[0:300000] = "a" * 300000
+		# not contiguous, so the collected writes go out first
+		fh.write("b" * 10, 5)
+		expected[5:15] = "b" * 10
+		self.assertEqual(str(expected[0:20]), str(fh.read(20, 0)))
+		fh.write("c" * 10, len(self.data))
+		expected.extend("c" * 10)
+		self.assertEqual(len(expected), fh.fstat().st_size)
+		fh.close()
+		with open(self.path, "rb") as f:
+			self.assertEqual(str(expected), f.read())
+
+	def testTruncateWithPendingWrites(self):
+		fh = self.openHandle(os.O_RDWR, "r+", writeBuffer=100000)
+		fh.write("z" * 100, 0)
+		fh.truncate(50)
+		fh.close()
+		with open(self.path, "rb") as f:
+			self.assertEqual("z" * 50, f.read())
+
+	def testCloseWhenPendingWritesFail(self):
+		fh = self.openHandle(os.O_RDWR, "r+", writeBuffer=100000)
+		fh.write("z" * 100, 0)
+		# swapped for a read-only descriptor, which refuses the collected writes as a full disk would
+		readOnly = os.open(self.path, os.O_RDONLY)
+		os.dup2(readOnly, fh.fileno())
+		os.close(readOnly)
+		self.assertRaises(EnvironmentError, fh.close)
+		self.assertTrue(fh.file.closed)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,67 @@
+# Tests for the ignore rules
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+
+sys.path.append("../")
+from sha1ignore import IgnoreRules, parseSize
+
+class TestIgnoreRules(unittest.TestCase):
+	def testDefaults(self):
+		rules = IgnoreRules(root="/data")
+		self.assertTrue(rules.ignored("/data/.Trash-1000/files/a.txt"))
+		self.assertFalse(rules.ignored("/data/a.txt", 0))
+		self.assertFalse(rules.needsSize)
+
+	def testGlobs(self):
+		rules = IgnoreRules(["# editor files", "*.sw?", "", "build/", "/tmp", "docs/**/*.bak",
+			"cache[0-9]"], "/data/")
+		self.assertTrue(rules.ignored("/data/src/.main.c.swp"))
+		self.assertFalse(rules.ignored("/data/src/main.c"))
+		# a name without a slash matches at any depth, and everything under a matching directory
+		self.assertTrue(rules.ignored("/data/a/build/out.o"))
+		self.assertFalse(rules.ignored("/data/a/build"))
+		self.assertTrue(rules.ignored("/data/tmp/x"))
+		self.assertFalse(rules.ignored("/data/a/tmp/x"))
+		self.assertTrue(rules.ignored("/data/docs/a/b/c.bak"))
+		self.assertTrue(rules.ignored("/data/docs/c.bak"))
+		self.assertFalse(rules.ignored("/data/c.bak"))
+		self.assertTrue(rules.ignored("/data/cache1/x"))
+		self.assertFalse(rules.ignored("/data/cachex/x"))
+		self.assertTrue(rules.ignoredDir("/data/a/build"))
+		self.assertFalse(rules.ignoredDir("/data/a"))
+
+	def testRegexExtensionsAndNegation(self):
+		rules = IgnoreRules([r"re:/\d+\.part$", "ext:.ISO tmp", "*.log", "!important.log"])
+		self.assertTrue(rules.ignored("/dl/123.part"))
+		self.assertFalse(rules.ignored("/dl/x123.part"))
+		self.assertTrue(rules.ignored("/images/disc.iso"))
+		self.assertTrue(rules.ignored("/a.TMP"))
+		self.assertTrue(rules.ignored("/var/debug.log"))
+		self.assertFalse(rules.ignored("/var/important.log"))
+		# with ! rules a directory may have files that are not ignored
+		self.assertFalse(rules.ignoredDir("/var/logs.log"))
+
+	def testSizes(self):
+		rules = IgnoreRules(["minsize: 1", "maxsize:2K"])
+		self.assertTrue(rules.needsSize)
+		self.assertTrue(rules.ignored("/empty", 0))
+		self.assertFalse(rules.ignored("/small", 2048))
+		self.assertTrue(rules.ignored("/big", 2049))
+		self.assertFalse(rules.ignored("/unknown"))
+		self.assertEqual(3 * 1024 ** 3, parseSize("3G"))
+		self.assertEqual(10, parseSize("10"))
+
+	def testBadRules(self):
+		self.assertRaises(ValueError, lambda: IgnoreRules(["re:("]))
+		self.assertRaises(ValueError, lambda: IgnoreRules(["maxsize: lots"]))
+		self.assertRaises(ValueError, lambda: IgnoreRules(["!ext:.iso"]))
+
+if __name__ == '__main__':
+	unittest.main()
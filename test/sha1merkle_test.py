@@ -0,0 +1,41 @@
+# Tests for the block level Merkle digests
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import hashlib
+
+sys.path.append("../")
+import sha1merkle
+
+class TestSha1Merkle(unittest.TestCase):
+	def testAddRange(self):
+		ranges = []
+		sha1merkle.addRange(ranges, 0, 10)
+		sha1merkle.addRange(ranges, 10, 20)
+		sha1merkle.addRange(ranges, 5, 8)
+		sha1merkle.addRange(ranges, 100, 110)
+		self.assertEqual([(0, 20), (100, 110)], ranges)
+
+	def testRangeBlocks(self):
+		self.assertEqual(set([0, 1, 3]), sha1merkle.rangeBlocks([(0, 20), (35, 40)], 10))
+		# an empty range marks the block it falls in
+		self.assertEqual(set([2]), sha1merkle.rangeBlocks([(25, 25)], 10))
+		self.assertEqual(0, sha1merkle.blockCount(0, 10))
+		self.assertEqual(3, sha1merkle.blockCount(21, 10))
+
+	def testMerkleRoot(self):
+		leaves = [hashlib.sha1(c).hexdigest() for c in "abc"]
+		raw = [hashlib.sha1(c).digest() for c in "abc"]
+		expected = hashlib.sha1(hashlib.sha1(raw[0] + raw[1]).digest() + raw[2]).hexdigest()
+		self.assertEqual(expected, sha1merkle.merkleRoot(leaves))
+		self.assertEqual(leaves[0], sha1merkle.merkleRoot(leaves[:1]))
+		self.assertEqual(hashlib.sha1("").hexdigest(), sha1merkle.merkleRoot([]))
+
+if __name__ == '__main__':
+	unittest.main()
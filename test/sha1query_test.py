@@ -0,0 +1,122 @@
+# Tests for the checksum query daemon
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import os
+import hashlib
+import shutil
+import socket
+import tempfile
+
+sys.path.append("../")
+from sha1db import Sha1DB
+from sha1query import QueryClient, QueryServer, QueryService
+
+class TestQuery(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.sha1db = Sha1DB(os.path.join(self.tmpdir, "sha1.db"))
+		self.paths = [self.makeFile("f%d.txt" % i, "file %d" % (i % 3)) for i in range(6)]
+		for path in self.paths:
+			self.sha1db.updateChecksum(path)
+		self.socketPath = os.path.join(self.tmpdir, "query.sock")
+		self.server = QueryServer(self.socketPath, QueryService(self.sha1db))
+		self.server.start()
+
+	def tearDown(self):
+		self.server.stop()
+		self.server.join()
+		shutil.rmtree(self.tmpdir)
+
+	def makeFile(self, name, contents):
+		path = os.path.join(self.tmpdir, name)
+		with open(path, "wb") as f:
+			f.write(contents)
+		return path
+
+	def testLookups(self):
+		digest = hashlib.sha1("file 0").hexdigest()
+		missing = hashlib.sha1("nothing").hexdigest()
+		with QueryClient(self.socketPath) as client:
+			digests = client.digests(self.paths + ["/nowhere"])
+			self.assertEqual(digest, digests[self.paths[3]])
+			self.assertEqual(hashlib.sha1("file 2").hexdigest(), digests[self.paths[5]])
+			self.assertEqual(None, digests["/nowhere"])
+			self.assertEqual({digest: [self.paths[0], self.paths[3]], missing: []},
+				client.paths([digest, missing]))
+			self.assertEqual({digest: [self.paths[0]]}, client.paths([digest], 1))
+			self.assertEqual({digest: True, missing: False}, client.exists([digest, missing]))
+			self.assertRaises(ValueError, lambda: client._request({"op": "nonsense"}))
+			# the connection is still usable after an error
+			self.assertEqual(True, client.exists([digest])[digest])
+
+	def testCacheInvalidation(self):
+		service = self.server.service
+		self.assertEqual(hashlib.sha1("file 0").hexdigest(), service.digests([self.paths[0]])[self.paths[0]])
+		self.assertEqual(1, len(service.byPath))
+		service.digests([self.paths[0]])
+		self.assertEqual(1, len(service.byPath))
+
+		# a write through another connection, as the mount makes, drops the entries it changed
+		self.makeFile("f0.txt", "changed")
+		self.sha1db.updateChecksum(self.paths[0])
+		self.assertEqual(hashlib.sha1("changed").hexdigest(), service.digests([self.paths[0]])[self.paths[0]])
+		self.assertEqual({hashlib.sha1("changed").hexdigest(): True}, service.exists([hashlib.sha1("changed").hexdigest()]))
+
+	def testChangesOnlyDropTheirEntries(self):
+		service = self.server.service
+		digests = [hashlib.sha1("file %d" % i).hexdigest() for i in range(3)]
+		service.digests(self.paths)
+		service.paths(digests)
+		self.assertEqual(6, len(service.byPath))
+		self.assertEqual(3, len(service.byDigest))
+
+		# f0 moves from the "file 0" digest to "file 1"; "file 2" and the other paths stay cached
+		self.makeFile("f0.txt", "file 1")
+		self.sha1db.updateChecksum(self.paths[0])
+		self.assertEqual({digests[0]: [self.paths[3]], digests[1]: [self.paths[0], self.paths[1], self.paths[4]]},
+			service.paths(digests[:2]))
+		self.assertEqual(5, len(service.byPath))
+		self.assertEqual([self.paths[2], self.paths[5]], service.byDigest.get(digests[2]))
+		self.assertEqual(digests[1], service.digests([self.paths[0]])[self.paths[0]])
+
+		# both paths of a rename, and a removal
+		renamed = os.path.join(self.tmpdir, "renamed.txt")
+		os.rename(self.paths[5], renamed)
+		self.sha1db.updatePath(self.paths[5], renamed)
+		self.sha1db.removeChecksum(self.paths[4])
+		self.assertEqual({self.paths[4]: None, self.paths[5]: None, renamed: digests[2]},
+			service.digests([self.paths[4], self.paths[5], renamed]))
+		self.assertEqual({digests[1]: [self.paths[0], self.paths[1]], digests[2]: [self.paths[2], renamed]},
+			service.paths(digests[1:]))
+
+	def testPrunedChangesEmptyTheCaches(self):
+		service = self.server.service
+		service.digests(self.paths)
+		self.makeFile("f0.txt", "changed")
+		self.sha1db.updateChecksum(self.paths[0])
+		# the change is pruned before the service has read it
+		self.sha1db.pruneChanges(-1)
+		service.digests([self.paths[0]])
+		self.assertEqual(1, len(service.byPath))
+
+	def testSocket(self):
+		# a second server can't take over a socket that is in use, but replaces a stale one
+		self.assertRaises(socket.error, lambda: QueryServer(self.socketPath, QueryService(self.sha1db)))
+		self.assertEqual(0600, os.stat(self.socketPath).st_mode & 0777)
+		stale = os.path.join(self.tmpdir, "stale.sock")
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.bind(stale)
+		sock.close()
+		server = QueryServer(stale, QueryService(self.sha1db))
+		server.stop()
+		self.assertFalse(os.path.exists(stale))
+
+if __name__ == '__main__':
+	unittest.main()
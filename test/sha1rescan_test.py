@@ -0,0 +1,73 @@
+# Tests for the background rescan
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import os
+import hashlib
+import json
+import shutil
+import tempfile
+
+sys.path.append("../")
+from sha1db import Sha1DB
+from sha1ignore import IgnoreRules
+from sha1rescan import Rescanner
+
+class TestRescanner(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.root = os.path.join(self.tmpdir, "root")
+		os.mkdir(self.root)
+		self.sha1db = Sha1DB(os.path.join(self.tmpdir, "sha1.db"))
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def makeFile(self, name, contents):
+		path = os.path.join(self.root, name)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		with open(path, "wb") as f:
+			f.write(contents)
+		return path
+
+	def testRescan(self):
+		paths = [self.makeFile("d%d/f%d.txt" % (i % 3, i), "file %d" % i) for i in range(250)]
+		self.makeFile("x.swp", "swap")
+		rescanner = Rescanner(self.sha1db, self.root, IgnoreRules(["*.swp"], self.root))
+		self.assertEqual("waiting", rescanner.status()["state"])
+		rescanner.start()
+		rescanner.join()
+
+		status = json.loads(rescanner.statusJson())
+		self.assertEqual("done", status["state"])
+		self.assertEqual((250, 250), (status["files"], status["totalFiles"]))
+		self.assertEqual(status["totalBytes"], status["bytes"])
+		self.assertEqual((0, 0), (status["changed"], status["errors"]))
+		for (i, path) in enumerate(paths):
+			self.assertEqual(hashlib.sha1("file %d" % i).hexdigest(), self.sha1db.lookupChecksum(path)[0])
+		self.assertEqual(None, self.sha1db.lookupChecksum(os.path.join(self.root, "x.swp")))
+
+	def testChangedWhileHashing(self):
+		path = self.makeFile("a.txt", "before")
+		gone = self.makeFile("b.txt", "gone")
+		same = self.makeFile("c.txt", "same")
+		hashed = [self.sha1db.hashPath(p) for p in (path, gone, same)]
+
+		# written and released through the mount before the scan stores what it read
+		self.makeFile("a.txt", "after the write")
+		self.sha1db.updateChecksum(path)
+		os.remove(gone)
+		self.assertEqual(1, self.sha1db.storeHashed(hashed))
+		self.assertEqual(hashlib.sha1("after the write").hexdigest(), self.sha1db.lookupChecksum(path)[0])
+		self.assertEqual(None, self.sha1db.lookupChecksum(gone))
+		self.assertEqual(hashlib.sha1("same").hexdigest(), self.sha1db.lookupChecksum(same)[0])
+
+if __name__ == '__main__':
+	unittest.main()
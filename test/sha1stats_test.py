@@ -0,0 +1,99 @@
+# Tests for the per-operation statistics
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import json
+import threading
+import time
+
+sys.path.append("../")
+import sha1stats
+
+class TestSha1Stats(unittest.TestCase):
+	def testBucketFor(self):
+		self.assertEqual(0, sha1stats.bucketFor(0))
+		self.assertEqual(1, sha1stats.bucketFor(0.000001))
+		self.assertEqual(10, sha1stats.bucketFor(0.001))
+		self.assertEqual(sha1stats.NUM_BUCKETS - 1, sha1stats.bucketFor(1000000))
+
+	def testRecord(self):
+		stats = sha1stats.OpStats()
+		stats.record("read", 0.001, nbytes=4096)
+		stats.record("read", 0.002, True, 10)
+		snapshot = stats.snapshot()
+		self.assertEqual(2, snapshot["read"]["calls"])
+		self.assertEqual(1, snapshot["read"]["errors"])
+		self.assertEqual(4106, snapshot["read"]["bytes"])
+		self.assertEqual([[1024, 1], [2048, 1]], snapshot["read"]["histogram"])
+		self.assertEqual(2, stats.totalCalls())
+		stats.record("db.updateChecksum", 0.01)
+		self.assertEqual(3, stats.totalCalls())
+		self.assertEqual(2, stats.filesystemCalls())
+		stats.count("verify.ok", 5)
+		self.assertEqual(5, stats.snapshot()["verify.ok"]["calls"])
+
+	def testThreadsMerge(self):
+		stats = sha1stats.OpStats()
+		def work():
+			for i in range(100):
+				stats.record("write", 0.0001)
+		threads = [threading.Thread(target=work) for i in range(4)]
+		for t in threads: t.start()
+		for t in threads: t.join()
+		self.assertEqual(400, stats.snapshot()["write"]["calls"])
+		self.assertEqual(400, json.loads(stats.toJson())["write"]["calls"])
+
+	def testThreadsRetired(self):
+		stats = sha1stats.OpStats()
+		def work():
+			stats.record("read", 0.0001, nbytes=10)
+		for i in range(50):
+			t = threading.Thread(target=work)
+			t.start()
+			t.join()
+		# finished threads are folded in when the counters are read; a thread leaves threading's
+		# list of running threads just after join returns
+		self.assertEqual(50, stats.snapshot()["read"]["calls"])
+		deadline = time.time() + 5
+		while len(stats._tables) > 0 and time.time() < deadline:
+			time.sleep(0.01)
+			stats.snapshot()
+		self.assertEqual(0, len(stats._tables))
+		self.assertEqual(500, stats.snapshot()["read"]["bytes"])
+		self.assertEqual(50, stats.filesystemCalls())
+		stats.record("read", 0.0001)
+		self.assertEqual(51, stats.totalCalls())
+
+	def testRunningThreadsKept(self):
+		stats = sha1stats.OpStats()
+		(recorded, done) = (threading.Event(), threading.Event())
+		def work():
+			stats.record("read", 0.0001)
+			recorded.set()
+			done.wait()
+			stats.record("read", 0.0001)
+		t = threading.Thread(target=work)
+		t.start()
+		recorded.wait()
+		# a running thread keeps its table, and goes on recording into it
+		self.assertEqual(1, stats.snapshot()["read"]["calls"])
+		self.assertEqual(1, len(stats._tables))
+		done.set()
+		t.join()
+		self.assertEqual(2, stats.snapshot()["read"]["calls"])
+
+	def testTimed(self):
+		@sha1stats.timed("test.timedRaises")
+		def raises():
+			raise IOError("expected")
+		self.assertRaises(IOError, raises)
+		self.assertEqual(1, sha1stats.STATS.snapshot()["test.timedRaises"]["errors"])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,86 @@
+# Tests for the FUSE operation trace recorder and replayer
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+
+sys.path.append("../")
+import sha1trace
+
+# Just enough of a filesystem to be traced; works on paths under root
+class FakeFS:
+	def __init__(self, root):
+		self.root = root
+	def open(self, path, flags):
+		mode = "r+" if (flags & (os.O_WRONLY | os.O_RDWR)) else "r"
+		return os.fdopen(os.open(self.root + path, flags, 0644), mode)
+	def read(self, path, size, offset, fh=None):
+		fh.seek(offset)
+		return fh.read(size)
+	def write(self, path, buf, offset, fh=None):
+		fh.seek(offset)
+		fh.write(buf)
+		return len(buf)
+	def release(self, path, flags, fh=None):
+		fh.close()
+	def unlink(self, path):
+		os.unlink(self.root + path)
+
+class TestSha1Trace(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.tracefile = os.path.join(self.tmpdir, "trace")
+		os.mkdir(os.path.join(self.tmpdir, "live"))
+		os.mkdir(os.path.join(self.tmpdir, "scratch"))
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def testRecordAndReplay(self):
+		fs = FakeFS(os.path.join(self.tmpdir, "live"))
+		recorder = sha1trace.TraceRecorder(self.tracefile)
+		recorder.attach(fs)
+		fh = fs.open("/a\tb.txt", os.O_RDWR | os.O_CREAT)
+		fs.write("/a\tb.txt", "x" * 100, 0, fh=fh)
+		fs.read("/a\tb.txt", 10, 50, fh)
+		fs.release("/a\tb.txt", os.O_RDWR, fh)
+		self.assertRaises(OSError, lambda: fs.unlink("/missing"))
+		recorder.close()
+
+		calls = list(sha1trace.readTrace(self.tracefile))
+		self.assertEqual(["open", "write", "read", "release", "unlink"], [c[2] for c in calls])
+		self.assertEqual("h0", calls[0][3])
+		self.assertEqual(["s/a\\tb.txt", "b100", "i0", "h0"], calls[1][4])
+		self.assertEqual("b10", calls[2][3])
+		self.assertEqual("e2", calls[4][3])
+
+		scratch = os.path.join(self.tmpdir, "scratch")
+		report = sha1trace.TraceReplayer(FakeFS(scratch)).replay(self.tracefile)
+		self.assertEqual(5, report["calls"])
+		self.assertEqual(100, report["bytes_written"])
+		self.assertEqual(10, report["bytes_read"])
+		self.assertEqual(1, report["ops"]["unlink"]["errors"])
+		self.assertEqual(100, os.path.getsize(os.path.join(scratch, "a\tb.txt")))
+
+	def testPrepareRoot(self):
+		with open(self.tracefile, "w") as f:
+			f.write(sha1trace.TRACE_HEADER)
+			f.write("0\t5\topen\th0\ts/dir/old.bin\ti0\n")
+			f.write("5\t5\tread\tb4096\ts/dir/old.bin\ti4096\ti8192\th0\n")
+			f.write("9\t5\trelease\tn\ts/dir/old.bin\ti0\th0\n")
+		scratch = os.path.join(self.tmpdir, "scratch")
+		replayer = sha1trace.TraceReplayer(FakeFS(scratch))
+		replayer.prepareRoot(self.tracefile, scratch)
+		self.assertEqual(12288, os.path.getsize(os.path.join(scratch, "dir", "old.bin")))
+		self.assertEqual(4096, replayer.replay(self.tracefile)["bytes_read"])
+
+if __name__ == '__main__':
+	unittest.main()
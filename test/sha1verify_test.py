@@ -0,0 +1,78 @@
+# Tests for scrubbing
+# Copyright (C) 2009-2011 Krysta Bouzek  <nwkrystab@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import os
+import json
+import shutil
+import tempfile
+import time
+from StringIO import StringIO
+
+sys.path.append("../")
+import sha1verify
+from sha1db import Sha1DB
+
+class TestSha1Verify(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.sha1db = Sha1DB(os.path.join(self.tmpdir, "sha1.db"))
+		self.paths = []
+		for i in range(10):
+			path = os.path.join(self.tmpdir, "file%d" % i)
+			with open(path, "wb") as f:
+				f.write("contents %d" % i)
+			# whole seconds, so that the mtime can be put back exactly
+			os.utime(path, (1000000000, 1000000000))
+			self.sha1db.updateChecksum(path)
+			self.paths.append(path)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def verify(self, **kw):
+		out = StringIO()
+		summary = sha1verify.Verifier(self.sha1db, 3, out=out).run(**kw)
+		return (summary, [json.loads(line) for line in out.getvalue().splitlines()])
+
+	def testVerify(self):
+		# flip the contents without changing the size or the mtime
+		with open(self.paths[3], "r+b") as f:
+			f.write("C")
+		os.utime(self.paths[3], (1000000000, 1000000000))
+		# a normal change
+		with open(self.paths[5], "ab") as f:
+			f.write("more")
+		os.remove(self.paths[7])
+
+		(summary, lines) = self.verify()
+		self.assertEqual((7, 1, 1, 1), (summary["ok"], summary["mismatch"], summary["changed"],
+			summary["missing"]))
+		self.assertEqual([(self.paths[3], "mismatch"), (self.paths[5], "changed"),
+			(self.paths[7], "missing")], [(line["path"], line["status"]) for line in lines[:-1]])
+		self.assertEqual("summary", lines[-1]["status"])
+		self.assertEqual(None, self.sha1db.getCheckpoint(sha1verify.CHECKPOINT))
+
+	def testResume(self):
+		self.sha1db.setCheckpoint(sha1verify.CHECKPOINT, self.paths[5])
+		(summary, lines) = self.verify()
+		self.assertEqual(4, summary["ok"])
+		(summary, lines) = self.verify(sample=3)
+		self.assertEqual(3, summary["ok"])
+
+	def testRateLimiter(self):
+		limiter = sha1verify.RateLimiter(1000000)
+		start = time.time()
+		# the first second's worth is free
+		for i in range(6):
+			limiter.consume(250000)
+		self.assertTrue(time.time() - start >= 0.45)
+
+if __name__ == '__main__':
+	unittest.main()